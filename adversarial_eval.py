@@ -0,0 +1,202 @@
+"""
+Batched adversarial evaluation: measures how often generator-obscured malware evades one or more discriminators as
+a function of the perturbation budget.
+
+For every malware sample of the test split, K noise draws are pushed through the generator as a single (N*K, ...)
+batch. The perturbation that gan.edit_features applies to the modifiable feature blocks is then scaled by each
+budget in [0, 1] (0 being the clean sample, 1 the full generator edit) and scored by every discriminator. Features
+and generator outputs are computed once per batch and shared by all discriminators and budgets.
+
+Usage:
+    python adversarial_eval.py ./models/simple_generator.model \
+        --disc simple=./models/simple_disc.model --disc resistant=./models/resistant_disc.model@0.7 \
+        --npz dataset/test_set.npz --draws 8 --out evasion.json
+"""
+import argparse
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import gan
+from gan import tf
+
+DEFAULT_BUDGETS = (0.0, 0.1, 0.25, 0.5, 0.75, 1.0)
+
+
+def make_evasion_step(generator, discriminators, thresholds, budgets, draws):
+    """
+    Returns a graph-compiled function mapping a batch of malware features of shape (N, 2381) to per-discriminator
+    evasion counts of shape (len(budgets), 2): samples where any draw evaded, and individual draws that evaded. The
+    mean L2 norm of the full perturbation is returned as well.
+
+    :param generator: Generator model from gan.make_generator_model.
+    :param discriminators: List of discriminator models.
+    :param thresholds: Detection threshold of each discriminator.
+    :param budgets: Perturbation budgets, fractions of the full generator edit to apply.
+    :param draws: Number of noise draws (K) per sample.
+    """
+    noise_dim = gan.generator_noise_dim(generator)
+
+    @tf.function(input_signature=[tf.TensorSpec([None, gan.feat_size], tf.float32)])
+    def step(malware_feats):
+        n = tf.shape(malware_feats)[0]
+        tiled = tf.repeat(malware_feats, draws, axis=0)
+        noise = tf.random.normal([n * draws, noise_dim], dtype=tf.float32)
+        gen_output = generator(tf.concat([tiled, noise], axis=1), training=False)
+        delta = gan.edit_features(tiled, gen_output) - tiled
+        delta_norm = tf.reduce_sum(tf.norm(delta, axis=1))
+
+        counts = []
+        for discriminator, threshold in zip(discriminators, thresholds):
+            disc_counts = []
+            for budget in budgets:
+                pred = discriminator(tiled + budget * delta, training=False)
+                evaded = tf.reshape(pred < threshold, [n, draws])
+                disc_counts.append(tf.stack([tf.reduce_sum(tf.cast(tf.reduce_any(evaded, axis=1), tf.int64)),
+                                             tf.reduce_sum(tf.cast(evaded, tf.int64))]))
+            counts.append(tf.stack(disc_counts))
+        return tf.stack(counts), delta_norm
+
+    return step
+
+
+def npz_malware_batches(path, batch_size):
+    """
+    Yields batches of malware features from a numpy file written by setup.save_npz.
+
+    :param path: Path of the numpy file.
+    :param batch_size: Number of samples per batch.
+    """
+    import setup
+
+    labels, features = setup.load_npz(path)
+    malware = features[labels == 1]
+    for i in range(0, len(malware), batch_size):
+        yield malware[i:i + batch_size]
+
+
+def sorel_malware_batches(metadb_path, lmdb_path, batch_size, mode='test', n_samples=None):
+    """
+    Yields batches of malware features from a SOREL split, read through dataset.Dataset.
+
+    :param metadb_path: Path of meta.db.
+    :param lmdb_path: Path of the features LMDB.
+    :param batch_size: Number of samples per batch.
+    :param mode: Split to read.
+    :param n_samples: Optional limit on the number of samples queried from meta.db.
+    """
+    import dataset
+    ds = dataset.Dataset(metadb_path, lmdb_path, return_malicious=True, return_counts=False, return_tags=False,
+                         mode=mode, n_samples=n_samples)
+    keys = [k for k, label in zip(ds.keylist, ds.labels) if label == 1]
+    for i in range(0, len(keys), batch_size):
+        yield np.stack([ds.features_lmdb_reader(k) for k in keys[i:i + batch_size]]).astype(np.float32)
+
+
+def run(generator, discriminators, batches, thresholds=None, budgets=DEFAULT_BUDGETS, draws=8, workers=2):
+    """
+    Evaluates evasion rates over all batches and returns a JSON-able report.
+
+    :param generator: Generator model.
+    :param discriminators: Dict of name to discriminator model.
+    :param batches: Iterable of malware feature arrays of shape (N, 2381).
+    :param thresholds: Optional dict of name to detection threshold, defaults to 0.5.
+    :param budgets: Perturbation budgets to sweep.
+    :param draws: Number of noise draws per sample.
+    :param workers: Number of batches evaluated concurrently.
+    """
+    names = list(discriminators)
+    thresholds = [float((thresholds or {}).get(name, 0.5)) for name in names]
+    step = make_evasion_step(generator, [discriminators[name] for name in names], thresholds, list(budgets), draws)
+
+    totals = np.zeros((len(names), len(budgets), 2), dtype=np.int64)
+    state = {'samples': 0, 'delta_norm': 0.0}
+    lock = threading.Lock()
+
+    def evaluate_batch(batch):
+        counts, delta_norm = step(batch)
+        with lock:
+            totals[:] += counts.numpy()
+            state['samples'] += len(batch)
+            state['delta_norm'] += float(delta_norm)
+
+    # TensorFlow releases the GIL while executing, so batches run concurrently on separate threads. Only a bounded
+    # number of batches are in flight to keep memory flat.
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        in_flight = []
+        for batch in batches:
+            in_flight.append(pool.submit(evaluate_batch, batch))
+            if len(in_flight) >= 2 * workers:
+                in_flight.pop(0).result()
+        for future in in_flight:
+            future.result()
+
+    samples = max(state['samples'], 1)
+    report = {
+        'samples': state['samples'],
+        'draws': draws,
+        'budgets': list(budgets),
+        'mean_full_perturbation_l2': state['delta_norm'] / (samples * draws),
+        'discriminators': {},
+    }
+    for d, name in enumerate(names):
+        report['discriminators'][name] = {
+            'threshold': thresholds[d],
+            # Fraction of samples for which at least one of the K draws evaded detection
+            'evasion_rate_any_draw': (totals[d, :, 0] / samples).tolist(),
+            # Fraction of individual draws that evaded detection
+            'evasion_rate_per_draw': (totals[d, :, 1] / (samples * draws)).tolist(),
+        }
+    return report
+
+
+def parse_disc(spec):
+    # name=path[@threshold]
+    name, _, rest = spec.partition('=')
+    path, _, threshold = rest.partition('@')
+    return name, path, float(threshold) if threshold else 0.5
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evasion rate vs. perturbation budget for trained generators.")
+    parser.add_argument("generator_path")
+    parser.add_argument("--disc", action="append", required=True, help="name=path[@threshold], repeatable.")
+    parser.add_argument("--npz", help="Numpy test set written by setup.save_npz.")
+    parser.add_argument("--metadb", help="SOREL meta.db, used instead of --npz.")
+    parser.add_argument("--lmdb", help="SOREL features LMDB (with --metadb).")
+    parser.add_argument("--n-samples", type=int, default=None)
+    parser.add_argument("--budgets", type=float, nargs="+", default=list(DEFAULT_BUDGETS))
+    parser.add_argument("--draws", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--out", help="Path to write the JSON report to.")
+    args = parser.parse_args()
+
+    generator = gan.load_model(args.generator_path)
+    discriminators = {}
+    thresholds = {}
+    for spec in args.disc:
+        name, path, threshold = parse_disc(spec)
+        discriminators[name] = gan.load_model(path)
+        thresholds[name] = threshold
+
+    if args.metadb:
+        batches = sorel_malware_batches(args.metadb, args.lmdb, args.batch_size, n_samples=args.n_samples)
+    elif args.npz:
+        batches = npz_malware_batches(args.npz, args.batch_size)
+    else:
+        parser.error("one of --npz or --metadb is required")
+
+    report = run(generator, discriminators, batches, thresholds, args.budgets, args.draws, args.workers)
+    for name, result in report['discriminators'].items():
+        rates = ', '.join(f'{b}: {r * 100:.2f}%' for b, r in zip(report['budgets'], result['evasion_rate_any_draw']))
+        print(f'{name} - Evasion rate by budget: {rates}')
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
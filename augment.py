@@ -0,0 +1,169 @@
+"""
+Offline augmentation of a training set with adversarial feature vectors from a trained generator.
+
+The malware rows of a feature store or numpy feature set are streamed in chunks through the generator and
+gan.edit_features, in large batches of one traced function, once per noise seed. The obscured vectors are appended,
+labeled malware, to a feature store (see feature_store.py) that gan.prepare_datasets loads like any other training
+set. With --copy-source the source rows are copied into it first, so it can replace the source set.
+
+Chunks are read and shards written in background threads while the generator runs. Noise is drawn with stateless
+random ops seeded by (seed, first row of the batch), so the output only depends on the seeds and the batch size, and
+the store's high-water mark records how far the job got: running it again on the same output, with the same seeds and
+batch size, resumes after the last complete shard.
+
+Usage:
+    python augment.py models/generator.model dataset/train_store dataset/train_augmented --seeds 0 1 2 --copy-source
+"""
+import argparse
+import concurrent.futures
+import os
+import time
+
+import numpy as np
+
+from lazy import lazy_import
+
+tf = lazy_import('tensorflow')
+
+feat_size = 2381  # From EMBER feature digest, DO NOT CHANGE!
+
+
+def make_augment_function(generator, jit_compile=False):
+    """
+    Returns a function of (features, seed) returning the obscured features, traced once for any batch size.
+
+    :param generator: Generator model, see gan.make_generator_model.
+    :param jit_compile: Compiles the function with XLA.
+    """
+    import gan
+
+    noise_dim = gan.generator_noise_dim(generator)
+
+    @tf.function(input_signature=[tf.TensorSpec([None, feat_size], tf.float32), tf.TensorSpec([2], tf.int64)],
+                 jit_compile=jit_compile)
+    def augment(features, seed):
+        noise = tf.random.stateless_normal([tf.shape(features)[0], noise_dim], seed=seed, dtype=tf.float32)
+        generator_output = generator(tf.concat([features, noise], axis=1), training=False)
+        return gan.edit_features(features, generator_output)
+
+    return augment
+
+
+class _Source(object):
+    """ Row chunks of a feature store, or of a numpy feature set loaded in memory. """
+
+    def __init__(self, path):
+        import feature_store
+        if os.path.isdir(path):
+            self.store = feature_store.FeatureStore(path)
+            if len(self.store.columns()) != feat_size:
+                raise ValueError(f'The generator needs all feature blocks, the store at {path} has {self.store.blocks}')
+            self.labels = self.store.labels()
+        else:
+            self.store = None
+            self.labels, self.features = feature_store.load(path)
+
+    def rows(self, indices):
+        if self.store is not None:
+            return self.store.load(rows=indices)[1]
+        return self.features[indices]
+
+
+def augment(generator, source_path, out_path, seeds=(0,), copy_source=False, chunk_size=65536, batch_size=1024,
+            jit_compile=False):
+    """
+    Appends the obscured malware of a training set to a feature store, see the module docstring. Returns the number
+    of rows appended.
+
+    :param generator: Generator model, or the path of one saved by gan.save_model.
+    :param source_path: Feature store directory or numpy file of the training set.
+    :param out_path: Feature store directory to append to, created if missing.
+    :param seeds: Noise seeds, every malware row is obscured once per seed.
+    :param copy_source: First copy every row of the source into the output.
+    :param chunk_size: Number of rows per output shard, rounded up to a multiple of batch_size.
+    :param batch_size: Number of rows per generator call.
+    :param jit_compile: Compiles the generator and edit_features with XLA.
+    """
+    import feature_store
+    import gan
+
+    if isinstance(generator, str):
+        generator = gan.load_model(generator)
+    source = _Source(source_path)
+    malware = np.flatnonzero(source.labels == 1)
+    stages = (['source'] if copy_source else []) + [int(seed) for seed in seeds]
+    chunk_size = -(-chunk_size // batch_size) * batch_size
+
+    if os.path.exists(os.path.join(out_path, feature_store.MANIFEST)):
+        store = feature_store.FeatureStore(out_path)
+        mark = store.high_water_mark or {'stages': stages, 'batch_size': batch_size, 'stage': 0, 'row': 0}
+        if (mark['stages'], mark['batch_size']) != (stages, batch_size):
+            raise ValueError(f'{out_path} was augmented with stages {mark["stages"]} and batch size '
+                             f'{mark["batch_size"]}, not {stages} and {batch_size}')
+    else:
+        store = feature_store.create_store(out_path)
+        mark = {'stages': stages, 'batch_size': batch_size, 'stage': 0, 'row': 0}
+
+    augment_fn = make_augment_function(generator, jit_compile)
+    malware_label = np.ones(1, dtype=source.labels.dtype)
+    tasks = []
+    for stage in range(mark['stage'], len(stages)):
+        rows = np.arange(len(source.labels)) if stages[stage] == 'source' else malware
+        start = mark['row'] if stage == mark['stage'] else 0
+        tasks += [(stage, i, rows[i:i + chunk_size]) for i in range(start, len(rows), chunk_size)]
+
+    def obscure(stage, feats, first_row):
+        if stages[stage] == 'source':
+            return feats
+        out = np.empty_like(feats)
+        for i in range(0, len(feats), batch_size):
+            seed = tf.constant([stages[stage], first_row + i], dtype=tf.int64)
+            out[i:i + batch_size] = augment_fn(tf.constant(feats[i:i + batch_size]), seed).numpy()
+        return out
+
+    def write(stage, first_row, indices, feats):
+        next_row = first_row + len(indices)
+        labels = source.labels[indices] if stages[stage] == 'source' else np.repeat(malware_label, len(indices))
+        done = next_row >= (len(source.labels) if stages[stage] == 'source' else len(malware))
+        next_mark = dict(mark, stage=stage + done, row=0 if done else next_row)
+        store.append_shard(labels, feats, high_water_mark=next_mark)
+
+    appended = 0
+    with concurrent.futures.ThreadPoolExecutor(1) as reader, concurrent.futures.ThreadPoolExecutor(1) as writer:
+        pending_read = reader.submit(source.rows, tasks[0][2]) if tasks else None
+        pending_write = None
+        for n, (stage, first_row, indices) in enumerate(tasks):
+            feats = pending_read.result()
+            if n + 1 < len(tasks):
+                pending_read = reader.submit(source.rows, tasks[n + 1][2])
+            feats = obscure(stage, np.asarray(feats, dtype=np.float32), first_row)
+            if pending_write is not None:
+                pending_write.result()
+            pending_write = writer.submit(write, stage, first_row, indices, feats)
+            appended += len(indices)
+        if pending_write is not None:
+            pending_write.result()
+    return appended
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Augment a training set with the generator's obscured malware.")
+    parser.add_argument("generator", help="Generator model saved by gan.save_model.")
+    parser.add_argument("source", help="Feature store directory or numpy file of the training set.")
+    parser.add_argument("out", help="Feature store directory to append to, created if missing.")
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0], help="Noise seeds, one obscured copy per seed.")
+    parser.add_argument("--copy-source", action="store_true", help="Copy the source rows into the output first.")
+    parser.add_argument("--chunk-size", type=int, default=65536, help="Rows per output shard.")
+    parser.add_argument("--batch-size", type=int, default=1024, help="Rows per generator call.")
+    parser.add_argument("--jit", action="store_true", help="Compile the generator with XLA.")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    appended = augment(args.generator, args.source, args.out, args.seeds, args.copy_source, args.chunk_size,
+                       args.batch_size, args.jit)
+    secs = time.perf_counter() - start
+    print(f'Appended {appended} rows to {args.out} in {secs:.1f}s ({appended / secs * 3600:.0f} rows/hour)')
+
+
+if __name__ == '__main__':
+    main()
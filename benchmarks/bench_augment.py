@@ -0,0 +1,73 @@
+"""
+Throughput of augment.make_augment_function at large batch sizes, with and without XLA, against calling the generator
+and gan.edit_features eagerly on training batches of gan.BATCH_SIZE as gan_test_step does, with an untrained
+generator on synthetic feature vectors.
+
+Usage:
+    python benchmarks/bench_augment.py --rows 65536 --batch-sizes 1024 4096 16384
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import augment  # noqa: E402
+import gan  # noqa: E402
+import synthetic  # noqa: E402
+from feature_stats import signed_log1p  # noqa: E402
+
+
+def eager(generator, feats, batch_size):
+    tf = gan.tf
+    for i in range(0, len(feats), batch_size):
+        batch = tf.constant(feats[i:i + batch_size])
+        noise = tf.random.normal([len(batch), gan.noise_dim], dtype=tf.float32)
+        gan.edit_features(batch, generator(tf.concat([batch, noise], axis=1), training=False)).numpy()
+
+
+def traced(augment_fn, feats, batch_size):
+    tf = gan.tf
+    for i in range(0, len(feats), batch_size):
+        augment_fn(tf.constant(feats[i:i + batch_size]), tf.constant([0, i], dtype=tf.int64)).numpy()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark adversarial batch generation.")
+    parser.add_argument("--rows", type=int, default=65536)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1024, 4096, 16384])
+    parser.add_argument("--out", help="Path to write the JSON results to.")
+    args = parser.parse_args()
+
+    feats = signed_log1p(synthetic.synthetic_features(args.rows))
+    generator = gan.make_generator_model()
+    generator.build((None, gan.feat_size + gan.noise_dim))
+
+    runs = [(f'eager_{gan.BATCH_SIZE}', lambda f: eager(generator, f, gan.BATCH_SIZE))]
+    for jit in (False, True):
+        augment_fn = augment.make_augment_function(generator, jit_compile=jit)
+        runs += [(f'{"xla" if jit else "traced"}_{b}', lambda f, fn=augment_fn, b=b: traced(fn, f, b))
+                 for b in args.batch_sizes]
+    results = {}
+    for name, run in runs:
+        run(feats[:max(args.batch_sizes)])  # Traces and warms up
+        start = time.perf_counter()
+        run(feats)
+        secs = time.perf_counter() - start
+        results[name] = {'secs': secs, 'rows_per_hour': args.rows / secs * 3600}
+        print(f'{name:>12}: {args.rows / secs * 3600 / 1e6:8.2f}M rows/hour')
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
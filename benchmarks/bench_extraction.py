@@ -0,0 +1,92 @@
+"""
+Compares in-process feature extraction (features.PEFeatureExtractor) against extraction.GuardedExtractor on a
+synthetic corpus mixing well-formed PE files with malformed ones: files per second, and the failure reasons.
+
+Usage:
+    python benchmarks/bench_extraction.py --files 200 --bad-fraction 0.3 --workers 4
+"""
+import argparse
+import collections
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import extraction  # noqa: E402
+import synthetic  # noqa: E402
+
+
+def corpus(files, bad_fraction, size, seed=0):
+    """ Returns a list of files: synthetic PE files, some of them truncated, corrupted or replaced by random bytes. """
+    rng = np.random.default_rng(seed)
+    out = []
+    for i in range(files):
+        bytez = synthetic.synthetic_pe(size, seed=i)
+        if rng.random() < bad_fraction:
+            kind = i % 3
+            if kind == 0:
+                bytez = bytez[:rng.integers(64, 1024)]
+            elif kind == 1:
+                corrupted = bytearray(bytez)
+                corrupted[0x80:0x200] = rng.integers(0, 256, 0x180, dtype=np.uint8).tobytes()
+                bytez = bytes(corrupted)
+            else:
+                bytez = b'MZ' + rng.integers(0, 256, size, dtype=np.uint8).tobytes()
+        out.append(bytez)
+    return out
+
+
+def in_process(files):
+    import features
+    extractor = features.PEFeatureExtractor(print_feature_warning=False)
+    errors = collections.Counter()
+    for bytez in files:
+        try:
+            extractor.raw_features(bytez)
+        except Exception as e:  # Would have ended the extraction job
+            errors[type(e).__name__] += 1
+    return dict(errors)
+
+
+def guarded(files, workers, timeout):
+    with extraction.GuardedExtractor(workers=workers, timeout=timeout) as extractor:
+        for _ in extractor.extract_many(files):
+            pass
+        return dict(extractor.failure_counts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark guarded feature extraction.")
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--size", type=int, default=256 << 10, help="Size of the synthetic files in bytes.")
+    parser.add_argument("--bad-fraction", type=float, default=0.3)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--timeout", type=float, default=10.0)
+    parser.add_argument("--out", help="Path to write the JSON results to.")
+    args = parser.parse_args()
+
+    files = corpus(args.files, args.bad_fraction, args.size)
+    results = {}
+    for name, run in (('in_process', lambda: in_process(files)),
+                      ('guarded_1', lambda: guarded(files, 1, args.timeout)),
+                      (f'guarded_{args.workers}', lambda: guarded(files, args.workers, args.timeout))):
+        start = time.perf_counter()
+        failures = run()
+        secs = time.perf_counter() - start
+        results[name] = {'secs': secs, 'files_per_sec': len(files) / secs, 'failures': failures}
+        print(f'{name:>12}: {len(files) / secs:8.1f} files/s, failures {failures}')
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Size and read throughput of a features LMDB in the SOREL-20M format (lmdb_writer.encode) against the compact record
+formats of feature_codec, on synthetic feature vectors. Reading covers the cursor, decompression and decoding into
+the postprocessed float32 vector (feature_stats.decode).
+
+Usage:
+    python benchmarks/bench_feature_codec.py --records 20000 --codecs none zlib
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import feature_codec  # noqa: E402
+import feature_stats  # noqa: E402
+import lmdb_writer  # noqa: E402
+import synthetic  # noqa: E402
+
+
+def write(path, feats, n, encoder):
+    with lmdb_writer.LMDBWriter(path, workers=1, encoder=encoder) as writer:
+        writer.write(('%064x' % i, feats[i % len(feats)]) for i in range(n))
+
+
+def read(path):
+    import lmdb
+    env = lmdb.open(path, readonly=True, lock=False, subdir=False)
+    total = 0.0
+    with env.begin() as txn:
+        for _, value in txn.cursor():
+            total += feature_stats.decode(value)[0]
+    env.close()
+    return total
+
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark feature record formats.")
+    parser.add_argument("--records", type=int, default=20000)
+    parser.add_argument("--codecs", nargs="+", default=["none", "zlib"])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--out", help="Path to write the JSON results to.")
+    args = parser.parse_args()
+
+    feats = synthetic.synthetic_features(1000)
+    formats = [('msgpack_zlib6', None)]
+    formats += [(f'{dtype}_{codec}', lambda v, d=dtype, c=codec: feature_codec.encode(v, d, c))
+                for dtype in feature_codec.DTYPES for codec in args.codecs]
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, encoder in formats:
+            path = os.path.join(tmp, f'{name}.mdb')
+            write(path, feats, args.records, encoder)
+            read(path)  # Warms the page cache, so all formats are read from memory
+            secs = min(_timed(read, path) for _ in range(args.repeats))
+            size = os.path.getsize(path)
+            results[name] = {'records_per_sec': args.records / secs, 'file_mb': size / (1 << 20),
+                             'bytes_per_record': size / args.records}
+            print(f'{name:>14}: {args.records / secs:9.0f} records/s, {size / args.records:7.0f} bytes/record')
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Compares loading block subsets from a numpy feature set written by setup.save_npz, which is read whole and then
+sliced, against the block-grouped feature store of feature_store.py: load time and peak memory allocated while
+loading. The page cache is not dropped between runs, so load times are of warm reads.
+
+Usage:
+    python benchmarks/bench_feature_store.py                       # synthetic features
+    python benchmarks/bench_feature_store.py --npz dataset/train_set.npz --blocks histogram byteentropy
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import feature_store  # noqa: E402
+import features  # noqa: E402
+
+feat_size = 2381  # From EMBER feature digest, DO NOT CHANGE!
+
+# Block subsets to load, besides the ones given on the command line
+DEFAULT_SUBSETS = [['histogram'], ['histogram', 'byteentropy'], ['section', 'imports', 'exports'], None]
+
+
+def load_cost(path, blocks):
+    """ Returns (seconds, peak MB allocated, loaded MB) of loading the given blocks of a feature set. """
+    tracemalloc.start()
+    start = time.perf_counter()
+    _, feats = feature_store.load(path, blocks)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak / 2 ** 20, feats.nbytes / 2 ** 20
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark block-selective feature loading.")
+    parser.add_argument("--npz", help="Numpy feature set written by setup.save_npz, synthetic when omitted.")
+    parser.add_argument("--samples", type=int, default=20000, help="Number of synthetic samples.")
+    parser.add_argument("--blocks", nargs="+", help="Block subset to benchmark in addition to the default ones.")
+    parser.add_argument("--out", help="Path to write the JSON results to.")
+    args = parser.parse_args()
+
+    subsets = DEFAULT_SUBSETS + ([args.blocks] if args.blocks else [])
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        npz_path = args.npz
+        if npz_path is None:
+            rng = np.random.default_rng(0)
+            npz_path = os.path.join(tmp, 'features.npz')
+            np.savez(npz_path, labels=rng.integers(0, 2, args.samples).astype(float),
+                     features=rng.random((args.samples, feat_size), dtype=np.float32))
+        labels, feats = feature_store.load(npz_path)
+        store_path = os.path.join(tmp, 'store')
+        feature_store.write_store(store_path, labels, feats)
+        del feats
+
+        for blocks in subsets:
+            name = ','.join(blocks) if blocks else 'all'
+            for kind, path in (('npz', npz_path), ('store', store_path)):
+                secs, peak_mb, loaded_mb = load_cost(path, blocks)
+                print(f'{kind:>5} {name:<28} {secs:7.3f}s  peak {peak_mb:8.1f} MB  loaded {loaded_mb:8.1f} MB')
+                results.append({'kind': kind, 'blocks': blocks, 'columns': len(features.block_columns(
+                    blocks or features.feature_blocks())), 'load_secs': secs, 'peak_mb': peak_mb,
+                    'loaded_mb': loaded_mb})
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
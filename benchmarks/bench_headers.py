@@ -0,0 +1,90 @@
+"""
+Compares header-only extraction of the lief based blocks (pe_headers.py) against reading the whole file, parsing it
+with lief and computing the byte based blocks, on synthetic installers: a PE file followed by a large overlay, like
+the payload of self-extracting installers. Reports bytes read and seconds per file.
+
+Usage:
+    python benchmarks/bench_headers.py --overlay-mb 64 --repeats 5
+"""
+import argparse
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import pe_headers  # noqa: E402
+import synthetic  # noqa: E402
+
+
+class CountingReader(io.FileIO):
+    """ File handle counting the bytes read. """
+    bytes_read = 0
+
+    def read(self, size=-1):
+        data = super().read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+def full(path):
+    import features
+    import lief
+    with CountingReader(path) as f:
+        bytez = f.read()
+        lief.PE.parse(list(bytez))
+        for fe in (features.ByteHistogram(), features.ByteEntropyHistogram(), features.StringExtractor()):
+            fe.raw_features(bytez, None)
+        return f.bytes_read
+
+
+def header_only(path, section_entropy):
+    with CountingReader(path) as f:
+        pe_headers.raw_features(f, section_entropy=section_entropy)
+        return f.bytes_read
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark header-only feature extraction.")
+    parser.add_argument("--pe-mb", type=float, default=2, help="Size of the PE part in MB.")
+    parser.add_argument("--overlay-mb", type=float, default=64, help="Size of the overlay in MB.")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--out", help="Path to write the JSON results to.")
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'installer.exe')
+        with open(path, 'wb') as f:
+            f.write(synthetic.synthetic_pe(int(args.pe_mb * (1 << 20))))
+            overlay = int(args.overlay_mb * (1 << 20))
+            f.write(np.random.default_rng(0).integers(0, 256, overlay, dtype=np.uint8).tobytes())
+
+        for name, run in (('full', lambda: full(path)),
+                          ('header_only', lambda: header_only(path, True)),
+                          ('header_only_no_entropy', lambda: header_only(path, False))):
+            bytes_read = run()
+            times = []
+            for _ in range(args.repeats):
+                start = time.perf_counter()
+                run()
+                times.append(time.perf_counter() - start)
+            results[name] = {'bytes_read': bytes_read, 'secs': statistics.median(times)}
+            print(f'{name:>22}: {bytes_read / (1 << 20):9.2f} MB read, {statistics.median(times) * 1000:9.2f} ms')
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
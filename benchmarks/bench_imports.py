@@ -0,0 +1,80 @@
+"""
+Guards the import time of the project modules using ``python -X importtime``.
+
+Each module is imported in a fresh interpreter. The benchmark fails (non-zero exit code) when a module takes longer
+than its budget to import, or when importing it pulls in one of the heavy libraries that must only be loaded on
+first use (see lazy.py).
+
+Usage:
+    python benchmarks/bench_imports.py [--json]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Cumulative import time budgets in milliseconds. Generous on purpose: importing TensorFlow alone takes seconds.
+IMPORT_BUDGETS_MS = {
+    'gan': 750,
+    'setup': 750,
+    'features': 750,
+    'scorer': 750,
+}
+
+FORBIDDEN_AT_IMPORT = ['tensorflow', 'keras', 'sklearn', 'matplotlib', 'boto3', 'torch', 'lief']
+
+
+def import_profile(module):
+    """
+    Returns the cumulative import time of module in milliseconds and the names of all modules it imported.
+
+    :param module: Name of the module to import.
+    """
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=REPO_DIR,
+                         capture_output=True, text=True, check=True)
+    total_us = None
+    imported = []
+    # Lines look like "import time:       123 |       4567 |   package.name"
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue  # header line
+        imported.append(name.strip())
+        if name.strip() == module:
+            total_us = int(cumulative)
+    return total_us / 1000, imported
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check import times of project modules.")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON.")
+    args = parser.parse_args()
+
+    results = {}
+    failures = []
+    for module, budget in IMPORT_BUDGETS_MS.items():
+        total_ms, imported = import_profile(module)
+        heavy = sorted(set(m for m in FORBIDDEN_AT_IMPORT if any(i == m or i.startswith(m + '.') for i in imported)))
+        results[module] = {'import_ms': total_ms, 'budget_ms': budget, 'heavy_imports': heavy}
+        if total_ms > budget:
+            failures.append(f'{module} took {total_ms:.1f}ms to import (budget {budget}ms)')
+        if heavy:
+            failures.append(f'{module} imports {", ".join(heavy)} at load')
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for module, r in results.items():
+            print(f'{module}: {r["import_ms"]:.1f}ms (budget {r["budget_ms"]}ms)')
+    for failure in failures:
+        print(f'FAIL: {failure}')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Sustained write throughput of lmdb_writer.LMDBWriter against writing every record in its own transaction from the
+producing thread, on synthetic feature vectors.
+
+Usage:
+    python benchmarks/bench_lmdb_writer.py --records 20000 --workers 1 4 --batch-size 1000
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import lmdb_writer  # noqa: E402
+import synthetic  # noqa: E402
+
+
+def records(n, feats):
+    for i in range(n):
+        yield '%064x' % i, feats[i % len(feats)]
+
+
+def serial(path, n, feats):
+    import lmdb
+    env = lmdb.open(path, map_size=1 << 34, subdir=False)
+    for sha256, vector in records(n, feats):
+        with env.begin(write=True) as txn:
+            txn.put(sha256.encode('ascii'), lmdb_writer.encode(vector))
+    env.close()
+
+
+def batched(path, n, feats, workers, batch_size):
+    with lmdb_writer.LMDBWriter(path, workers=workers, batch_size=batch_size) as writer:
+        writer.write(records(n, feats))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark LMDB write throughput.")
+    parser.add_argument("--records", type=int, default=20000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--out", help="Path to write the JSON results to.")
+    args = parser.parse_args()
+
+    feats = synthetic.synthetic_features(1000)
+    runs = [('serial', lambda path: serial(path, args.records, feats))]
+    runs += [(f'writer_{w}', lambda path, w=w: batched(path, args.records, feats, w, args.batch_size))
+             for w in args.workers]
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, run in runs:
+            path = os.path.join(tmp, f'{name}.mdb')
+            start = time.perf_counter()
+            run(path)
+            secs = time.perf_counter() - start
+            size = os.path.getsize(path)
+            results[name] = {'secs': secs, 'records_per_sec': args.records / secs, 'file_mb': size / (1 << 20)}
+            print(f'{name:>10}: {args.records / secs:9.0f} records/s, {size / (1 << 20):8.1f} MB file')
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
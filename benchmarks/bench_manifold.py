@@ -0,0 +1,97 @@
+"""
+Compares fit time and peak memory of the resistant discriminator's LLE embedding: sklearn's LocallyLinearEmbedding
+on 2000 samples, as fitted by SKLearnLLE, against manifold.ManifoldEmbedding on increasingly large samples. Every
+fit runs in a fresh process so its peak resident memory can be measured.
+
+Usage:
+    python benchmarks/bench_manifold.py --npz dataset/train_set.npz --samples 2000 10000 50000
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+feat_size = 2381  # From EMBER feature digest, DO NOT CHANGE!
+
+FIT_SNIPPETS = {
+    'sklearn': "from sklearn.manifold import LocallyLinearEmbedding; "
+               "LocallyLinearEmbedding(n_neighbors=10, n_components={components}).fit(x)",
+    'manifold': "import manifold; manifold.ManifoldEmbedding({components}, 10).fit(x)",
+}
+
+# Loads (or synthesizes) the samples, then times the fit only
+FIT_TEMPLATE = """
+import resource, time, tracemalloc
+import numpy as np
+if {npz!r}:
+    with np.load({npz!r}) as data:
+        x = data["features"][:{n}].astype(np.float32)
+else:
+    rng = np.random.default_rng(0)
+    # Samples near a 32-dimensional manifold, so the neighborhood graph has some structure
+    x = np.tanh(rng.standard_normal(({n}, 32)) @ rng.standard_normal((32, {dim}))).astype(np.float32)
+    x += 0.01 * rng.standard_normal(x.shape).astype(np.float32)
+tracemalloc.start()
+start = time.perf_counter()
+{fit}
+elapsed = time.perf_counter() - start
+print(elapsed, tracemalloc.get_traced_memory()[1], resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def fit_cost(kind, n, components, npz=None, timeout=None):
+    """
+    Returns (fit seconds, peak MB allocated during the fit, peak resident MB of the process) of fitting an embedding
+    in a fresh process, or None if it exceeded the timeout. Allocations are traced with tracemalloc, which covers
+    NumPy arrays but not LAPACK's internal workspace.
+
+    :param kind: Either 'sklearn' or 'manifold'.
+    :param n: Number of samples to fit on.
+    :param components: Embedding dimension.
+    :param npz: Optional numpy feature set to take samples from, random samples otherwise.
+    :param timeout: Seconds after which the fit is abandoned.
+    """
+    code = FIT_TEMPLATE.format(npz=npz or '', n=n, dim=feat_size,
+                               fit=FIT_SNIPPETS[kind].format(components=components))
+    try:
+        out = subprocess.run([sys.executable, "-c", code], cwd=REPO_DIR, capture_output=True, text=True, check=True,
+                             timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return None
+    elapsed, traced, max_rss = out.stdout.strip().splitlines()[-1].split()
+    # ru_maxrss is in kilobytes on Linux
+    return float(elapsed), int(traced) / 2 ** 20, int(max_rss) / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark LLE embedding fits.")
+    parser.add_argument("--npz", help="Numpy feature set to fit on, random samples when omitted.")
+    parser.add_argument("--samples", type=int, nargs="+", default=[2000, 10000, 50000])
+    parser.add_argument("--components", type=int, default=512)
+    parser.add_argument("--timeout", type=float, default=3600, help="Seconds after which a fit is abandoned.")
+    parser.add_argument("--out", help="Path to write the JSON results to.")
+    args = parser.parse_args()
+
+    # The baseline is the current SKLearnLLE fit on 2000 samples
+    runs = [('sklearn', 2000)] + [('manifold', n) for n in args.samples]
+    results = []
+    for kind, n in runs:
+        cost = fit_cost(kind, n, args.components, args.npz, args.timeout)
+        if cost is None:
+            print(f'{kind:>8} n={n:<7} timed out after {args.timeout:.0f}s')
+            results.append({'kind': kind, 'samples': n, 'fit_secs': None, 'fit_peak_mb': None, 'max_rss_mb': None})
+            continue
+        print(f'{kind:>8} n={n:<7} fit {cost[0]:8.2f}s  fit peak {cost[1]:8.1f} MB  process max RSS {cost[2]:8.1f} MB')
+        results.append({'kind': kind, 'samples': n, 'fit_secs': cost[0], 'fit_peak_mb': cost[1], 'max_rss_mb': cost[2]})
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+"""
+End-to-end benchmark suite: times every stage of the pipeline on synthetic inputs (see synthetic.py), so it runs
+offline and in CI.
+
+Stages and the sizes they are timed at:
+    byteentropy  features.ByteEntropyHistogram on one PE file of the given size in bytes
+    extract      features.PEFeatureExtractor.feature_vector on one PE file of the given size in bytes
+    lmdb_read    reading the given number of random feature vectors through setup.get_reader
+    npz_build    setup.save_npz of the given number of samples from meta.db and data.mdb
+    ingest       setup.ingest of all of meta.db by first-seen time into a new feature store, in chunks of the given
+                 number of rows. Checks that every row was appended once and that ingesting again appends nothing.
+    train_step   gan.discriminator_train_step on a batch of the given size
+    gan_step     gan.gan_train_step (generator against a black box) on a batch of the given size
+    inference    scoring a batch of the given size with the simple discriminator
+
+Results are written as JSON. Given a baseline written by an earlier run, the suite exits with status 1 when a stage
+got slower than its regression threshold.
+
+Usage:
+    python benchmarks/bench_pipeline.py --out bench.json
+    python benchmarks/bench_pipeline.py --quick --baseline bench.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import synthetic  # noqa: E402
+
+STAGES = ('byteentropy', 'extract', 'lmdb_read', 'npz_build', 'ingest', 'train_step', 'gan_step', 'inference')
+
+SIZES = {
+    'byteentropy': [64 << 10, 1 << 20, 4 << 20],
+    'extract': [64 << 10, 1 << 20, 4 << 20],
+    'lmdb_read': [100, 1000],
+    'npz_build': [1000, 5000],
+    'ingest': [100, 1000],
+    'train_step': [128, 512],
+    'gan_step': [128, 512],
+    'inference': [1, 128, 1024],
+}
+
+QUICK_SIZES = {
+    'byteentropy': [64 << 10, 1 << 20],
+    'extract': [64 << 10, 1 << 20],
+    'lmdb_read': [100],
+    'npz_build': [500],
+    'ingest': [100],
+    'train_step': [128],
+    'gan_step': [128],
+    'inference': [1, 128],
+}
+
+# Allowed slowdown against the baseline before a stage counts as a regression, as a fraction of the baseline time.
+# Stages dominated by TensorFlow's thread pools are noisier.
+DEFAULT_THRESHOLD = 0.25
+REGRESSION_THRESHOLDS = {'train_step': 0.5, 'gan_step': 0.5, 'inference': 0.5}
+
+
+def median_time(fn, repeats, warmup=1):
+    """ Returns the median wall time of fn over repeats calls, after warmup untimed calls. """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+class Pipeline(object):
+    """ Builds the inputs of every stage once, and returns the callable timed for a stage and size. """
+
+    def __init__(self, workdir, samples):
+        self.workdir = workdir
+        self.samples = samples
+        self._dataset = None
+        self._models = {}
+
+    def dataset(self):
+        if self._dataset is None:
+            # Some rows without a first-seen time, more than an ingest chunk, as SOREL's meta.db may have
+            self._dataset = synthetic.write_sorel_dataset(os.path.join(self.workdir, 'sorel'), self.samples,
+                                                          missing_first_seen=0.05)
+        return self._dataset
+
+    def byteentropy(self, size):
+        import features
+        bytez = synthetic.synthetic_pe(size)
+        histogram = features.ByteEntropyHistogram()
+        return lambda: histogram.raw_features(bytez, None)
+
+    def extract(self, size):
+        import features
+        bytez = synthetic.synthetic_pe(size)
+        extractor = features.PEFeatureExtractor(print_feature_warning=False)
+        return lambda: extractor.feature_vector(bytez)
+
+    def lmdb_read(self, size):
+        import setup
+        meta_path, lmdb_path = self.dataset()
+        reader = setup.get_reader(lmdb_path)
+        con = sqlite3.connect(meta_path)
+        shas = [row[0] for row in con.execute('SELECT sha256 FROM meta')]
+        con.close()
+        rng = np.random.default_rng(0)
+        keys = [shas[i] for i in rng.integers(0, len(shas), size)]
+        return lambda: [reader(key) for key in keys]
+
+    def npz_build(self, size):
+        import setup
+        if size > self.samples:
+            raise ValueError(f'npz_build of {size} samples needs --samples >= {size}')
+        self._use_dataset(setup)
+        out_path = os.path.join(self.workdir, 'bench.npz')
+
+        def build():
+            # Silences the progress bar
+            with contextlib.redirect_stdout(io.StringIO()):
+                setup.save_npz(out_path, size, 0)
+        return build
+
+    def ingest(self, size):
+        import setup
+        self._use_dataset(setup)
+        runs = []
+
+        def ingest():
+            path = os.path.join(self.workdir, f'store-{size}-{len(runs)}')
+            runs.append(path)
+            with contextlib.redirect_stdout(io.StringIO()):
+                added = setup.ingest(path, 'rl_fs_t', chunk_size=size)
+                again = setup.ingest(path)
+            if added != self.samples or again:
+                raise RuntimeError(f'Ingested {added} of {self.samples} rows, then {again} more without new rows')
+        return ingest
+
+    def _use_dataset(self, setup):
+        setup.meta_db_path, setup.features_lmdb_path = self.dataset()
+        setup.get_reader.cache_clear()
+
+    def _model(self, name):
+        import gan
+        if name not in self._models:
+            model = gan.make_generator_model() if name == 'generator' else gan.make_simple_discriminator_model()
+            model.build([None, gan.feat_size + gan.noise_dim if name == 'generator' else gan.feat_size])
+            self._models[name] = model
+        return self._models[name]
+
+    def _batch(self, size):
+        import tensorflow as tf
+        feats = np.log1p(synthetic.synthetic_features(size))
+        labels = (np.arange(size) % 2).astype(np.float64)
+        return tf.constant(feats), tf.constant(labels)
+
+    def train_step(self, size):
+        import gan
+        batch = self._batch(size)
+        return lambda: float(gan.discriminator_train_step(batch, self._model('discriminator')))
+
+    def gan_step(self, size):
+        import gan
+        batch = self._batch(size)
+        return lambda: float(gan.gan_train_step(batch, self._model('discriminator'), self._model('generator'),
+                                                self._model('black_box')))
+
+    def inference(self, size):
+        features = self._batch(size)[0]
+        model = self._model('discriminator')
+        return lambda: model(features, training=False).numpy()
+
+
+def compare(results, baseline):
+    """
+    Returns the results that got slower than their regression threshold against the baseline results.
+
+    :param results: Results of this run.
+    :param baseline: Results of an earlier run.
+    """
+    base = {(r['stage'], r['size']): r['secs'] for r in baseline if r.get('secs') is not None}
+    regressions = []
+    for result in results:
+        key = (result['stage'], result['size'])
+        if result.get('secs') is None or key not in base:
+            continue
+        threshold = REGRESSION_THRESHOLDS.get(result['stage'], DEFAULT_THRESHOLD)
+        ratio = result['secs'] / base[key]
+        if ratio > 1 + threshold:
+            regressions.append(dict(result, baseline_secs=base[key], ratio=ratio, threshold=threshold))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic inputs.")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES))
+    parser.add_argument("--quick", action="store_true", help="Fewer and smaller sizes.")
+    parser.add_argument("--samples", type=int, default=5000, help="Samples in the synthetic meta.db/LMDB.")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--baseline", help="Results of an earlier run to check for regressions.")
+    parser.add_argument("--out", help="Path to write the JSON results to.")
+    args = parser.parse_args()
+
+    sizes = QUICK_SIZES if args.quick else SIZES
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        pipeline = Pipeline(workdir, args.samples)
+        for stage in args.stages:
+            for size in sizes[stage]:
+                # Data loading stages are slow per call, time them once
+                repeats = 1 if stage in ('npz_build', 'ingest') else args.repeats
+                try:
+                    secs = median_time(getattr(pipeline, stage)(size), repeats, warmup=0 if repeats == 1 else 1)
+                except Exception as e:
+                    print(f'{stage:>12} {size:>9}  failed: {e!r}')
+                    results.append({'stage': stage, 'size': size, 'secs': None, 'error': repr(e)})
+                    continue
+                print(f'{stage:>12} {size:>9}  {secs * 1000:10.2f} ms')
+                results.append({'stage': stage, 'size': size, 'secs': secs})
+
+    report = {'python': platform.python_version(), 'numpy': np.__version__, 'results': results}
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)['results'])
+        for r in regressions:
+            print(f'REGRESSION {r["stage"]} {r["size"]}: {r["secs"] * 1000:.2f} ms vs {r["baseline_secs"] * 1000:.2f} ms '
+                  f'({r["ratio"]:.2f}x, threshold {1 + r["threshold"]:.2f}x)')
+        if regressions:
+            sys.exit(1)
+        print('No regressions')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Compares shuffle-buffer batches against sampling.StratifiedBatchSampler for GAN training: spread of the malware count
+per batch, number of distinct malware batch shapes gan.edit_features is traced for, and generator step time.
+
+Usage:
+    python benchmarks/bench_sampling.py                       # synthetic features, written in class order
+    python benchmarks/bench_sampling.py --npz dataset/train_set.npz
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import gan  # noqa: E402
+
+
+def run(dataset, steps):
+    """ Returns (malware counts per batch, seconds per generator step) of training on the first steps batches. """
+    discriminator = gan.make_simple_discriminator_model()
+    black_box = gan.make_simple_discriminator_model()
+    generator = gan.make_generator_model()
+    counts = []
+    start = None
+    for i, batch in enumerate(dataset.repeat().take(steps + 1)):
+        if i == 1:
+            start = time.perf_counter()  # The first step builds the models
+        counts.append(int(np.sum(batch[1].numpy())))
+        loss = gan.gan_train_step(batch, discriminator, generator, black_box)
+    float(loss)
+    return counts, (time.perf_counter() - start) / steps
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark stratified batch sampling.")
+    parser.add_argument("--npz", help="Numpy feature set written by setup.save_npz, synthetic when omitted.")
+    parser.add_argument("--samples", type=int, default=20000, help="Number of synthetic samples.")
+    parser.add_argument("--batch-size", type=int, default=gan.BATCH_SIZE)
+    parser.add_argument("--steps", type=int, default=200)
+    parser.add_argument("--out", help="Path to write the JSON results to.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.npz
+        if path is None:
+            rng = np.random.default_rng(0)
+            path = os.path.join(tmp, 'features.npz')
+            # Runs of malware and benign samples, like files pulled from meta.db in order
+            labels = np.repeat(rng.integers(0, 2, args.samples // 500), 500).astype(float)
+            np.savez(path, labels=labels, features=np.abs(rng.standard_normal((len(labels), gan.feat_size))))
+
+        results = {}
+        for stratified in (False, True):
+            gan.reset_optimizers()
+            dataset, _ = gan.prepare_datasets(path, path, args.batch_size, stratified=stratified)
+            counts, step_secs = run(dataset, args.steps)
+            name = 'stratified' if stratified else 'shuffled'
+            results[name] = {'malware_min': min(counts), 'malware_max': max(counts),
+                             'malware_std': float(np.std(counts)), 'batch_shapes': len(set(counts)),
+                             'step_secs': step_secs}
+            print(f'{name:>10}: malware per batch {min(counts)}-{max(counts)} (std {np.std(counts):.1f}), '
+                  f'{len(set(counts))} distinct shapes, {step_secs:.4f}s per generator step')
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
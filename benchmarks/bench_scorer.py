@@ -0,0 +1,92 @@
+"""
+Compares startup time and per-sample latency of the TFLite scorer against loading the Keras model directly.
+
+Usage:
+    python benchmarks/bench_scorer.py ./models/simple_disc.model ./models/simple_disc.tflite
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+feat_size = 2381  # From EMBER feature digest, DO NOT CHANGE!
+
+# Each snippet loads a model and scores one sample, printing the elapsed time. Run in a fresh interpreter so
+# import costs are included.
+STARTUP_SNIPPETS = {
+    'tflite': "import scorer; s = scorer.Scorer({path!r}); s.score(np.zeros((1, {dim}), np.float32))",
+    'keras': "import tensorflow as tf; m = tf.keras.models.load_model({path!r}); "
+             "m(np.zeros((1, {dim}), np.float32), training=False)",
+}
+
+
+def startup_time(kind, path, repeats=3):
+    """
+    Returns the best wall time, in seconds, of a fresh process importing a runtime, loading a model and scoring one
+    sample.
+
+    :param kind: Either 'tflite' or 'keras'.
+    :param path: Model path passed to the runtime.
+    :param repeats: Number of processes to start, the minimum is reported.
+    """
+    snippet = STARTUP_SNIPPETS[kind].format(path=path, dim=feat_size)
+    code = f"import time; t = time.perf_counter(); import numpy as np; {snippet}; print(time.perf_counter() - t)"
+    times = []
+    for _ in range(repeats):
+        out = subprocess.run([sys.executable, "-c", code], cwd=REPO_DIR, capture_output=True, text=True, check=True)
+        times.append(float(out.stdout.strip().splitlines()[-1]))
+    return min(times)
+
+
+def latency(score_fn, features, batch_size):
+    """
+    Returns the mean time per sample, in seconds, of scoring features in batches of batch_size.
+
+    :param score_fn: Callable taking a (n, 2381) float32 array.
+    :param features: Features to score.
+    :param batch_size: Number of samples per call.
+    """
+    score_fn(features[:batch_size])  # warm up
+    start = time.perf_counter()
+    for i in range(0, len(features) - batch_size + 1, batch_size):
+        score_fn(features[i:i + batch_size])
+    n = (len(features) // batch_size) * batch_size
+    return (time.perf_counter() - start) / n
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the TFLite scorer against Keras.")
+    parser.add_argument("keras_model")
+    parser.add_argument("tflite_model")
+    parser.add_argument("--samples", type=int, default=2048)
+    args = parser.parse_args()
+
+    import scorer
+    import tensorflow as tf
+
+    features = np.abs(np.random.default_rng(0).normal(size=(args.samples, feat_size))).astype(np.float32)
+    tflite_scorer = scorer.Scorer(args.tflite_model)
+    keras_model = tf.keras.models.load_model(args.keras_model)
+
+    results = {
+        'startup_s': {'tflite': startup_time('tflite', args.tflite_model),
+                      'keras': startup_time('keras', args.keras_model)},
+        'latency_s_per_sample': {},
+    }
+    for batch_size in (1, 256):
+        results['latency_s_per_sample'][f'batch_{batch_size}'] = {
+            'tflite': latency(tflite_scorer.score, features, batch_size),
+            'keras': latency(lambda x: keras_model(x, training=False).numpy(), features, batch_size),
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Query latency and recall@k of similarity.IVFPQIndex against exact brute force search, on synthetic postprocessed
+feature vectors drawn around a number of "family" centers.
+
+Usage:
+    python benchmarks/bench_similarity.py --vectors 50000 --nlist 256 --nprobe 4 16 64
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import similarity  # noqa: E402
+import synthetic  # noqa: E402
+from feature_stats import signed_log1p  # noqa: E402
+
+
+def family_vectors(n, centers, noise, seed=0):
+    rng = np.random.default_rng(seed)
+    vectors = centers[rng.integers(0, len(centers), n)]
+    return (vectors + rng.normal(0, noise, vectors.shape) * (vectors != 0)).astype(np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the similarity index.")
+    parser.add_argument("--vectors", type=int, default=50000)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--families", type=int, default=2000)
+    parser.add_argument("--noise", type=float, default=0.1, help="Deviation of family members from their center.")
+    parser.add_argument("--nlist", type=int, default=256)
+    parser.add_argument("--m", type=int, default=64)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[4, 16, 64])
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--out", help="Path to write the JSON results to.")
+    args = parser.parse_args()
+
+    centers = signed_log1p(synthetic.synthetic_features(args.families))
+    data = family_vectors(args.vectors, centers, args.noise)
+    queries = family_vectors(args.queries, centers, args.noise, seed=1)
+    ids = ['%064x' % i for i in range(args.vectors)]
+
+    start = time.perf_counter()
+    index = similarity.IVFPQIndex(nlist=args.nlist, m=args.m)
+    index.train(data[:max(20000, args.nlist * 40)])
+    train_secs = time.perf_counter() - start
+    start = time.perf_counter()
+    for i in range(0, args.vectors, 10000):
+        index.add(data[i:i + 10000], ids[i:i + 10000])
+    add_secs = time.perf_counter() - start
+    print(f'train {train_secs:.1f}s, add {args.vectors / add_secs:.0f} vectors/s, '
+          f'{index.m} bytes/vector vs {data.shape[1] * 4} exact')
+
+    def exact_search(q):
+        distances = ((data - q) ** 2).sum(axis=1)
+        return np.argpartition(distances, args.k)[:args.k]
+
+    start = time.perf_counter()
+    truth = [set(ids[i] for i in exact_search(q)) for q in queries]
+    exact_ms = (time.perf_counter() - start) / args.queries * 1000
+    print(f'{"brute force":>16}: {exact_ms:8.2f} ms/query')
+    results = {'train_secs': train_secs, 'add_vectors_per_sec': args.vectors / add_secs,
+               'brute_force': {'ms_per_query': exact_ms, 'recall': 1.0}}
+
+    rerank = lambda keys: data[[int(key, 16) for key in keys]]  # noqa: E731
+    for nprobe in args.nprobe:
+        for name, rerank_func in (('', None), ('+rerank', rerank)):
+            index.search(queries[0], args.k, nprobe, rerank=rerank_func)  # Merges the added chunks
+            start = time.perf_counter()
+            found = [index.search(q, args.k, nprobe, rerank=rerank_func)[0] for q in queries]
+            ms = (time.perf_counter() - start) / args.queries * 1000
+            recall = np.mean([len(truth[i] & set(f)) / args.k for i, f in enumerate(found)])
+            label = f'nprobe {nprobe}{name}'
+            results[label] = {'ms_per_query': ms, 'recall': float(recall)}
+            print(f'{label:>16}: {ms:8.2f} ms/query, recall@{args.k} {recall:.3f}')
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
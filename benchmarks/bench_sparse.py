@@ -0,0 +1,103 @@
+"""
+Compares the dense and sparse (features.SPARSE_BLOCKS as CSR) dataset formats: file size, in-memory size of the
+training features, and discriminator training step time with dense inputs against layers.BlockSparseDense.
+
+Usage:
+    python benchmarks/bench_sparse.py                       # synthetic features with EMBER-like sparsity
+    python benchmarks/bench_sparse.py --npz dataset/train_set.npz
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import features  # noqa: E402
+import gan  # noqa: E402
+import setup  # noqa: E402
+
+
+def synthetic_features(n, density=0.01, seed=0):
+    """
+    Returns (labels, features) with dense blocks filled in and only a fraction of the hashed block columns nonzero.
+
+    :param n: Number of samples.
+    :param density: Fraction of nonzero columns in features.SPARSE_BLOCKS.
+    :param seed: Random seed.
+    """
+    rng = np.random.default_rng(seed)
+    feats = np.abs(rng.standard_normal((n, gan.feat_size))).astype(np.float32)
+    start, stop = features.sparse_columns()
+    feats[:, start:stop] *= rng.random((n, stop - start)) < density
+    return rng.integers(0, 2, n).astype(float), feats
+
+
+def step_time(dataset, discriminator, steps, repeats=3):
+    """ Returns the mean seconds per discriminator training step over the given number of steps, best of repeats. """
+    batches = iter(dataset.repeat())
+    gan.discriminator_train_step(next(batches), discriminator)  # warm up
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(steps):
+            loss = gan.discriminator_train_step(next(batches), discriminator)
+        float(loss)
+        best = min(best, (time.perf_counter() - start) / steps)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the sparse dataset format.")
+    parser.add_argument("--npz", help="Dense numpy feature set written by setup.save_npz, synthetic when omitted.")
+    parser.add_argument("--samples", type=int, default=20000, help="Number of synthetic samples.")
+    parser.add_argument("--density", type=float, default=0.01, help="Density of the synthetic hashed blocks.")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[gan.BATCH_SIZE, 1024])
+    parser.add_argument("--steps", type=int, default=50)
+    parser.add_argument("--repeats", type=int, default=3, help="Step times are the best of this many runs of --steps.")
+    parser.add_argument("--out", help="Path to write the JSON results to.")
+    args = parser.parse_args()
+
+    if args.npz:
+        labels, feats = setup.load_npz(args.npz)
+    else:
+        labels, feats = synthetic_features(args.samples, args.density)
+
+    results = {'samples': len(labels)}
+    with tempfile.TemporaryDirectory() as tmp:
+        dense_path = os.path.join(tmp, 'dense.npz')
+        sparse_path = os.path.join(tmp, 'sparse.npz')
+        # Until now features were stored as float64
+        np.savez(dense_path, labels=labels, features=feats.astype(np.float64))
+        np.savez(sparse_path, labels=labels, **setup.sparse_npz_arrays(feats))
+        results['file_mb'] = {'dense_float64': os.path.getsize(dense_path) / 2 ** 20,
+                              'sparse': os.path.getsize(sparse_path) / 2 ** 20}
+
+        _, (dense, csr) = setup.load_npz(sparse_path, sparse=True)
+        results['memory_mb'] = {'dense_float64': feats.size * 8 / 2 ** 20, 'dense_float32': feats.nbytes / 2 ** 20,
+                                'sparse': (dense.nbytes + csr.data.nbytes + csr.indices.nbytes
+                                           + csr.indptr.nbytes) / 2 ** 20}
+
+        results['step_secs'] = {}
+        for batch_size in args.batch_sizes:
+            for sparse in (False, True):
+                gan.reset_optimizers()
+                train_dataset, _ = gan.prepare_datasets(sparse_path, sparse_path, batch_size, sparse=sparse)
+                discriminator = gan.make_simple_discriminator_model(sparse_input=sparse)
+                name = f'{"sparse" if sparse else "dense"}_{batch_size}'
+                results['step_secs'][name] = step_time(train_dataset, discriminator, args.steps, args.repeats)
+
+    for key in ('file_mb', 'memory_mb', 'step_secs'):
+        print(f'{key}: ' + ', '.join(f'{name} {value:.4g}' for name, value in results[key].items()))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""
+Synthetic inputs so benchmarks run offline: minimal but well-formed PE files, and a meta.db + features LMDB pair in
+the SOREL-20M layout read by setup.py and dataset.LMDBReader (msgpack-encoded, zlib-compressed feature vectors keyed
+by sha256).
+"""
+import hashlib
+import os
+import sqlite3
+import struct
+import zlib
+
+import numpy as np
+
+from setup import META_COLUMNS
+
+feat_size = 2381  # From EMBER feature digest, DO NOT CHANGE!
+
+FILE_ALIGNMENT = 0x200
+SECTION_ALIGNMENT = 0x1000
+IMAGE_BASE = 0x400000
+
+
+def _align(value, alignment):
+    return (value + alignment - 1) // alignment * alignment
+
+
+def _import_section(rva, imports):
+    # Import descriptors, then per DLL the lookup table, hint/name entries and the DLL name
+    descriptors_size = 20 * (len(imports) + 1)
+    body = bytearray()
+    descriptors = bytearray()
+    for dll, functions in imports.items():
+        lookup_rva = rva + descriptors_size + len(body)
+        body += b'\0' * 4 * (len(functions) + 1)
+        entries = []
+        for function in functions:
+            entries.append(rva + descriptors_size + len(body))
+            body += struct.pack('<H', 0) + function.encode('ascii') + b'\0'
+            body += b'\0' * (len(body) % 2)
+        start = lookup_rva - rva - descriptors_size
+        body[start:start + 4 * len(entries)] = struct.pack(f'<{len(entries)}I', *entries)
+        name_rva = rva + descriptors_size + len(body)
+        body += dll.encode('ascii') + b'\0'
+        # The lookup table doubles as the import address table
+        descriptors += struct.pack('<5I', lookup_rva, 0, 0, name_rva, lookup_rva)
+    descriptors += b'\0' * 20
+    return bytes(descriptors + body), descriptors_size
+
+
+def synthetic_pe(size, seed=0, imports=None):
+    """
+    Returns the bytes of a PE32 executable of roughly the given size, with a .text section of random code-like bytes,
+    a .data section mixing random bytes, zeros and printable strings, and an import table.
+
+    :param size: Approximate file size in bytes.
+    :param seed: Random seed of the section contents.
+    :param imports: Dict of DLL name to imported function names.
+    """
+    rng = np.random.default_rng(seed)
+    imports = imports or {'KERNEL32.dll': ['CreateFileA', 'ReadFile', 'WriteFile', 'CloseHandle', 'VirtualAlloc'],
+                          'USER32.dll': ['MessageBoxA']}
+    payload = max(size - 3 * FILE_ALIGNMENT, 2 * FILE_ALIGNMENT)
+    text = rng.integers(0, 256, payload // 2, dtype=np.uint8).tobytes()
+    strings = b''.join(b'http://example.com/%d\0C:\\Windows\\file%d.dll\0' % (i, i) for i in range(payload // 2048))
+    data = (strings + bytes(payload // 4) + rng.integers(0, 256, payload // 4, dtype=np.uint8).tobytes())[:payload // 2]
+
+    headers_size = FILE_ALIGNMENT
+    sections = []
+    rva = SECTION_ALIGNMENT
+    offset = headers_size
+    idata_rva = rva + _align(len(text), SECTION_ALIGNMENT) + _align(len(data), SECTION_ALIGNMENT)
+    idata, descriptors_size = _import_section(idata_rva, imports)
+    for name, content, characteristics in ((b'.text', text, 0x60000020), (b'.data', data, 0xC0000040),
+                                           (b'.idata', idata, 0xC0000040)):
+        raw_size = _align(len(content), FILE_ALIGNMENT)
+        sections.append((name, content, rva, offset, raw_size, characteristics))
+        rva += _align(len(content), SECTION_ALIGNMENT)
+        offset += raw_size
+
+    data_directories = [(0, 0)] * 16
+    data_directories[1] = (idata_rva, descriptors_size)
+    optional_header = struct.pack(
+        '<HBBIIIIIIIIIHHHHHHIIIIHHIIIIII', 0x10B, 14, 0, sections[0][4], sections[1][4] + sections[2][4], 0,
+        SECTION_ALIGNMENT, SECTION_ALIGNMENT, sections[1][2], IMAGE_BASE, SECTION_ALIGNMENT, FILE_ALIGNMENT, 6, 0, 0,
+        0, 6, 0, 0, rva, headers_size, 0, 2, 0x8140, 0x100000, 0x1000, 0x100000, 0x1000, 0, 16)
+    optional_header += b''.join(struct.pack('<II', *d) for d in data_directories)
+    coff_header = struct.pack('<HHIIIHH', 0x14C, len(sections), 0x5F000000, 0, 0, len(optional_header), 0x0102)
+    section_headers = b''.join(struct.pack('<8sIIIIIIHHI', name, len(content), section_rva, raw_size, raw_offset,
+                                           0, 0, 0, 0, characteristics)
+                               for name, content, section_rva, raw_offset, raw_size, characteristics in sections)
+
+    dos_header = b'MZ' + b'\0' * 58 + struct.pack('<I', 0x80)
+    headers = dos_header.ljust(0x80, b'\0') + b'PE\0\0' + coff_header + optional_header + section_headers
+    out = bytearray(headers.ljust(headers_size, b'\0'))
+    for _, content, _, _, raw_size, _ in sections:
+        out += content.ljust(raw_size, b'\0')
+    return bytes(out)
+
+
+def synthetic_features(n, seed=0):
+    """ Returns raw (before dataset.features_postproc_func) feature vectors shaped like EMBER's, as float32. """
+    rng = np.random.default_rng(seed)
+    feats = rng.exponential(1.0, (n, feat_size)).astype(np.float32)
+    # The hashed section/imports/exports blocks are mostly zero
+    feats[:, 688:2351] *= rng.random((n, 2351 - 688)) < 0.02
+    return feats
+
+
+def write_sorel_dataset(directory, n, seed=0, malware_ratio=0.5, missing_first_seen=0.0):
+    """
+    Writes meta.db and data.mdb with n samples to directory and returns their paths. Every sample has features, and
+    the rows are ordered by first-seen time (rl_fs_t).
+
+    :param directory: Directory to write to.
+    :param n: Number of samples.
+    :param seed: Random seed.
+    :param malware_ratio: Fraction of malware samples.
+    :param missing_first_seen: Fraction of rows, at random, whose rl_fs_t is NULL.
+    """
+    import lmdb
+    import msgpack
+
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    meta_path = os.path.join(directory, 'meta.db')
+    lmdb_path = os.path.join(directory, 'data.mdb')
+    for path in (meta_path, lmdb_path, lmdb_path + '-lock'):
+        if os.path.exists(path):
+            os.remove(path)
+
+    feats = synthetic_features(n, seed)
+    shas = [hashlib.sha256(b'%d-%d' % (seed, i)).hexdigest() for i in range(n)]
+    is_malware = (rng.random(n) < malware_ratio).astype(int)
+    first_seen = [None if missing else 1500000000 + i for i, missing in enumerate(rng.random(n) < missing_first_seen)]
+
+    con = sqlite3.connect(meta_path)
+    columns = ', '.join(f'{c} text' if c == 'sha256' else f'{c} int' for c in META_COLUMNS)
+    con.execute(f'CREATE TABLE meta ({columns})')
+    tags = rng.integers(0, 2, (n, len(META_COLUMNS) - 4)) * is_malware[:, None]
+    con.executemany(f'INSERT INTO meta VALUES ({", ".join("?" * len(META_COLUMNS))})',
+                    [[shas[i], int(is_malware[i]), first_seen[i], int(is_malware[i]) * 30] + tags[i].tolist()
+                     for i in range(n)])
+    con.commit()
+    con.close()
+
+    env = lmdb.open(lmdb_path, map_size=max(1 << 30, n * feat_size * 8), subdir=False)
+    with env.begin(write=True) as txn:
+        for sha, vector in zip(shas, feats):
+            txn.put(sha.encode('ascii'), zlib.compress(msgpack.dumps([vector.tolist()])))
+    env.close()
+    return meta_path, lmdb_path
@@ -0,0 +1,155 @@
+"""
+Checkpointing for gan.train built on tf.train.CheckpointManager.
+
+Checkpoints are written asynchronously (variables are copied to host memory and written on a background thread)
+every N steps and/or T seconds, the most recent ones are kept up to a retention limit, and separately the best N
+checkpoints according to a validation metric are tracked in ``<directory>/best``.
+
+Async checkpointing does not capture tf.data iterator state, so the input pipeline position is written
+synchronously to a small sidecar checkpoint (``ckpt-<step>_input``) next to each regular one.
+"""
+import glob
+import json
+import os
+import time
+
+from lazy import lazy_import
+
+tf = lazy_import('tensorflow')
+
+
+INPUT_SUFFIX = '_input'
+
+
+def _async_options():
+    # The option was renamed from experimental_enable_async_checkpoint to enable_async in TensorFlow 2.15
+    for name in ('enable_async', 'experimental_enable_async_checkpoint'):
+        try:
+            return tf.train.CheckpointOptions(**{name: True})
+        except TypeError:
+            pass
+    print("WARNING: async checkpointing needs TensorFlow 2.9 or newer, saving synchronously")
+    return tf.train.CheckpointOptions()
+
+
+class CheckpointSaver(object):
+    """ Periodic, retained and best-model checkpointing of a tf.train.Checkpoint. """
+
+    def __init__(self, checkpoint, directory, step, every_n_steps=None, every_n_secs=None, max_to_keep=3,
+                 keep_best=0, mode='min', async_save=True, input_checkpoint=None):
+        """
+        :param checkpoint: tf.train.Checkpoint holding everything to save.
+        :param directory: Directory to write checkpoints to.
+        :param step: Scalar int64 tf.Variable with the global step, used to number checkpoints.
+        :param every_n_steps: Save every N steps, None to disable.
+        :param every_n_secs: Save every T seconds, None to disable.
+        :param max_to_keep: Number of most recent checkpoints to retain.
+        :param keep_best: Number of best checkpoints (by record_metric) to retain, 0 to disable.
+        :param mode: 'min' if lower metric values are better, 'max' otherwise.
+        :param async_save: Write checkpoints in the background instead of blocking training.
+        :param input_checkpoint: Optional tf.train.Checkpoint tracking the input pipeline iterator, saved synchronously
+                                 alongside every checkpoint.
+        """
+        self.checkpoint = checkpoint
+        self.input_checkpoint = input_checkpoint
+        self.directory = directory
+        self.step = step
+        self.every_n_steps = every_n_steps
+        self.every_n_secs = every_n_secs
+        self.keep_best = keep_best
+        self.mode = mode
+        self.options = _async_options() if async_save else tf.train.CheckpointOptions()
+        self.manager = tf.train.CheckpointManager(checkpoint, directory, max_to_keep=max_to_keep, step_counter=step)
+
+        self._best_dir = os.path.join(directory, 'best')
+        self._best_index = os.path.join(self._best_dir, 'best.json')
+        self.best = []  # [{'step': ..., 'metric': ..., 'path': ...}], best first
+        if os.path.exists(self._best_index):
+            with open(self._best_index) as f:
+                self.best = json.load(f)
+        self._last_save_step = None
+        self._last_save_time = time.time()
+
+    def restore_latest(self):
+        """ Restores the most recent checkpoint, if any, and returns its path (or None). """
+        latest = self.manager.latest_checkpoint
+        if latest is not None:
+            self.checkpoint.restore(latest)
+            if self.input_checkpoint is not None and os.path.exists(latest + INPUT_SUFFIX + '.index'):
+                self.input_checkpoint.restore(latest + INPUT_SUFFIX)
+            self._last_save_step = int(self.step.numpy())
+        return latest
+
+    def save(self):
+        """ Saves a checkpoint numbered by the current step and returns its path. """
+        step = int(self.step.numpy())
+        if step == self._last_save_step:
+            return self.manager.latest_checkpoint
+        path = self.manager.save(checkpoint_number=step, options=self.options)
+        if self.input_checkpoint is not None:
+            self.input_checkpoint.write(path + INPUT_SUFFIX)
+            self._remove_stale_inputs(path)
+        self._last_save_step = step
+        self._last_save_time = time.time()
+        return path
+
+    def _remove_stale_inputs(self, latest):
+        # The manager only deletes the checkpoints it wrote itself, clean up sidecars of retired ones. With async
+        # saving the manager only lists the latest checkpoint once it has been written, so it is added explicitly.
+        retained = set(self.manager.checkpoints) | {latest}
+        for index in glob.glob(os.path.join(self.directory, 'ckpt-*' + INPUT_SUFFIX + '.index')):
+            prefix = index[:-len('.index')]
+            if prefix[:-len(INPUT_SUFFIX)] not in retained:
+                for f in glob.glob(prefix + '.*'):
+                    os.remove(f)
+
+    def maybe_save(self):
+        """ Saves a checkpoint if the step or time interval has elapsed since the last one. Returns the path or None. """
+        step = int(self.step.numpy())
+        last_step = self._last_save_step or 0
+        due = (self.every_n_steps is not None and step - last_step >= self.every_n_steps) or \
+              (self.every_n_secs is not None and time.time() - self._last_save_time >= self.every_n_secs)
+        return self.save() if due else None
+
+    def _is_better(self, metric, other):
+        return metric < other if self.mode == 'min' else metric > other
+
+    def record_metric(self, metric):
+        """
+        Records a validation metric for the current state, keeping a copy of it if it ranks among the best keep_best
+        checkpoints seen so far. Returns True if it was kept.
+
+        :param metric: Validation metric of the current model state.
+        """
+        if not self.keep_best:
+            return False
+        metric = float(metric)
+        if len(self.best) >= self.keep_best and not self._is_better(metric, self.best[-1]['metric']):
+            return False
+
+        os.makedirs(self._best_dir, exist_ok=True)
+        step = int(self.step.numpy())
+        path = self.checkpoint.write(os.path.join(self._best_dir, f'ckpt-{step}'), options=self.options)
+        self.best.append({'step': step, 'metric': metric, 'path': path})
+        self.best.sort(key=lambda b: b['metric'], reverse=self.mode == 'max')
+        for evicted in self.best[self.keep_best:]:
+            for f in glob.glob(evicted['path'] + '.*'):
+                os.remove(f)
+        self.best = self.best[:self.keep_best]
+
+        tmp_path = self._best_index + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.best, f, indent=2)
+        os.replace(tmp_path, self._best_index)
+        return True
+
+    def best_checkpoint(self):
+        """ Returns the path of the best checkpoint recorded so far, or None. """
+        return self.best[0]['path'] if self.best else None
+
+    def sync(self):
+        """ Blocks until outstanding asynchronous saves have been written. """
+        if hasattr(self.checkpoint, 'sync'):
+            self.checkpoint.sync()
+        if self.input_checkpoint is not None and self.manager.latest_checkpoint is not None:
+            self._remove_stale_inputs(self.manager.latest_checkpoint)
@@ -0,0 +1,262 @@
+"""
+Continual fine-tuning of a trained discriminator from a stream of newly featurized samples.
+
+New samples arrive as numpy files (written by setup.save_npz, or feature_store.load compatible) dropped into a watched
+directory, or through a local queue standing in for a message broker. Every batch of new samples is mixed with
+samples replayed from a fixed-size reservoir of historical and previously streamed samples, so the model adapts to new
+samples without forgetting old ones, and memory stays bounded however long the stream runs. After a configurable
+number of updates the fine-tuned weights are published to a HotSwapScorer, which keeps serving requests meanwhile.
+
+Usage:
+    python continual.py models/simple_disc.model --watch dataset/incoming --history dataset/train_set.npz \
+        --save models/simple_disc_continual.model
+"""
+import argparse
+import glob
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+from lazy import lazy_import
+
+tf = lazy_import('tensorflow')
+keras = lazy_import('keras')
+
+feat_size = 2381  # From EMBER feature digest, DO NOT CHANGE!
+
+
+class ReplayBuffer(object):
+    """
+    Fixed-size uniform sample of every sample added so far, kept with reservoir sampling in preallocated arrays.
+    """
+
+    def __init__(self, capacity, feature_dim=feat_size, seed=None):
+        """
+        :param capacity: Maximum number of samples held.
+        :param feature_dim: Feature dimension of the samples.
+        :param seed: Random seed of the reservoir and of sampling.
+        """
+        self.capacity = capacity
+        self.features = np.empty((capacity, feature_dim), dtype=np.float32)
+        self.labels = np.empty(capacity, dtype=np.float32)
+        self.seen = 0
+        self._rng = np.random.default_rng(seed)
+
+    def __len__(self):
+        return min(self.seen, self.capacity)
+
+    def add(self, features, labels):
+        """ Offers samples to the reservoir, every sample seen so far is held with equal probability. """
+        features = np.asarray(features, dtype=np.float32)
+        labels = np.asarray(labels, dtype=np.float32).reshape(-1)
+        # Fill the free slots first
+        free = min(self.capacity - len(self), len(labels))
+        self.features[len(self):len(self) + free] = features[:free]
+        self.labels[len(self):len(self) + free] = labels[:free]
+        self.seen += free
+        # Then sample i of the stream replaces a random slot with probability capacity / (i + 1)
+        positions = self.seen + np.arange(len(labels) - free)
+        slots = (self._rng.random(len(positions)) * (positions + 1)).astype(np.int64)
+        keep = slots < self.capacity
+        self.features[slots[keep]] = features[free:][keep]
+        self.labels[slots[keep]] = labels[free:][keep]
+        self.seen += len(positions)
+
+    def sample(self, n):
+        """ Returns (features, labels) of n samples drawn with replacement. """
+        if not len(self):
+            return self.features[:0], self.labels[:0]
+        indices = self._rng.integers(0, len(self), n)
+        return self.features[indices], self.labels[indices]
+
+
+class HotSwapScorer(object):
+    """
+    Thread-safe scorer whose weights can be replaced while it is serving. Updates are applied to a fresh copy of the
+    model, which then replaces the serving one, so a request never sees a half-updated model.
+    """
+
+    def __init__(self, model, input_dim=feat_size):
+        """
+        :param model: Keras discriminator to serve, it is copied.
+        :param input_dim: Input dimension of the model.
+        """
+        self.input_dim = input_dim
+        self.version = 0
+        self._lock = threading.Lock()
+        self._model = self._copy(model.get_weights(), model)
+
+    def _copy(self, weights, model):
+        serving = keras.models.clone_model(model)
+        serving.build([None, self.input_dim])
+        serving.set_weights(weights)
+        return serving
+
+    def swap(self, model):
+        """ Publishes the current weights of model. """
+        serving = self._copy(model.get_weights(), model)
+        with self._lock:
+            self._model = serving
+            self.version += 1
+
+    def score(self, features):
+        """ Returns the probability of each sample being malware. """
+        with self._lock:
+            serving = self._model
+        features = np.asarray(features, dtype=np.float32).reshape(-1, self.input_dim)
+        return serving(features, training=False).numpy().reshape(-1)
+
+    def __call__(self, features):
+        return self.score(features)
+
+
+def watch_directory(path, pattern='*.npz', poll_secs=5.0, stop=None):
+    """
+    Yields (labels, features) from numpy files as they appear in a directory, oldest first. Processed files are moved
+    to a 'done' subdirectory, so a restarted watcher does not replay them. Writers should create files under another
+    name (e.g. with a .tmp suffix) and rename them when complete.
+
+    :param path: Directory to watch.
+    :param pattern: Glob pattern of the files to pick up.
+    :param poll_secs: Seconds between directory scans when no new file is found.
+    :param stop: Optional threading.Event ending the stream.
+    """
+    import feature_store
+
+    done_dir = os.path.join(path, 'done')
+    os.makedirs(done_dir, exist_ok=True)
+    while stop is None or not stop.is_set():
+        paths = sorted(glob.glob(os.path.join(path, pattern)), key=os.path.getmtime)
+        if not paths:
+            time.sleep(poll_secs)
+            continue
+        for file_path in paths:
+            yield feature_store.load(file_path)
+            os.replace(file_path, os.path.join(done_dir, os.path.basename(file_path)))
+
+
+def drain_queue(samples, timeout=None, stop=None):
+    """
+    Yields (labels, features) put on a queue.Queue, a local stand-in for a message broker. Ends on a None item, when
+    stop is set, or when nothing arrives within timeout seconds.
+
+    :param samples: queue.Queue of (labels, features) tuples.
+    :param timeout: Seconds to wait for an item, forever by default.
+    :param stop: Optional threading.Event ending the stream.
+    """
+    while stop is None or not stop.is_set():
+        try:
+            item = samples.get(timeout=timeout)
+        except queue.Empty:
+            return
+        if item is None:
+            return
+        yield item
+
+
+class ContinualTrainer(object):
+    """ Fine-tunes a discriminator on streamed samples mixed with replayed ones. """
+
+    def __init__(self, model, replay, scorer=None, batch_size=128, replay_fraction=0.5, publish_every=10,
+                 save_path=None):
+        """
+        :param model: Trained Keras discriminator, fine-tuned in place.
+        :param replay: ReplayBuffer of historical samples, streamed samples are added to it after training on them.
+        :param scorer: Optional HotSwapScorer to publish the weights to.
+        :param batch_size: Size of every training batch, new and replayed samples combined.
+        :param replay_fraction: Fraction of every batch drawn from the replay buffer.
+        :param publish_every: Number of training steps between publishing the weights (and saving the model).
+        :param save_path: Optional path the fine-tuned model is saved to when publishing.
+        """
+        self.model = model
+        self.replay = replay
+        self.scorer = scorer
+        self.batch_size = batch_size
+        self.replay_fraction = replay_fraction
+        self.publish_every = publish_every
+        self.save_path = save_path
+        self.steps = 0
+        self.samples = 0
+
+    def update(self, labels, features):
+        """ Trains on a chunk of new samples, in mini-batches. Returns the mean loss. """
+        import gan
+
+        features = np.asarray(features, dtype=np.float32)
+        labels = np.asarray(labels, dtype=np.float32).reshape(-1)
+        # Without history, replay only starts with the second chunk of the stream
+        n_replay = int(round(self.batch_size * self.replay_fraction)) if len(self.replay) else 0
+        n_new = self.batch_size - n_replay
+        losses = []
+        for start in range(0, len(labels), n_new):
+            batch_features, batch_labels = features[start:start + n_new], labels[start:start + n_new]
+            replay_features, replay_labels = self.replay.sample(n_replay)
+            batch = (tf.constant(np.concatenate([batch_features, replay_features])),
+                     tf.constant(np.concatenate([batch_labels, replay_labels])))
+            losses.append(float(gan.discriminator_train_step(batch, self.model)))
+            self.steps += 1
+            if self.steps % self.publish_every == 0:
+                self.publish()
+        self.replay.add(features, labels)
+        self.samples += len(labels)
+        return float(np.mean(losses)) if losses else float('nan')
+
+    def publish(self):
+        """ Swaps the current weights into the scorer and saves the model. """
+        if self.scorer is not None:
+            self.scorer.swap(self.model)
+        if self.save_path:
+            self.model.save(self.save_path)
+
+    def run(self, stream):
+        """
+        Fine-tunes on every (labels, features) chunk of a stream until it ends, then publishes the final weights.
+
+        :param stream: Iterable of (labels, features), e.g. watch_directory or drain_queue.
+        """
+        for labels, features in stream:
+            loss = self.update(labels, features)
+            print(f'Fine-tuned on {len(labels)} new samples ({self.samples} total, {self.steps} steps) - '
+                  f'Loss: {loss}')
+        self.publish()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Continually fine-tune a discriminator on streamed samples.")
+    parser.add_argument("model_path", help="Discriminator saved by gan.save_model.")
+    parser.add_argument("--watch", required=True, help="Directory new numpy feature sets are dropped into.")
+    parser.add_argument("--history", help="Training set (numpy file or feature store) seeding the replay buffer.")
+    parser.add_argument("--replay-size", type=int, default=50000, help="Number of samples kept for replay.")
+    parser.add_argument("--replay-fraction", type=float, default=0.5)
+    parser.add_argument("--batch-size", type=int, default=128)
+    parser.add_argument("--learning-rate", type=float, default=1e-5)
+    parser.add_argument("--publish-every", type=int, default=10, help="Training steps between weight swaps.")
+    parser.add_argument("--save", help="Path to save the fine-tuned model to, defaults to overwriting model_path.")
+    parser.add_argument("--poll-secs", type=float, default=5.0)
+    args = parser.parse_args()
+
+    import gan
+
+    model = gan.load_model(args.model_path)
+    gan.set_learning_rate('discriminator', args.learning_rate)
+    replay = ReplayBuffer(args.replay_size, seed=0)
+    if args.history:
+        import feature_store
+        labels, features = feature_store.load(args.history)
+        replay.add(features, labels)
+        del labels, features
+        print(f'Replay buffer seeded with {len(replay)} of {replay.seen} historical samples')
+    scorer = HotSwapScorer(model)
+    trainer = ContinualTrainer(model, replay, scorer, args.batch_size, args.replay_fraction, args.publish_every,
+                               args.save or args.model_path)
+    try:
+        trainer.run(watch_directory(args.watch, poll_secs=args.poll_secs))
+    except KeyboardInterrupt:
+        trainer.publish()
+
+
+if __name__ == '__main__':
+    main()
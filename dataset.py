@@ -18,10 +18,16 @@ import tqdm
 from logzero import logger
 
 import config
+import feature_codec
+import feature_stats
 import json
 
 
 class LMDBReader(object):
+    """
+    Reads the records of a features LMDB by sha256. Compact records (see feature_codec) are returned as the
+    postprocessed vector they hold, without postproc_func.
+    """
 
     def __init__(self, path, postproc_func=None):
         self.env = lmdb.open(path, readonly=True, map_size=1e13, max_readers=1024, subdir=False)
@@ -31,6 +37,8 @@ class LMDBReader(object):
         with self.env.begin() as txn:
             x = txn.get(key.encode('ascii'))
         if x is None: return None
+        if feature_codec.is_compact(x):
+            return feature_codec.decode(x)
         x = msgpack.loads(zlib.decompress(x), strict_map_key=False)
         if self.postproc_func is not None:
             x = self.postproc_func(x)
@@ -38,12 +46,7 @@ class LMDBReader(object):
 
 
 def features_postproc_func(x):
-    x = np.asarray(x[0], dtype=np.float32)
-    lz = x < 0
-    gz = x > 0
-    x[lz] = - np.log(1 - x[lz])
-    x[gz] = np.log(1 + x[gz])
-    return x
+    return feature_stats.signed_log1p(np.asarray(x[0], dtype=np.float32))
 
 
 def tags_postproc_func(x):
@@ -0,0 +1,281 @@
+"""
+Streaming ROC evaluation of discriminators over full test splits.
+
+Scores are accumulated into fixed-size histograms rather than stored, so memory stays O(bins) no matter how many
+samples are evaluated. From a single pass this computes the ROC curve, AUC, the detection rate (TPR) at target false
+positive rates and a per-tag breakdown using dataset.Dataset.tags.
+
+Usage:
+    python evaluate.py ./models/simple_disc.model --npz dataset/test_set.npz --out report.json
+    python evaluate.py ./models/simple_disc.tflite --metadb meta.db --lmdb data.mdb --out report.json
+"""
+import argparse
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+DEFAULT_TARGET_FPRS = (1e-2, 1e-3, 1e-4)
+
+
+class StreamingROC(object):
+    """
+    Histogram-based ROC accumulator. Bin edges are evenly spaced in logit space, which gives fine threshold
+    resolution close to 0 and 1 where low false positive rate operating points lie.
+    """
+
+    def __init__(self, bins=100000, logit_range=20.0, tags=None):
+        """
+        :param bins: Number of histogram bins per class.
+        :param logit_range: Edges span sigmoid(-logit_range) to sigmoid(logit_range).
+        :param tags: Optional list of tag names to keep separate positive histograms for.
+        """
+        self.bins = bins
+        self.edges = 1 / (1 + np.exp(-np.linspace(-logit_range, logit_range, bins - 1)))
+        # Score s falls into bin b when lower_edges[b] <= s < lower_edges[b + 1]
+        self.lower_edges = np.concatenate([[0.0], self.edges])
+        self.pos = np.zeros(bins, dtype=np.int64)
+        self.neg = np.zeros(bins, dtype=np.int64)
+        self.tags = list(tags) if tags is not None else []
+        self.tag_hist = np.zeros((len(self.tags), bins), dtype=np.int64)
+
+    def update(self, scores, labels, tag_labels=None):
+        """
+        Adds a batch of predictions.
+
+        :param scores: Malware probabilities of shape (n,).
+        :param labels: Ground truth of shape (n,), 1 for malware.
+        :param tag_labels: Optional binarized tags of shape (n, len(tags)).
+        """
+        scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+        labels = np.asarray(labels).reshape(-1) != 0
+        idx = np.searchsorted(self.edges, scores, side='right')
+        self.pos += np.bincount(idx[labels], minlength=self.bins)
+        self.neg += np.bincount(idx[~labels], minlength=self.bins)
+        if tag_labels is not None and self.tags:
+            tag_labels = np.asarray(tag_labels) != 0
+            for t in range(len(self.tags)):
+                self.tag_hist[t] += np.bincount(idx[tag_labels[:, t]], minlength=self.bins)
+
+    def merge(self, other):
+        """ Adds the counts of another accumulator with identical bins, e.g. one filled by another worker. """
+        assert self.bins == other.bins and self.tags == other.tags
+        self.pos += other.pos
+        self.neg += other.neg
+        self.tag_hist += other.tag_hist
+
+    @staticmethod
+    def _at_or_above(hist):
+        # Number of samples scoring at or above each bin's lower edge
+        return np.cumsum(hist[::-1])[::-1]
+
+    def roc(self):
+        """ Returns (fpr, tpr, thresholds) ordered by decreasing threshold. """
+        tp = self._at_or_above(self.pos)[::-1]
+        fp = self._at_or_above(self.neg)[::-1]
+        fpr = fp / max(self.neg.sum(), 1)
+        tpr = tp / max(self.pos.sum(), 1)
+        return fpr, tpr, self.lower_edges[::-1]
+
+    def auc(self):
+        fpr, tpr, _ = self.roc()
+        fpr = np.concatenate([[0.0], fpr])
+        tpr = np.concatenate([[0.0], tpr])
+        return float(np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2))
+
+    def threshold_at_fpr(self, target_fpr):
+        """
+        Returns the lowest threshold whose false positive rate does not exceed target_fpr, along with the
+        achieved (fpr, tpr).
+
+        :param target_fpr: Maximum acceptable false positive rate.
+        """
+        fpr, tpr, thresholds = self.roc()
+        ok = np.nonzero(fpr <= target_fpr)[0]
+        if len(ok) == 0:
+            return 1.0, 0.0, 0.0
+        i = ok[-1]
+        return float(thresholds[i]), float(fpr[i]), float(tpr[i])
+
+    def tag_detection_rate(self, threshold):
+        """ Returns, per tag, the fraction of tagged samples scoring at or above threshold. """
+        b = np.searchsorted(self.edges, threshold, side='right')
+        totals = self.tag_hist.sum(axis=1)
+        detected = self.tag_hist[:, b:].sum(axis=1)
+        return {tag: (float(detected[t] / totals[t]) if totals[t] else None) for t, tag in enumerate(self.tags)}
+
+    def report(self, target_fprs=DEFAULT_TARGET_FPRS, curve_points=200):
+        """
+        Returns a JSON-able summary of the accumulated predictions.
+
+        :param target_fprs: False positive rates to report operating points for.
+        :param curve_points: Number of points of the (downsampled) ROC curve to include.
+        """
+        fpr, tpr, thresholds = self.roc()
+        keep = np.unique(np.linspace(0, len(fpr) - 1, curve_points).astype(int))
+        report = {
+            'samples': int(self.pos.sum() + self.neg.sum()),
+            'positives': int(self.pos.sum()),
+            'negatives': int(self.neg.sum()),
+            'bins': self.bins,
+            'auc': self.auc(),
+            'operating_points': [],
+            'roc_curve': {'fpr': fpr[keep].tolist(), 'tpr': tpr[keep].tolist(),
+                          'thresholds': thresholds[keep].tolist()},
+        }
+        thresholds_used = {}
+        for target in target_fprs:
+            threshold, achieved_fpr, achieved_tpr = self.threshold_at_fpr(target)
+            thresholds_used[str(target)] = threshold
+            report['operating_points'].append({'target_fpr': target, 'threshold': threshold,
+                                               'fpr': achieved_fpr, 'tpr': achieved_tpr})
+        if self.tags:
+            report['tags'] = {
+                'count': dict(zip(self.tags, self.tag_hist.sum(axis=1).astype(int).tolist())),
+                'detection_rate': {target: self.tag_detection_rate(threshold)
+                                   for target, threshold in thresholds_used.items()},
+            }
+        return report
+
+
+class ConfusionCounter(object):
+    """ Exact confusion matrix counts at a single threshold, accumulated alongside the histograms. """
+
+    def __init__(self, threshold=0.5):
+        self.threshold = threshold
+        self.tp = self.fp = self.tn = self.fn = 0
+
+    def update(self, scores, labels):
+        pred = np.asarray(scores).reshape(-1) > self.threshold
+        labels = np.asarray(labels).reshape(-1) != 0
+        self.tp += int(np.sum(pred & labels))
+        self.fp += int(np.sum(pred & ~labels))
+        self.tn += int(np.sum(~pred & ~labels))
+        self.fn += int(np.sum(~pred & labels))
+
+    def report(self):
+        total = self.tp + self.fp + self.tn + self.fn
+        return {
+            'threshold': self.threshold,
+            'tp': self.tp, 'fp': self.fp, 'tn': self.tn, 'fn': self.fn,
+            'accuracy': (self.tp + self.tn) / total if total else 0,
+            'fpr': self.fp / (self.fp + self.tn) if (self.fp + self.tn) else 0,
+            'fnr': self.fn / (self.fn + self.tp) if (self.fn + self.tp) else 0,
+        }
+
+
+def evaluate(predict_fn, batches, bins=100000, tags=None, target_fprs=DEFAULT_TARGET_FPRS):
+    """
+    Streams batches through predict_fn and returns the evaluation report.
+
+    :param predict_fn: Callable mapping a (n, 2381) feature array to (n,) malware probabilities.
+    :param batches: Iterable of (features, labels, tag_labels) tuples, tag_labels may be None.
+    :param bins: Number of histogram bins.
+    :param tags: Tag names matching the columns of tag_labels.
+    :param target_fprs: False positive rates to report operating points for.
+    """
+    roc = StreamingROC(bins=bins, tags=tags)
+    confusion = ConfusionCounter()
+    for features, labels, tag_labels in batches:
+        scores = np.asarray(predict_fn(features)).reshape(-1)
+        roc.update(scores, labels, tag_labels)
+        confusion.update(scores, labels)
+
+    report = roc.report(target_fprs)
+    report['confusion'] = confusion.report()
+    return report
+
+
+def npz_batches(path, batch_size=1024):
+    """
+    Yields (features, labels, None) batches from a numpy file written by setup.save_npz.
+
+    :param path: Path of the numpy file.
+    :param batch_size: Number of samples per batch.
+    """
+    import setup
+
+    labels, features = setup.load_npz(path)
+    for i in range(0, len(labels), batch_size):
+        yield features[i:i + batch_size], np.asarray(labels[i:i + batch_size]), None
+
+
+def sorel_batches(ds, batch_size=1024):
+    """
+    Yields (features, labels, tag_labels) batches from a dataset.Dataset opened with return_tags=True. The next
+    batch is read from LMDB on a background thread while the current one is being scored.
+
+    :param ds: dataset.Dataset instance.
+    :param batch_size: Number of samples per batch.
+    """
+    def read(start):
+        keys = ds.keylist[start:start + batch_size]
+        feats = np.stack([ds.features_lmdb_reader(k) for k in keys]).astype(np.float32)
+        labels = np.asarray(ds.labels[start:start + batch_size])
+        tag_labels = ds.tag_labels[start:start + batch_size]
+        return feats, labels, tag_labels
+
+    starts = range(0, len(ds), batch_size)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        pending = pool.submit(read, starts[0]) if len(starts) else None
+        for i in range(len(starts)):
+            batch = pending.result()
+            pending = pool.submit(read, starts[i + 1]) if i + 1 < len(starts) else None
+            yield batch
+
+
+def load_predict_fn(model_path):
+    """
+    Returns a batch scoring function for a .tflite file (via scorer.Scorer) or a Keras SavedModel directory.
+
+    :param model_path: Path of the model to load.
+    """
+    if model_path.endswith('.tflite'):
+        import scorer
+        return scorer.Scorer(model_path).score
+
+    import gan
+    model = gan.load_model(model_path)
+    return lambda x: model(x, training=False).numpy()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Streaming ROC evaluation of a discriminator.")
+    parser.add_argument("model_path", help="Keras SavedModel directory or .tflite file.")
+    parser.add_argument("--npz", help="Evaluate on a numpy file written by setup.save_npz.")
+    parser.add_argument("--metadb", help="Evaluate on a SOREL split, path of meta.db.")
+    parser.add_argument("--lmdb", help="Path of the features LMDB (with --metadb).")
+    parser.add_argument("--mode", default="test", help="SOREL split to evaluate (with --metadb).")
+    parser.add_argument("--n-samples", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=1024)
+    parser.add_argument("--bins", type=int, default=100000)
+    parser.add_argument("--target-fpr", type=float, nargs="+", default=list(DEFAULT_TARGET_FPRS))
+    parser.add_argument("--out", help="Path to write the JSON report to.")
+    args = parser.parse_args()
+
+    predict_fn = load_predict_fn(args.model_path)
+    if args.metadb:
+        import dataset
+        ds = dataset.Dataset(args.metadb, args.lmdb, return_malicious=True, return_counts=False, return_tags=True,
+                             mode=args.mode, n_samples=args.n_samples)
+        batches = sorel_batches(ds, args.batch_size)
+        tags = dataset.Dataset.tags
+    elif args.npz:
+        batches = npz_batches(args.npz, args.batch_size)
+        tags = None
+    else:
+        parser.error("one of --npz or --metadb is required")
+
+    report = evaluate(predict_fn, batches, bins=args.bins, tags=tags, target_fprs=args.target_fpr)
+    report['model'] = args.model_path
+
+    print(f'AUC: {report["auc"]}')
+    for point in report['operating_points']:
+        print(f'FPR target {point["target_fpr"]}: threshold {point["threshold"]}, TPR {point["tpr"] * 100}%')
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Exports discriminators built by gan.make_simple_discriminator_model to TensorFlow Lite, so they can be scored
+with scorer.Scorer without importing TensorFlow/Keras.
+
+Usage:
+    python export.py ./models/simple_disc.model ./models/simple_disc.tflite [--quantize] [--check]
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+
+feat_size = 2381  # From EMBER feature digest, DO NOT CHANGE!
+
+
+def export_tflite(model_path, out_path, quantize=False):
+    """
+    Converts a saved Keras discriminator to a TFLite flatbuffer and returns the size of the written file in bytes.
+
+    :param model_path: Path of the SavedModel directory written by gan.save_model.
+    :param out_path: Path to write the .tflite file to.
+    :param quantize: If True, applies dynamic-range quantization, storing Dense kernels as int8.
+    """
+    import tensorflow as tf
+    import gan
+
+    model = gan.load_model(model_path)
+    # Trace through a fixed input signature, the Sequential models are built lazily and have no input layer
+    predict = tf.function(lambda x: model(x, training=False))
+    concrete = predict.get_concrete_function(tf.TensorSpec([None, feat_size], tf.float32))
+
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([concrete], model)
+    if quantize:
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    flatbuffer = converter.convert()
+
+    with open(out_path, 'wb') as f:
+        f.write(flatbuffer)
+    return len(flatbuffer)
+
+
+def load_check_features(amount, path="dataset/test_set.npz"):
+    """
+    Returns features to compare exported and Keras models on. Uses the test set when it exists, otherwise random
+    features of the same shape.
+
+    :param amount: Number of feature vectors to return.
+    :param path: Path of the numpy file written by setup.save_npz.
+    """
+    if os.path.exists(path):
+        import setup
+        return setup.load_npz(path)[1][:amount]
+    rng = np.random.default_rng(0)
+    return np.abs(rng.normal(size=(amount, feat_size))).astype(np.float32)
+
+
+def check_parity(model_path, tflite_path, features, atol=1e-3):
+    """
+    Compares the scores of an exported model against the original Keras model. Returns the maximum absolute
+    difference in malware probability and the fraction of samples whose 0.5-thresholded label disagrees.
+
+    :param model_path: Path of the original SavedModel directory.
+    :param tflite_path: Path of the exported .tflite file.
+    :param features: Array of preprocessed features of shape (n, 2381).
+    :param atol: Maximum allowed absolute difference, a RuntimeError is raised when exceeded.
+    """
+    import gan
+    import scorer
+
+    model = gan.load_model(model_path)
+    expected = model(features, training=False).numpy().reshape(-1)
+    actual = scorer.Scorer(tflite_path).score(features)
+
+    max_diff = float(np.max(np.abs(expected - actual)))
+    label_mismatch = float(np.mean((expected > 0.5) != (actual > 0.5)))
+    if max_diff > atol:
+        raise RuntimeError(f'Exported model differs from Keras model by {max_diff} (> {atol})')
+    return max_diff, label_mismatch
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a Keras discriminator to TFLite.")
+    parser.add_argument("model_path")
+    parser.add_argument("out_path")
+    parser.add_argument("--quantize", action="store_true", help="Use int8 dynamic-range quantization.")
+    parser.add_argument("--check", action="store_true", help="Compare exported scores against the Keras model.")
+    parser.add_argument("--check-samples", type=int, default=1024)
+    parser.add_argument("--atol", type=float, default=None,
+                        help="Parity tolerance, defaults to 1e-4 (float) or 5e-2 (quantized).")
+    args = parser.parse_args()
+
+    size = export_tflite(args.model_path, args.out_path, quantize=args.quantize)
+    print(f'Wrote {args.out_path} ({size / 1024:.1f} KiB)')
+
+    if args.check:
+        atol = args.atol if args.atol is not None else (5e-2 if args.quantize else 1e-4)
+        features = load_check_features(args.check_samples)
+        try:
+            max_diff, mismatch = check_parity(args.model_path, args.out_path, features, atol=atol)
+        except RuntimeError as e:
+            print(f'Parity check failed: {e}')
+            sys.exit(1)
+        print(f'Parity OK - Max abs diff: {max_diff}, Label mismatch: {mismatch * 100}%')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,311 @@
+"""
+Guarded PE feature extraction for untrusted corpora.
+
+features.PEFeatureExtractor parses every file with lief in-process, so a single pathological binary can hang or crash
+a whole extraction job. GuardedExtractor instead computes the raw features in subprocess workers, each with an
+address space limit and a per-file CPU time limit, which are killed on a per-file wall time limit and replaced after a
+fixed number of files so leaks don't accumulate. Files lief can't handle in time, or at all, fall back to the features
+computed without a lief parse (lief_binary=None, like PEFeatureExtractor on a lief error), and the reason is recorded
+per file instead of printed.
+
+Usage:
+    python extraction.py samples/ --out raw_features.jsonl --failures failures.jsonl --workers 8 --timeout 10
+"""
+import argparse
+import collections
+import hashlib
+import json
+import math
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import time
+
+ParseFailure = collections.namedtuple('ParseFailure', ['sha256', 'reason', 'detail'])
+ParseFailure.__doc__ = """
+Why the lief features of a file were computed without a lief parse. The reason is one of
+    too_large     the file is larger than max_file_size and wasn't parsed
+    parse_error   lief rejected the file
+    feature_error a lief based feature type raised on the parsed file
+    memory_limit  the worker ran out of its address space limit
+    cpu_limit     the worker was killed by the per-file CPU time limit
+    timeout       the worker was killed by the per-file wall time limit
+    crashed       the worker died, e.g. a segfault in lief
+"""
+
+
+def _raw_features(extractor, bytez):
+    # Returns (raw features, reason, detail), see ParseFailure
+    import features
+    reason = detail = None
+    try:
+        lief_binary = features.lief.PE.parse(list(bytez))
+        if lief_binary is None:  # lief 0.10 and later return None instead of raising
+            reason, detail = 'parse_error', 'lief returned no binary'
+    except MemoryError:
+        lief_binary, reason, detail = None, 'memory_limit', 'MemoryError'
+    except features.lief_errors() as e:
+        lief_binary, reason, detail = None, 'parse_error', str(e)
+
+    raw = {"sha256": hashlib.sha256(bytez).hexdigest()}
+    for fe in extractor.features:
+        try:
+            raw[fe.name] = fe.raw_features(bytez, lief_binary)
+        except Exception as e:
+            if lief_binary is None or fe.name not in features.LIEF_BLOCKS:
+                raise
+            # Recomputes the lief based feature types consistently, rather than mixing parsed and unparsed ones
+            reason, detail = 'feature_error', f'{fe.name}: {e!r}'
+            return _fallback(extractor, bytez, raw), reason, detail
+    return raw, reason, detail
+
+
+def _fallback(extractor, bytez, raw=None):
+    # The raw features without a lief parse, reusing the byte based feature types already in raw
+    import features
+    raw = {"sha256": hashlib.sha256(bytez).hexdigest()} if raw is None else raw
+    for fe in extractor.features:
+        if fe.name in features.LIEF_BLOCKS or fe.name not in raw:
+            raw[fe.name] = fe.raw_features(bytez, None)
+    return raw
+
+
+def _worker_main(conn, feature_version, memory_limit, cpu_limit):
+    import resource
+
+    import lief  # Before the address space limit is set
+
+    import features
+    extractor = features.PEFeatureExtractor(feature_version, print_feature_warning=False)
+    if hasattr(lief, 'logging'):
+        lief.logging.disable()  # Failures are reported per file instead
+    if memory_limit:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    _, cpu_hard = resource.getrlimit(resource.RLIMIT_CPU)
+    while True:
+        try:
+            bytez = conn.recv_bytes()
+        except EOFError:
+            return
+        if cpu_limit:
+            # RLIMIT_CPU counts the CPU time of the whole process, so the limit is moved forward for every file
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            resource.setrlimit(resource.RLIMIT_CPU, (int(usage.ru_utime + usage.ru_stime) + cpu_limit, cpu_hard))
+        try:
+            conn.send(_raw_features(extractor, bytez))
+        except MemoryError:
+            conn.send((None, 'memory_limit', 'MemoryError'))
+
+
+class _Worker(object):
+    """ One worker process and the file it is working on, if any. """
+
+    def __init__(self, context, args):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn,) + args, daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.tasks = 0
+        self.task = None
+        self.deadline = None
+
+    def submit(self, task, bytez, timeout):
+        self.conn.send_bytes(bytez)
+        self.tasks += 1
+        self.task = task
+        self.deadline = time.monotonic() + timeout if timeout else None
+
+    def death_reason(self):
+        self.process.join()
+        if self.process.exitcode == -signal.SIGXCPU:
+            return 'cpu_limit', 'exceeded the CPU time limit'
+        return 'crashed', f'worker exit code {self.process.exitcode}'
+
+    def stop(self, kill=False):
+        if kill:
+            self.process.kill()
+        self.conn.close()  # Ends the worker loop
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+
+
+class GuardedExtractor(object):
+    """
+    Extracts raw features like features.PEFeatureExtractor, in subprocess workers that can't take down the caller.
+    Failure reasons are counted in failure_counts, and written to failure_log if given.
+    """
+
+    def __init__(self, feature_version=2, workers=1, timeout=10.0, cpu_limit=None, memory_limit=2 << 30,
+                 max_file_size=64 << 20, max_tasks_per_worker=500, failure_log=None):
+        """
+        :param feature_version: EMBER feature version, 1 or 2.
+        :param workers: Number of worker processes.
+        :param timeout: Wall time limit per file in seconds, None for no limit.
+        :param cpu_limit: CPU time limit per file in whole seconds, defaults to the wall time limit rounded up.
+        :param memory_limit: Address space limit of every worker in bytes, including the interpreter and lief.
+        :param max_file_size: Larger files aren't parsed by lief at all.
+        :param max_tasks_per_worker: Number of files after which a worker is replaced by a fresh one.
+        :param failure_log: Path of a JSON lines file the failures are appended to.
+        """
+        import features
+        self.extractor = features.PEFeatureExtractor(feature_version, print_feature_warning=False)
+        self.timeout = timeout
+        self.max_file_size = max_file_size
+        self.max_tasks_per_worker = max_tasks_per_worker
+        if cpu_limit is None and timeout:
+            cpu_limit = max(1, math.ceil(timeout))
+        self._worker_args = (feature_version, memory_limit, cpu_limit)
+        self._context = multiprocessing.get_context('spawn')
+        self._num_workers = workers
+        self._workers = []
+        self.failure_counts = collections.Counter()
+        self._failure_log = open(failure_log, 'a') if failure_log else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """ Stops the workers and closes the failure log. """
+        for worker in self._workers:
+            worker.stop()
+        self._workers = []
+        if self._failure_log:
+            self._failure_log.close()
+            self._failure_log = None
+
+    def _record(self, raw, reason, detail):
+        failure = ParseFailure(raw['sha256'], reason, detail)
+        self.failure_counts[reason] += 1
+        if self._failure_log:
+            self._failure_log.write(json.dumps(failure._asdict()) + '\n')
+            self._failure_log.flush()
+        return failure
+
+    def _finish(self, bytez, raw, reason, detail):
+        if raw is None:
+            raw = _fallback(self.extractor, bytez)
+        return raw, self._record(raw, reason, detail) if reason else None
+
+    def _replace(self, worker, kill=False):
+        worker.stop(kill)
+        replacement = _Worker(self._context, self._worker_args)
+        self._workers[self._workers.index(worker)] = replacement
+        return replacement
+
+    def extract_many(self, samples):
+        """
+        Yields (raw features, ParseFailure or None) for every file, in order, keeping all workers busy.
+
+        :param samples: Iterable of file contents as bytes.
+        """
+        for worker in [worker for worker in self._workers if worker.task is not None]:
+            self._replace(worker, kill=True)  # Left busy by an earlier call that wasn't iterated to the end
+        while len(self._workers) < self._num_workers:
+            self._workers.append(_Worker(self._context, self._worker_args))
+        samples = iter(samples)
+        done = {}
+        submitted = yielded = 0
+        exhausted = False
+        while True:
+            for worker in self._workers:
+                while worker.task is None and not exhausted:
+                    bytez = next(samples, None)
+                    if bytez is None:
+                        exhausted = True
+                    elif len(bytez) > self.max_file_size:
+                        done[submitted] = self._finish(bytez, None, 'too_large', f'{len(bytez)} bytes')
+                        submitted += 1
+                    else:
+                        try:
+                            worker.submit((submitted, bytez), bytez, self.timeout)
+                        except OSError:  # Died while idle
+                            done[submitted] = self._finish(bytez, None, *worker.death_reason())
+                            worker = self._replace(worker)
+                        submitted += 1
+            while yielded in done:
+                yield done.pop(yielded)
+                yielded += 1
+            busy = [worker for worker in self._workers if worker.task is not None]
+            if not busy:
+                return
+
+            deadlines = [worker.deadline for worker in busy if worker.deadline is not None]
+            wait = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+            ready = multiprocessing.connection.wait([worker.conn for worker in busy], wait)
+            for worker in busy:
+                (index, bytez) = worker.task
+                if worker.conn in ready:
+                    try:
+                        raw, reason, detail = worker.conn.recv()
+                    except (EOFError, OSError):
+                        raw, (reason, detail) = None, worker.death_reason()
+                        self._replace(worker)
+                    else:
+                        worker.task = None
+                        if worker.tasks >= self.max_tasks_per_worker:
+                            self._replace(worker)
+                elif worker.deadline is not None and time.monotonic() >= worker.deadline:
+                    raw, reason, detail = None, 'timeout', f'exceeded {self.timeout}s'
+                    self._replace(worker, kill=True)
+                else:
+                    continue
+                done[index] = self._finish(bytez, raw, reason, detail)
+
+    def raw_features(self, bytez):
+        raw, _ = next(self.extract_many([bytez]))
+        return raw
+
+    def process_raw_features(self, raw_obj):
+        return self.extractor.process_raw_features(raw_obj)
+
+    def feature_vector(self, bytez):
+        return self.process_raw_features(self.raw_features(bytez))
+
+
+def _iter_paths(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for name in sorted(files):
+                    yield os.path.join(root, name)
+        else:
+            yield path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract raw EMBER features from PE files in guarded workers.")
+    parser.add_argument("paths", nargs="+", help="PE files, or directories of them.")
+    parser.add_argument("--out", required=True, help="JSON lines file to write the raw features to.")
+    parser.add_argument("--failures", help="JSON lines file to append the per-file failure reasons to.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--timeout", type=float, default=10.0, help="Wall time limit per file in seconds.")
+    parser.add_argument("--memory-limit", type=int, default=2048, help="Address space limit per worker in MB.")
+    parser.add_argument("--max-file-size", type=int, default=64, help="Larger files aren't parsed by lief, in MB.")
+    parser.add_argument("--feature-version", type=int, default=2)
+    args = parser.parse_args()
+
+    def read(paths):
+        for path in paths:
+            with open(path, 'rb') as f:
+                yield f.read()
+
+    start = time.perf_counter()
+    count = 0
+    with GuardedExtractor(args.feature_version, args.workers, args.timeout, memory_limit=args.memory_limit << 20,
+                          max_file_size=args.max_file_size << 20, failure_log=args.failures) as extractor, \
+            open(args.out, 'w') as out:
+        for raw, _ in extractor.extract_many(read(_iter_paths(args.paths))):
+            out.write(json.dumps(raw) + '\n')
+            count += 1
+        failures = dict(extractor.failure_counts)
+    print(f'Extracted {count} files in {time.perf_counter() - start:.1f}s, failures: {failures or "none"}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+"""
+Compact record format for the features LMDB, decoded straight into a NumPy array.
+
+The SOREL-20M format (see lmdb_writer.encode) is zlib-compressed msgpack of a list of Python floats, so reading a
+record builds thousands of Python objects before np.asarray and dataset.features_postproc_func. A compact record
+instead holds the postprocessed vector (after features_postproc_func, so float16 doesn't overflow on sizes and
+quantization steps are relative) as raw little-endian values:
+
+    float32  4 bytes per feature, lossless
+    float16  2 bytes per feature
+    int8     1 byte per feature, quantized per feature block (see features.feature_blocks) with a float32 scale of
+             max |value| / 127 per block, so zeros stay exact
+
+after a 7 byte header (magic b'FC', version, dtype, codec, dimension), compressed with zlib at level 1, or zstd or lz4
+when those packages are installed, or not at all. The magic can't be the first byte of a zlib stream, so readers
+(decode, feature_stats.decode, dataset.LMDBReader) tell the two formats apart per record, and an LMDB can be converted
+in place of the old one.
+
+Usage:
+    python feature_codec.py convert dataset/ember_features/data.mdb dataset/compact_features/data.mdb --dtype int8
+    python feature_codec.py parity models/simple_disc.model dataset/test_set.npz --dtype int8
+"""
+import argparse
+import struct
+import time
+import zlib
+
+import numpy as np
+
+MAGIC = b'FC'
+VERSION = 1
+_HEADER = struct.Struct('<2sBBBH')
+
+DTYPES = ('float32', 'float16', 'int8')
+
+
+def _zstd():
+    import zstandard
+    return zstandard.ZstdCompressor(level=3).compress, zstandard.ZstdDecompressor().decompress
+
+
+def _lz4():
+    import lz4.frame
+    return lz4.frame.compress, lz4.frame.decompress
+
+
+# Codec name to (id, function returning (compress, decompress)), the packages of zstd and lz4 being optional
+CODECS = {
+    'none': (0, lambda: (bytes, bytes)),
+    'zlib': (1, lambda: (lambda data: zlib.compress(data, 1), zlib.decompress)),
+    'zstd': (2, _zstd),
+    'lz4': (3, _lz4),
+}
+_codec_cache = {}
+
+
+def _codec(name_or_id):
+    if name_or_id not in _codec_cache:
+        name = name_or_id if name_or_id in CODECS else {i: n for n, (i, _) in CODECS.items()}.get(name_or_id)
+        if name is None:
+            raise ValueError(f'Unknown codec {name_or_id!r}, expected one of {", ".join(CODECS)}')
+        _codec_cache[name_or_id] = (CODECS[name][0],) + CODECS[name][1]()
+    return _codec_cache[name_or_id]
+
+
+_block_cache = {}
+
+
+def _blocks(dim):
+    # (start, stop) columns of the feature blocks of a vector length, and the block index of every column
+    if dim not in _block_cache:
+        import features
+        layout = {2381: 2, 2351: 1}.get(dim)
+        bounds = list(features.feature_blocks(layout).values()) if layout else [(0, dim)]
+        _block_cache[dim] = (bounds, np.repeat(np.arange(len(bounds)), [stop - start for start, stop in bounds]))
+    return _block_cache[dim]
+
+
+def is_compact(value):
+    """ Returns whether an LMDB value is a compact record rather than a SOREL-20M one. """
+    return bytes(value[:2]) == MAGIC
+
+
+def encode_postprocessed(vector, dtype='int8', codec='zlib'):
+    """
+    Returns the compact record of a postprocessed feature vector.
+
+    :param vector: Feature vector after dataset.features_postproc_func.
+    :param dtype: One of DTYPES.
+    :param codec: One of CODECS.
+    """
+    vector = np.asarray(vector, dtype=np.float32)
+    codec_id, compress, _ = _codec(codec)
+    if dtype == 'float32':
+        payload = vector.astype('<f4').tobytes()
+    elif dtype == 'float16':
+        payload = vector.astype('<f2').tobytes()
+    elif dtype == 'int8':
+        bounds, block_of = _blocks(len(vector))
+        scales = np.array([np.abs(vector[start:stop]).max(initial=0.0) for start, stop in bounds], dtype='<f4') / 127
+        quantized = np.rint(vector / np.where(scales > 0, scales, 1)[block_of]).astype(np.int8)
+        payload = scales.tobytes() + quantized.tobytes()
+    else:
+        raise ValueError(f'Unknown dtype {dtype!r}, expected one of {", ".join(DTYPES)}')
+    return _HEADER.pack(MAGIC, VERSION, DTYPES.index(dtype), codec_id, len(vector)) + compress(payload)
+
+
+def encode(vector, dtype='int8', codec='zlib'):
+    """
+    Returns the compact record of a raw feature vector (before dataset.features_postproc_func), like
+    lmdb_writer.encode. See LMDBWriter's encoder.
+    """
+    from feature_stats import signed_log1p
+    return encode_postprocessed(signed_log1p(np.array(vector, dtype=np.float32)), dtype, codec)
+
+
+def decode(value):
+    """ Returns the postprocessed float32 feature vector of a compact record. """
+    magic, version, dtype, codec_id, dim = _HEADER.unpack_from(value)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f'Not a version {VERSION} compact record')
+    payload = _codec(codec_id)[2](bytes(value[_HEADER.size:]))
+    if dtype == 0:
+        return np.frombuffer(payload, dtype='<f4', count=dim).astype(np.float32)
+    if dtype == 1:
+        return np.frombuffer(payload, dtype='<f2', count=dim).astype(np.float32)
+    bounds, block_of = _blocks(dim)
+    scales = np.frombuffer(payload, dtype='<f4', count=len(bounds))
+    quantized = np.frombuffer(payload, dtype=np.int8, count=dim, offset=scales.nbytes)
+    return quantized * scales[block_of]
+
+
+def convert(src_path, dst_path, dtype='int8', codec='zlib', batch_size=1000, workers=4):
+    """
+    Copies every record of a features LMDB into a new LMDB of compact records, keeping the keys. Returns the number
+    of records written.
+
+    :param src_path: Path of the source LMDB, in either format.
+    :param dst_path: Path of the LMDB to write, created if missing.
+    :param dtype: One of DTYPES.
+    :param codec: One of CODECS.
+    :param batch_size: Number of records per write transaction.
+    :param workers: Number of encoding threads.
+    """
+    import lmdb
+
+    from feature_stats import decode as decode_any
+    from lmdb_writer import LMDBWriter
+
+    _codec(codec)  # Fails early if the codec's package is missing
+    env = lmdb.open(src_path, readonly=True, lock=False, map_size=int(1e13), subdir=False)
+    with LMDBWriter(dst_path, workers=workers, batch_size=batch_size,
+                    encoder=lambda vector: encode_postprocessed(vector, dtype, codec)) as writer:
+        with env.begin() as txn:
+            for key, value in txn.cursor():
+                writer.put(key.decode('ascii'), decode_any(value))
+    env.close()
+    return writer.written
+
+
+def parity(model_path, npz_path, dtype='int8', codec='zlib', batch_size=1024):
+    """
+    Compares the scores of a discriminator on a feature set with those on the same features after a round trip
+    through compact records. Returns a dict of the largest score difference, the fraction of decisions (at 0.5)
+    that changed, the ROC AUC of both, and the largest feature error.
+
+    :param model_path: Path of a discriminator saved by gan.save_model.
+    :param npz_path: Numpy feature set (postprocessed features) with labels, see setup.save_npz.
+    :param dtype: One of DTYPES.
+    :param codec: One of CODECS.
+    :param batch_size: Batch size of scoring.
+    """
+    import feature_store
+    import gan
+
+    labels, feats = feature_store.load(npz_path)
+    round_trip = np.stack([decode(encode_postprocessed(x, dtype, codec)) for x in feats])
+    model = gan.load_model(model_path)
+
+    def scores(x):
+        return np.concatenate([model(x[i:i + batch_size], training=False).numpy().ravel()
+                               for i in range(0, len(x), batch_size)])
+
+    def auc(s):
+        ranks = np.empty(len(s))
+        ranks[np.argsort(s, kind='stable')] = np.arange(1, len(s) + 1)
+        positives = labels == 1
+        n_pos, n_neg = positives.sum(), (~positives).sum()
+        return float((ranks[positives].sum() - n_pos * (n_pos + 1) / 2) / (n_pos * n_neg))
+
+    original, compact = scores(feats), scores(round_trip)
+    return {'max_score_diff': float(np.abs(original - compact).max()),
+            'changed_decisions': float(np.mean((original > 0.5) != (compact > 0.5))),
+            'auc': auc(original), 'compact_auc': auc(compact),
+            'max_feature_error': float(np.abs(feats - round_trip).max())}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a features LMDB to compact records, or check their parity.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    convert_parser = commands.add_parser("convert", help="Write the records of a features LMDB as compact records.")
+    convert_parser.add_argument("src", help="Source LMDB file.")
+    convert_parser.add_argument("dst", help="LMDB file to write, created if missing.")
+    parity_parser = commands.add_parser("parity", help="Compare a model's scores before and after a round trip.")
+    parity_parser.add_argument("model", help="Discriminator saved by gan.save_model.")
+    parity_parser.add_argument("npz", help="Numpy feature set with labels.")
+    for p in (convert_parser, parity_parser):
+        p.add_argument("--dtype", choices=DTYPES, default="int8")
+        p.add_argument("--codec", choices=list(CODECS), default="zlib")
+    convert_parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        start = time.perf_counter()
+        written = convert(args.src, args.dst, args.dtype, args.codec, workers=args.workers)
+        print(f'Converted {written} records in {time.perf_counter() - start:.1f}s')
+    else:
+        for name, value in parity(args.model, args.npz, args.dtype, args.codec).items():
+            print(f'{name}: {value}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,444 @@
+"""
+Streaming per-feature statistics of the features LMDB, feature drift between dataset splits, and adapting the
+Normalization layers of the models in gan.py without loading a dataset into memory.
+
+RunningStats keeps, per feature, the count, mean and variance (Welford, merged with Chan's formula), min/max, the
+number of zeros, and a fixed-bin histogram of the nonzero values from which quantiles and the population stability
+index (PSI) are computed. All of it merges exactly, so key ranges of the LMDB are summarized in parallel processes
+and combined. Statistics are of the features as the models see them, after dataset.features_postproc_func.
+
+Usage:
+    python feature_stats.py stats dataset/ember_features/data.mdb --meta-db dataset/ember_features/meta.db \
+        --split train --out stats-train.npz
+    python feature_stats.py drift stats-train.npz stats-test.npz --out drift.json
+    python feature_stats.py adapt models/simple_disc.model dataset/ember_features/data.mdb \
+        --meta-db dataset/ember_features/meta.db --out models/simple_disc_adapted.model
+"""
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import sqlite3
+import zlib
+
+import numpy as np
+
+feat_size = 2381  # From EMBER feature digest, DO NOT CHANGE!
+
+
+def signed_log1p(x):
+    """
+    Postprocessing of raw feature vectors, sign(x) * log(1 + |x|), on a float array in place. Also applied by
+    dataset.features_postproc_func, kept here so it can be used without dataset.py's dependencies.
+    """
+    lz = x < 0
+    gz = x > 0
+    x[lz] = - np.log(1 - x[lz])
+    x[gz] = np.log(1 + x[gz])
+    return x
+
+
+def decode(value):
+    """
+    Returns the feature vector of an LMDB value as dataset.LMDBReader with features_postproc_func does, from either
+    record format (see feature_codec).
+    """
+    import msgpack
+
+    import feature_codec
+    if feature_codec.is_compact(value):
+        return feature_codec.decode(value)
+    return signed_log1p(np.asarray(msgpack.loads(zlib.decompress(value), strict_map_key=False)[0], dtype=np.float32))
+
+
+class RunningStats(object):
+    """ Mergeable per-feature statistics of a stream of feature batches, see the module docstring. """
+
+    def __init__(self, dim=feat_size, bins=1024, value_range=(-32.0, 32.0)):
+        """
+        :param dim: Number of features.
+        :param bins: Number of histogram bins for quantiles and PSI, 0 for moments only. Must be even, so that 0 is a
+                     bin edge.
+        :param value_range: Range of the histogram, values outside fall in the outermost bins.
+        """
+        if bins % 2:
+            raise ValueError(f'bins must be even, not {bins}')
+        self.dim = dim
+        self.bins = bins
+        self.value_range = tuple(value_range)
+        self.count = 0
+        self.mean = np.zeros(dim)
+        self.m2 = np.zeros(dim)
+        self.min = np.full(dim, np.inf)
+        self.max = np.full(dim, -np.inf)
+        self.zeros = np.zeros(dim, dtype=np.int64)
+        self.histogram = np.zeros((dim, bins), dtype=np.int64) if bins else None
+
+    def update(self, batch):
+        """
+        Adds a batch of samples.
+
+        :param batch: Array of shape [samples, dim].
+        """
+        batch = np.asarray(batch, dtype=np.float64).reshape(-1, self.dim)
+        n = len(batch)
+        if not n:
+            return
+        batch_mean = batch.mean(axis=0)
+        batch_m2 = ((batch - batch_mean) ** 2).sum(axis=0)
+        self._merge_moments(n, batch_mean, batch_m2)
+        self.min = np.minimum(self.min, batch.min(axis=0))
+        self.max = np.maximum(self.max, batch.max(axis=0))
+        nonzero = batch != 0
+        self.zeros += n - nonzero.sum(axis=0)
+        if self.bins:
+            lo, hi = self.value_range
+            index = np.clip(((batch - lo) * (self.bins / (hi - lo))).astype(np.int64), 0, self.bins - 1)
+            index += np.arange(self.dim) * self.bins
+            self.histogram += np.bincount(index[nonzero], minlength=self.dim * self.bins).reshape(self.dim, self.bins)
+
+    def _merge_moments(self, n, mean, m2):
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (n / total)
+        self.m2 = self.m2 + m2 + delta ** 2 * (self.count * n / total)
+        self.count = total
+
+    def merge(self, other):
+        """ Adds the samples summarized by other, returns self. """
+        if (other.dim, other.bins, other.value_range) != (self.dim, self.bins, self.value_range):
+            raise ValueError('Cannot merge statistics with different dimensions or histograms')
+        if other.count:
+            self._merge_moments(other.count, other.mean, other.m2)
+            self.min = np.minimum(self.min, other.min)
+            self.max = np.maximum(self.max, other.max)
+            self.zeros += other.zeros
+            if self.bins:
+                self.histogram += other.histogram
+        return self
+
+    @property
+    def variance(self):
+        """ Population variance, as keras.layers.Normalization uses. """
+        return self.m2 / max(self.count, 1)
+
+    @property
+    def sparsity(self):
+        """ Fraction of zero values. """
+        return self.zeros / max(self.count, 1)
+
+    def _cells(self):
+        # The histogram with the zeros as a zero-width cell at 0: (counts, lower edges, widths)
+        lo, hi = self.value_range
+        width = (hi - lo) / self.bins
+        half = self.bins // 2
+        counts = np.concatenate([self.histogram[:, :half], self.zeros[:, None], self.histogram[:, half:]], axis=1)
+        lower = np.concatenate([lo + width * np.arange(half), [0.0], lo + width * np.arange(half, self.bins)])
+        widths = np.concatenate([np.full(half, width), [0.0], np.full(self.bins - half, width)])
+        return counts, lower, widths
+
+    def quantiles(self, qs):
+        """
+        Returns an array of shape [len(qs), dim] of approximate quantiles, exact for zeros and within one bin width
+        (value_range / bins) otherwise.
+
+        :param qs: Quantiles in [0, 1].
+        """
+        if not self.bins:
+            raise ValueError('Quantiles need the histogram, bins=0')
+        counts, lower, widths = self._cells()
+        cumulative = np.cumsum(counts, axis=1)
+        out = np.empty((len(qs), self.dim))
+        rows = np.arange(self.dim)
+        for i, q in enumerate(qs):
+            target = q * self.count
+            cell = np.minimum((cumulative < target).sum(axis=1), counts.shape[1] - 1)
+            before = cumulative[rows, cell] - counts[rows, cell]
+            fraction = np.where(counts[rows, cell] > 0, (target - before) / np.maximum(counts[rows, cell], 1), 0.0)
+            out[i] = np.clip(lower[cell] + np.clip(fraction, 0, 1) * widths[cell], self.min, self.max)
+        return out
+
+    def distribution(self):
+        """ Returns the fraction of the samples in every histogram cell (the zeros being one cell), per feature. """
+        counts, _, _ = self._cells()
+        return counts / max(self.count, 1)
+
+    def summary(self, qs=(0.01, 0.25, 0.5, 0.75, 0.99)):
+        """ Returns a dict of per-feature arrays: count, mean, std, min, max, sparsity and the quantiles qs. """
+        out = {'count': self.count, 'mean': self.mean, 'std': np.sqrt(self.variance), 'min': self.min, 'max': self.max,
+               'sparsity': self.sparsity}
+        if self.bins:
+            for q, values in zip(qs, self.quantiles(qs)):
+                out[f'q{q:g}'] = values
+        return out
+
+    def save(self, path):
+        np.savez_compressed(path, count=self.count, mean=self.mean, m2=self.m2, min=self.min, max=self.max,
+                            zeros=self.zeros, histogram=self.histogram if self.bins else np.zeros((0, 0)),
+                            value_range=np.asarray(self.value_range))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            stats = cls(len(f['mean']), f['histogram'].shape[1] if f['histogram'].size else 0, tuple(f['value_range']))
+            stats.count = int(f['count'])
+            stats.mean, stats.m2, stats.min, stats.max, stats.zeros = (f['mean'], f['m2'], f['min'], f['max'],
+                                                                       f['zeros'])
+            if stats.bins:
+                stats.histogram = f['histogram']
+        return stats
+
+
+def psi(expected, actual, eps=1e-6):
+    """
+    Returns the population stability index of every feature between two RunningStats with the same histogram bins.
+    Below 0.1 is commonly read as no significant shift, above 0.25 as a major one.
+
+    :param expected: Statistics of the reference data, e.g. the training split.
+    :param actual: Statistics of the data compared to it.
+    :param eps: Floor of the cell fractions, so empty cells don't make the index infinite.
+    """
+    e = np.maximum(expected.distribution(), eps)
+    a = np.maximum(actual.distribution(), eps)
+    return np.sum((a - e) * np.log(a / e), axis=1)
+
+
+def drift_report(expected, actual, top=20):
+    """
+    Returns a dict with the per-feature PSI and standardized mean shift of actual against expected, and the top
+    features by PSI along with the feature block (see features.feature_blocks) they belong to.
+
+    :param expected: Statistics of the reference data.
+    :param actual: Statistics of the data compared to it.
+    :param top: Number of top drifting features to list.
+    """
+    import features
+    index = psi(expected, actual)
+    shift = np.abs(actual.mean - expected.mean) / np.maximum(np.sqrt(expected.variance), 1e-12)
+    blocks = features.feature_blocks()
+
+    def block_of(column):
+        return next(name for name, (start, stop) in blocks.items() if start <= column < stop)
+
+    return {
+        'expected_count': expected.count,
+        'actual_count': actual.count,
+        'psi': index.tolist(),
+        'mean_shift': shift.tolist(),
+        'features_over_0.1': int(np.sum(index > 0.1)),
+        'features_over_0.25': int(np.sum(index > 0.25)),
+        'top': [{'feature': int(i), 'block': block_of(int(i)), 'psi': float(index[i]), 'mean_shift': float(shift[i])}
+                for i in np.argsort(-index)[:top]],
+    }
+
+
+def split_keys(meta_db_path, mode, splits=None):
+    """
+    Returns the sha256 keys of a split of meta.db, selected like dataset.Dataset does.
+
+    :param meta_db_path: Path of meta.db.
+    :param mode: 'train', 'validation', 'test', or 'all'.
+    :param splits: (train/validation, validation/test) rl_fs_t thresholds, by default those of config.py that
+                   dataset.Dataset splits by.
+    """
+    if splits is None and mode != 'all':
+        import config
+        splits = (config.train_validation_split, config.validation_test_split)
+    train_validation, validation_test = splits or (None, None)
+    where = {
+        'train': f'WHERE rl_fs_t <= {train_validation}',
+        'validation': f'WHERE rl_fs_t >= {train_validation} AND rl_fs_t < {validation_test}',
+        'test': f'WHERE rl_fs_t >= {validation_test}',
+        'all': '',
+    }
+    if mode not in where:
+        raise ValueError(f'invalid mode: {mode}')
+    con = sqlite3.connect(meta_db_path)
+    try:
+        return [row[0] for row in con.execute(f'SELECT sha256 FROM meta {where[mode]}')]
+    finally:
+        con.close()
+
+
+def _open(lmdb_path):
+    import lmdb
+    return lmdb.open(lmdb_path, readonly=True, lock=False, map_size=int(1e13), subdir=False)
+
+
+def _range_stats(lmdb_path, start, stop, batch_size, bins):
+    # Statistics of the records with start <= key < stop (stop None for no upper bound)
+    stats = RunningStats(bins=bins)
+    batch = []
+    env = _open(lmdb_path)
+    with env.begin() as txn:
+        cursor = txn.cursor()
+        if cursor.set_range(start):
+            for key, value in cursor:
+                if stop is not None and key >= stop:
+                    break
+                batch.append(decode(value))
+                if len(batch) == batch_size:
+                    stats.update(np.stack(batch))
+                    batch = []
+    if batch:
+        stats.update(np.stack(batch))
+    env.close()
+    return stats
+
+
+def _keys_stats(lmdb_path, keys, batch_size, bins):
+    stats = RunningStats(bins=bins)
+    for batch in iter_lmdb_batches(lmdb_path, keys, batch_size):
+        stats.update(batch)
+    return stats
+
+
+def iter_lmdb_batches(lmdb_path, keys, batch_size=1024):
+    """
+    Yields postprocessed feature batches of shape [<= batch_size, feat_size] for the given keys, skipping missing keys.
+
+    :param lmdb_path: Path of the features LMDB.
+    :param keys: sha256 keys.
+    :param batch_size: Maximum samples per batch.
+    """
+    env = _open(lmdb_path)
+    try:
+        with env.begin() as txn:
+            batch = []
+            for key in keys:
+                value = txn.get(key.encode('ascii'))
+                if value is None:
+                    continue
+                batch.append(decode(value))
+                if len(batch) == batch_size:
+                    yield np.stack(batch)
+                    batch = []
+            if batch:
+                yield np.stack(batch)
+    finally:
+        env.close()
+
+
+def lmdb_stats(lmdb_path, keys=None, workers=None, batch_size=1024, bins=1024):
+    """
+    Returns the RunningStats of a features LMDB, computed in parallel processes over contiguous key ranges and merged.
+
+    :param lmdb_path: Path of the features LMDB.
+    :param keys: sha256 keys to summarize (e.g. from split_keys), all records when omitted.
+    :param workers: Number of processes, os.cpu_count() by default.
+    :param batch_size: Samples per statistics update.
+    :param bins: Histogram bins, see RunningStats.
+    """
+    workers = workers or os.cpu_count()
+    parts = 4 * workers
+    if keys is None:
+        # sha256 keys are hex, so splitting on the first byte balances the ranges
+        bounds = [b''] + [b'%02x' % (256 * i // parts) for i in range(1, parts)] + [None]
+        tasks = [(_range_stats, (lmdb_path, bounds[i], bounds[i + 1], batch_size, bins)) for i in range(parts)]
+    else:
+        keys = sorted(keys)  # Sorted reads touch neighboring LMDB pages
+        chunk = -(-len(keys) // parts) or 1
+        tasks = [(_keys_stats, (lmdb_path, keys[i:i + chunk], batch_size, bins)) for i in range(0, len(keys), chunk)]
+
+    stats = RunningStats(bins=bins)
+    if workers == 1:
+        for fn, args in tasks:
+            stats.merge(fn(*args))
+        return stats
+    with concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        for future in [pool.submit(fn, *args) for fn, args in tasks]:
+            stats.merge(future.result())
+    return stats
+
+
+def adapt_normalization(model, batches, max_batches=None):
+    """
+    Adapts every keras.layers.Normalization layer of a Sequential model, in order, to the inputs it receives from the
+    layers before it, streaming the batches once per Normalization layer.
+
+    :param model: A built Sequential model, e.g. from gan.make_simple_discriminator_model.
+    :param batches: Feature batches: a tf.data dataset, a list, or a function returning a fresh iterable.
+    :param max_batches: Optional number of batches to adapt on.
+    """
+    from keras.layers import Normalization
+
+    iterate = batches if callable(batches) else lambda: iter(batches)
+    for i, layer in enumerate(model.layers):
+        if not isinstance(layer, Normalization):
+            continue
+        stats = None
+        for n, batch in enumerate(iterate()):
+            if max_batches is not None and n >= max_batches:
+                break
+            if isinstance(batch, tuple):
+                batch = batch[0]  # (features, labels) batches
+            x = batch
+            for previous in model.layers[:i]:
+                x = previous(x, training=False)
+            x = np.asarray(x)
+            if stats is None:
+                stats = RunningStats(x.shape[-1], bins=0)
+            stats.update(x)
+        if stats is None:
+            raise ValueError('No batches to adapt on')
+        layer.adapt_mean.assign(stats.mean.astype(layer.adapt_mean.dtype.as_numpy_dtype))
+        layer.adapt_variance.assign(stats.variance.astype(layer.adapt_variance.dtype.as_numpy_dtype))
+        layer.count.assign(stats.count)
+        layer.finalize_state()
+    return model
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Streaming feature statistics, drift and normalization.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    stats_parser = subparsers.add_parser('stats', help="Compute the statistics of the features LMDB or a split of it.")
+    stats_parser.add_argument("lmdb_path")
+    stats_parser.add_argument("--meta-db", help="meta.db to select the split from.")
+    stats_parser.add_argument("--split", default='all', choices=('all', 'train', 'validation', 'test'))
+    stats_parser.add_argument("--workers", type=int, default=os.cpu_count())
+    stats_parser.add_argument("--bins", type=int, default=1024)
+    stats_parser.add_argument("--out", required=True, help="npz file to save the statistics to.")
+
+    drift_parser = subparsers.add_parser('drift', help="Compare two statistics files.")
+    drift_parser.add_argument("expected", help="Statistics of the reference split.")
+    drift_parser.add_argument("actual", help="Statistics of the compared split.")
+    drift_parser.add_argument("--top", type=int, default=20)
+    drift_parser.add_argument("--out", help="JSON file to write the full report to.")
+
+    adapt_parser = subparsers.add_parser('adapt', help="Adapt the Normalization layers of a saved model.")
+    adapt_parser.add_argument("model_path")
+    adapt_parser.add_argument("lmdb_path")
+    adapt_parser.add_argument("--meta-db", required=True, help="meta.db to select the training split from.")
+    adapt_parser.add_argument("--batch-size", type=int, default=1024)
+    adapt_parser.add_argument("--max-batches", type=int)
+    adapt_parser.add_argument("--out", required=True, help="Path to save the adapted model to.")
+    args = parser.parse_args()
+
+    if args.command == 'stats':
+        keys = split_keys(args.meta_db, args.split) if args.meta_db else None
+        stats = lmdb_stats(args.lmdb_path, keys, args.workers, bins=args.bins)
+        stats.save(args.out)
+        summary = stats.summary()
+        print(f'{stats.count} samples, mean sparsity {summary["sparsity"].mean():.3f}, '
+              f'{int(np.sum(summary["std"] == 0))} constant features')
+    elif args.command == 'drift':
+        report = drift_report(RunningStats.load(args.expected), RunningStats.load(args.actual), args.top)
+        print(f'{report["features_over_0.1"]} features with PSI > 0.1, {report["features_over_0.25"]} with PSI > 0.25')
+        for row in report['top']:
+            print(f'  feature {row["feature"]:4d} ({row["block"]}): PSI {row["psi"]:.3f}, '
+                  f'mean shift {row["mean_shift"]:.2f} std')
+        if args.out:
+            with open(args.out, 'w') as f:
+                json.dump(report, f)
+    else:
+        import gan
+        model = gan.load_model(args.model_path)
+        keys = split_keys(args.meta_db, 'train')
+        adapt_normalization(model, lambda: iter_lmdb_batches(args.lmdb_path, keys, args.batch_size), args.max_batches)
+        model.save(args.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+"""
+Block-selective, append-only feature store. The columns of a feature set are stored grouped by EMBER feature block
+(FeatureType.name, see features.feature_blocks), one float32 .npy file per block and shard, next to a JSON manifest:
+
+    <store>/manifest.json
+    <store>/labels-00000.npy
+    <store>/histogram-00000.npy, <store>/byteentropy-00000.npy, ...
+
+Blocks are memory-mapped when loaded, so loading a subset of blocks only reads (and keeps in memory) those columns.
+
+New samples are appended as new shards (see append_shard and setup.ingest) and the manifest is replaced atomically,
+so readers always see a complete set of shards. The manifest also records the high-water mark of the source rows
+ingested so far, so an update only has to extract the rows added since.
+
+A feature set can also be written as one memory-mappable matrix (see write_mmap), which load returns without reading
+it, for processes that share a dataset through the page cache (see gan.memmap_dataset):
+
+    <dir>/labels.npy
+    <dir>/features.npy
+
+Usage:
+    python feature_store.py convert dataset/train_set.npz dataset/train_store [--blocks histogram byteentropy]
+    python feature_store.py ingest dataset/train_store [--mark rowid|rl_fs_t] [--chunk-size 50000]
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+import features
+
+MANIFEST = 'manifest.json'
+MMAP_FEATURES = 'features.npy'
+MMAP_LABELS = 'labels.npy'
+
+
+def _write_manifest(path, manifest):
+    # Replaced atomically, so a reader or a killed writer never sees a partially written manifest. Shard files are
+    # written before the manifest that references them.
+    tmp_path = os.path.join(path, MANIFEST + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(path, MANIFEST))
+
+
+def create_store(path, blocks=None, feature_version=2):
+    """
+    Creates an empty store and returns it.
+
+    :param path: Directory of the store, created if needed.
+    :param blocks: Names of the blocks to store, defaults to all of them.
+    :param feature_version: EMBER feature version of the columns.
+    """
+    layout = features.feature_blocks(feature_version)
+    features.block_columns(blocks or layout, feature_version)  # Validates the block names
+    os.makedirs(path, exist_ok=True)
+    _write_manifest(path, {'rows': 0, 'feature_version': feature_version,
+                           'blocks': {name: layout[name] for name in layout if blocks is None or name in blocks},
+                           'shards': [], 'high_water_mark': None})
+    return FeatureStore(path)
+
+
+def write_store(path, labels, feats, blocks=None, feature_version=2):
+    """
+    Writes a feature set as a store with a single shard and returns the store.
+
+    :param path: Directory to write the store to, created if needed.
+    :param labels: Array of labels, one per row.
+    :param feats: Feature matrix, either with all columns or, if blocks is given, only the columns of those blocks in
+                  feature vector order (see features.block_columns).
+    :param blocks: Names of the blocks to store, defaults to all of them.
+    :param feature_version: EMBER feature version of the columns.
+    """
+    store = create_store(path, blocks, feature_version)
+    store.append_shard(labels, feats)
+    return store
+
+
+class FeatureStore(object):
+    """ Reads and appends to a store created by create_store or write_store. """
+
+    def __init__(self, path):
+        """
+        :param path: Directory of the store.
+        """
+        self.path = path
+        with open(os.path.join(path, MANIFEST)) as f:
+            self.manifest = json.load(f)
+
+    def __len__(self):
+        return self.manifest['rows']
+
+    @property
+    def blocks(self):
+        """ Names of the stored blocks, in feature vector order. """
+        return list(self.manifest['blocks'])
+
+    @property
+    def high_water_mark(self):
+        """ The last source row ingested, as recorded by append_shard, or None. """
+        return self.manifest['high_water_mark']
+
+    def columns(self, blocks=None):
+        """ Returns the feature vector column indices of the given blocks, all stored blocks by default. """
+        return features.block_columns(self._select(blocks), self.manifest['feature_version'])
+
+    def _select(self, blocks):
+        if blocks is None:
+            return self.blocks
+        missing = set(blocks) - set(self.blocks)
+        if missing:
+            raise ValueError(f'Blocks {sorted(missing)} are not in the store at {self.path}, it has {self.blocks}')
+        return [name for name in self.blocks if name in blocks]
+
+    def _shard_array(self, shard, name):
+        return np.load(os.path.join(self.path, shard['files'][name]), mmap_mode='r')
+
+    def labels(self):
+        return np.concatenate([np.load(os.path.join(self.path, shard['labels'])) for shard in self.manifest['shards']]
+                              or [np.empty(0)])
+
+    def load(self, blocks=None, rows=None):
+        """
+        Returns (labels, features) with the columns of the requested blocks, in feature vector order. Only those
+        blocks, and with rows only those rows, are read from disk.
+
+        :param blocks: Names of the blocks to load, all stored blocks by default.
+        :param rows: Optional slice or index array of the rows to load.
+        """
+        names = self._select(blocks)
+        shards = self.manifest['shards']
+        offsets = np.cumsum([0] + [shard['rows'] for shard in shards])
+        indices = np.arange(len(self))[rows] if rows is not None else None
+        feats = np.empty((len(self) if indices is None else len(indices), len(self.columns(names))), np.float32)
+        # Filled block by block and shard by shard, so at most one block of one shard is read at a time
+        for i, shard in enumerate(shards):
+            if indices is None:
+                out_rows, shard_rows = slice(offsets[i], offsets[i + 1]), slice(None)
+            else:
+                out_rows = np.flatnonzero((indices >= offsets[i]) & (indices < offsets[i + 1]))
+                shard_rows = indices[out_rows] - offsets[i]
+                if not len(out_rows):
+                    continue
+            column = 0
+            for name in names:
+                start, stop = self.manifest['blocks'][name]
+                feats[out_rows, column:column + stop - start] = self._shard_array(shard, name)[shard_rows]
+                column += stop - start
+        labels = self.labels()
+        return (labels, feats) if indices is None else (labels[indices], feats)
+
+    def append_shard(self, labels, feats, high_water_mark=None):
+        """
+        Appends rows as a new shard and atomically publishes it in the manifest.
+
+        :param labels: Array of labels, one per row.
+        :param feats: Feature matrix with the columns of the stored blocks, in feature vector order.
+        :param high_water_mark: Optional JSON-serializable mark of the last source row scanned, see setup.ingest.
+                                With no rows, only the mark is updated.
+        """
+        width = len(self.columns())
+        if feats.shape != (len(labels), width):
+            raise ValueError(f'Expected features of shape {(len(labels), width)} for blocks {self.blocks}, '
+                             f'got {feats.shape}')
+        if len(labels) == 0:
+            if high_water_mark is not None:
+                self.manifest = dict(self.manifest, high_water_mark=high_water_mark)
+                _write_manifest(self.path, self.manifest)
+            return
+        # Shards are numbered after the ones in the manifest, files of an append that never got published are
+        # simply overwritten
+        index = len(self.manifest['shards'])
+        shard = {'rows': len(labels), 'labels': f'labels-{index:05d}.npy', 'files': {}}
+        np.save(os.path.join(self.path, shard['labels']), labels)
+        column = 0
+        for name, (start, stop) in self.manifest['blocks'].items():
+            shard['files'][name] = f'{name}-{index:05d}.npy'
+            np.save(os.path.join(self.path, shard['files'][name]),
+                    np.asarray(feats[:, column:column + stop - start], np.float32))
+            column += stop - start
+
+        manifest = dict(self.manifest, rows=self.manifest['rows'] + len(labels),
+                        shards=self.manifest['shards'] + [shard])
+        if high_water_mark is not None:
+            manifest['high_water_mark'] = high_water_mark
+        _write_manifest(self.path, manifest)
+        self.manifest = manifest
+
+
+def write_mmap(path, labels, feats, chunk_size=65536):
+    """
+    Writes a feature set with all columns as a memory-mappable directory, see load.
+
+    :param path: Directory to write to, created if needed.
+    :param labels: Array of labels, one per row.
+    :param feats: Feature matrix, copied chunk by chunk.
+    :param chunk_size: Number of rows copied at once.
+    """
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, MMAP_LABELS), labels)
+    tmp_path = os.path.join(path, MMAP_FEATURES + '.tmp')
+    out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=feats.shape)
+    for i in range(0, len(feats), chunk_size):
+        out[i:i + chunk_size] = feats[i:i + chunk_size]
+    out.flush()
+    del out
+    # Published last, so a directory with features.npy is always complete
+    os.replace(tmp_path, os.path.join(path, MMAP_FEATURES))
+
+
+def load(path, blocks=None):
+    """
+    Loads (labels, float32 features) from a feature store directory, a memory-mapped directory written by write_mmap or
+    a numpy file written by setup.save_npz. Only the columns of the requested blocks are returned, for a store only
+    those are read. The features of a memory-mapped directory are returned as a read-only np.memmap when all blocks
+    are requested.
+
+    :param path: Store directory, memory-mapped directory or numpy file.
+    :param blocks: Names of the blocks to load, all of them by default.
+    """
+    if os.path.isfile(os.path.join(path, MMAP_FEATURES)):
+        labels = np.load(os.path.join(path, MMAP_LABELS))
+        feats = np.load(os.path.join(path, MMAP_FEATURES), mmap_mode='r')
+        return labels, feats if blocks is None else feats[:, features.block_columns(blocks)]
+    if os.path.isdir(path):
+        return FeatureStore(path).load(blocks)
+
+    import setup
+    labels, feats = setup.load_npz(path)
+    if blocks is not None:
+        feats = feats[:, features.block_columns(blocks)]
+    return labels, feats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create and update block-grouped feature stores.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    convert = commands.add_parser("convert", help="Convert a numpy feature set into a store.")
+    convert.add_argument("npz", help="Numpy file written by setup.save_npz.")
+    convert.add_argument("out", help="Directory to write the store to.")
+    convert.add_argument("--blocks", nargs="+", help=f"Blocks to keep: {', '.join(features.feature_blocks())}.")
+    ingest = commands.add_parser("ingest", help="Append the samples added to meta.db since the last ingest.")
+    ingest.add_argument("store", help="Store directory, created when missing.")
+    ingest.add_argument("--mark", choices=("rowid", "rl_fs_t"), default="rowid",
+                        help="meta.db column the high-water mark is kept on, only used when creating the store.")
+    ingest.add_argument("--blocks", nargs="+", help="Blocks to keep, only used when creating the store.")
+    ingest.add_argument("--chunk-size", type=int, default=50000, help="Rows per appended shard.")
+    ingest.add_argument("--limit", type=int, help="Maximum number of new rows to scan.")
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        labels, feats = load(args.npz, args.blocks)
+        store = write_store(args.out, labels, feats, args.blocks)
+        print(f'Wrote {len(store)} rows of {", ".join(store.blocks)} to {args.out}')
+    else:
+        import setup
+        added = setup.ingest(args.store, args.mark, args.blocks, args.chunk_size, args.limit)
+        store = FeatureStore(args.store)
+        print(f'Appended {added} rows to {args.store}, now {len(store)} rows, high-water mark {store.high_water_mark}')
+
+
+if __name__ == '__main__':
+    main()
@@ -13,14 +13,46 @@ for your modeling problem.
 '''
 
 import re
-import lief
+import functools
 import hashlib
 import numpy as np
-from sklearn.feature_extraction import FeatureHasher
 
-LIEF_MAJOR, LIEF_MINOR, _ = lief.__version__.split('.')
-LIEF_EXPORT_OBJECT = int(LIEF_MAJOR) > 0 or ( int(LIEF_MAJOR)==0 and int(LIEF_MINOR) >= 10 )
-LIEF_HAS_SIGNATURE = int(LIEF_MAJOR) > 0 or (int(LIEF_MAJOR) == 0 and int(LIEF_MINOR) >= 11)
+from lazy import lazy_import
+
+# lief and sklearn are only imported once features are actually extracted, see lazy.py
+lief = lazy_import('lief')
+
+
+@functools.lru_cache(maxsize=None)
+def _lief_version():
+    major, minor = lief.__version__.split('.')[:2]
+    return int(major), int(minor)
+
+
+def _lief_export_object():
+    major, minor = _lief_version()
+    return major > 0 or (major == 0 and minor >= 10)
+
+
+def _lief_has_signature():
+    major, minor = _lief_version()
+    return major > 0 or (major == 0 and minor >= 11)
+
+
+def __getattr__(name):
+    # Former module-level constants, now computed on demand so importing this module doesn't load lief
+    if name == 'LIEF_EXPORT_OBJECT':
+        return _lief_export_object()
+    if name == 'LIEF_HAS_SIGNATURE':
+        return _lief_has_signature()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+@functools.lru_cache(maxsize=None)
+def _hasher(n_features, input_type):
+    # FeatureHasher is stateless, so instances are shared instead of being rebuilt for every sample
+    from sklearn.feature_extraction import FeatureHasher
+    return FeatureHasher(n_features, input_type=input_type)
 
 
 class FeatureType(object):
@@ -40,6 +72,12 @@ class FeatureType(object):
         ''' Generate a feature vector from the raw features '''
         raise (NotImplementedError)
 
+    def process_raw_features_sparse(self, raw_obj):
+        ''' Generate the feature vector as a (1, dim) scipy CSR matrix. Overridden by the mostly-zero hashed feature
+        types so they are never densified. '''
+        from scipy import sparse
+        return sparse.csr_matrix(self.process_raw_features(raw_obj))
+
     def feature_vector(self, bytez, lief_binary):
         ''' Directly calculate the feature vector from the sample itself. This should only be implemented differently
         if there are significant speedups to be gained from combining the two functions. '''
@@ -95,7 +133,7 @@ class ByteEntropyHistogram(FeatureType):
         return Hbin, c
 
     def raw_features(self, bytez, lief_binary):
-        output = np.zeros((16, 16), dtype=np.int)
+        output = np.zeros((16, 16), dtype=np.int64)
         a = np.frombuffer(bytez, dtype=np.uint8)
         if a.shape[0] < self.window:
             Hbin, c = self._entropy_bin_counts(a)
@@ -141,12 +179,16 @@ class SectionInfo(FeatureType):
 
         # properties of entry point, or if invalid, the first executable section
         try:
-            entry_section = lief_binary.section_from_offset(lief_binary.entrypoint).name
-        except lief.not_found:
+            section = lief_binary.section_from_offset(lief_binary.entrypoint)
+        except getattr(lief, 'not_found', ()):  # lief 0.10 and later return None instead
+            section = None
+        if section is not None:
+            entry_section = section.name
+        else:
             # bad entry point, let's find the first executable section
             entry_section = ""
             for s in lief_binary.sections:
-                if lief.PE.SECTION_CHARACTERISTICS.MEM_EXECUTE in s.characteristics_lists:
+                if 'MEM_EXECUTE' in self._properties(s):
                     entry_section = s.name
                     break
 
@@ -160,7 +202,8 @@ class SectionInfo(FeatureType):
         } for s in lief_binary.sections]
         return raw_obj
 
-    def process_raw_features(self, raw_obj):
+    def process_raw_features_sparse(self, raw_obj):
+        from scipy import sparse
         sections = raw_obj['sections']
         general = [
             len(sections),  # total number of sections
@@ -175,19 +218,23 @@ class SectionInfo(FeatureType):
         ]
         # gross characteristics of each section
         section_sizes = [(s['name'], s['size']) for s in sections]
-        section_sizes_hashed = FeatureHasher(50, input_type="pair").transform([section_sizes]).toarray()[0]
+        section_sizes_hashed = _hasher(50, "pair").transform([section_sizes])
         section_entropy = [(s['name'], s['entropy']) for s in sections]
-        section_entropy_hashed = FeatureHasher(50, input_type="pair").transform([section_entropy]).toarray()[0]
+        section_entropy_hashed = _hasher(50, "pair").transform([section_entropy])
         section_vsize = [(s['name'], s['vsize']) for s in sections]
-        section_vsize_hashed = FeatureHasher(50, input_type="pair").transform([section_vsize]).toarray()[0]
-        entry_name_hashed = FeatureHasher(50, input_type="string").transform([raw_obj['entry']]).toarray()[0]
+        section_vsize_hashed = _hasher(50, "pair").transform([section_vsize])
+        # Hashed per character, as older sklearn versions did when given the plain string
+        entry_name_hashed = _hasher(50, "string").transform([list(raw_obj['entry'])])
         characteristics = [p for s in sections for p in s['props'] if s['name'] == raw_obj['entry']]
-        characteristics_hashed = FeatureHasher(50, input_type="string").transform([characteristics]).toarray()[0]
+        characteristics_hashed = _hasher(50, "string").transform([characteristics])
 
-        return np.hstack([
-            general, section_sizes_hashed, section_entropy_hashed, section_vsize_hashed, entry_name_hashed,
-            characteristics_hashed
-        ]).astype(np.float32)
+        return sparse.hstack([
+            sparse.csr_matrix([general]), section_sizes_hashed, section_entropy_hashed, section_vsize_hashed,
+            entry_name_hashed, characteristics_hashed
+        ], format='csr', dtype=np.float32)
+
+    def process_raw_features(self, raw_obj):
+        return self.process_raw_features_sparse(raw_obj).toarray()[0]
 
 
 class ImportsInfo(FeatureType):
@@ -221,17 +268,22 @@ class ImportsInfo(FeatureType):
 
         return imports
 
-    def process_raw_features(self, raw_obj):
+    def process_raw_features_sparse(self, raw_obj):
+        from scipy import sparse
+
         # unique libraries
         libraries = list(set([l.lower() for l in raw_obj.keys()]))
-        libraries_hashed = FeatureHasher(256, input_type="string").transform([libraries]).toarray()[0]
+        libraries_hashed = _hasher(256, "string").transform([libraries])
 
         # A string like "kernel32.dll:CreateFileMappingA" for each imported function
         imports = [lib.lower() + ':' + e for lib, elist in raw_obj.items() for e in elist]
-        imports_hashed = FeatureHasher(1024, input_type="string").transform([imports]).toarray()[0]
+        imports_hashed = _hasher(1024, "string").transform([imports])
 
         # Two separate elements: libraries (alone) and fully-qualified names of imported functions
-        return np.hstack([libraries_hashed, imports_hashed]).astype(np.float32)
+        return sparse.hstack([libraries_hashed, imports_hashed], format='csr', dtype=np.float32)
+
+    def process_raw_features(self, raw_obj):
+        return self.process_raw_features_sparse(raw_obj).toarray()[0]
 
 
 class ExportsInfo(FeatureType):
@@ -251,7 +303,7 @@ class ExportsInfo(FeatureType):
 
         # Clipping assumes there are diminishing returns on the discriminatory power of exports beyond
         #  the first 10000 characters, and this will help limit the dataset size
-        if LIEF_EXPORT_OBJECT:
+        if _lief_export_object():
             # export is an object with .name attribute (0.10.0 and later)
             clipped_exports = [export.name[:10000] for export in lief_binary.exported_functions]
         else:
@@ -261,9 +313,11 @@ class ExportsInfo(FeatureType):
 
         return clipped_exports
 
+    def process_raw_features_sparse(self, raw_obj):
+        return _hasher(128, "string").transform([raw_obj]).astype(np.float32).tocsr()
+
     def process_raw_features(self, raw_obj):
-        exports_hashed = FeatureHasher(128, input_type="string").transform([raw_obj]).toarray()[0]
-        return exports_hashed.astype(np.float32)
+        return self.process_raw_features_sparse(raw_obj).toarray()[0]
 
 
 class GeneralFileInfo(FeatureType):
@@ -298,7 +352,7 @@ class GeneralFileInfo(FeatureType):
             'imports': len(lief_binary.imported_functions),
             'has_relocations': int(lief_binary.has_relocations),
             'has_resources': int(lief_binary.has_resources),
-            'has_signature': int(lief_binary.has_signatures) if LIEF_HAS_SIGNATURE else int(lief_binary.has_signature),
+            'has_signature': int(lief_binary.has_signatures) if _lief_has_signature() else int(lief_binary.has_signature),
             'has_tls': int(lief_binary.has_tls),
             'symbols': len(lief_binary.symbols),
         }
@@ -369,11 +423,11 @@ class HeaderFileInfo(FeatureType):
     def process_raw_features(self, raw_obj):
         return np.hstack([
             raw_obj['coff']['timestamp'],
-            FeatureHasher(10, input_type="string").transform([[raw_obj['coff']['machine']]]).toarray()[0],
-            FeatureHasher(10, input_type="string").transform([raw_obj['coff']['characteristics']]).toarray()[0],
-            FeatureHasher(10, input_type="string").transform([[raw_obj['optional']['subsystem']]]).toarray()[0],
-            FeatureHasher(10, input_type="string").transform([raw_obj['optional']['dll_characteristics']]).toarray()[0],
-            FeatureHasher(10, input_type="string").transform([[raw_obj['optional']['magic']]]).toarray()[0],
+            _hasher(10, "string").transform([[raw_obj['coff']['machine']]]).toarray()[0],
+            _hasher(10, "string").transform([raw_obj['coff']['characteristics']]).toarray()[0],
+            _hasher(10, "string").transform([[raw_obj['optional']['subsystem']]]).toarray()[0],
+            _hasher(10, "string").transform([raw_obj['optional']['dll_characteristics']]).toarray()[0],
+            _hasher(10, "string").transform([[raw_obj['optional']['magic']]]).toarray()[0],
             raw_obj['optional']['major_image_version'],
             raw_obj['optional']['minor_image_version'],
             raw_obj['optional']['major_linker_version'],
@@ -484,20 +538,62 @@ class DataDirectories(FeatureType):
         return features
 
 
+# Feature types in feature vector order, feature version 2 appends DataDirectories
+FEATURE_TYPES = [
+    ByteHistogram,
+    ByteEntropyHistogram,
+    StringExtractor,
+    GeneralFileInfo,
+    HeaderFileInfo,
+    SectionInfo,
+    ImportsInfo,
+    ExportsInfo
+]
+
+# Feature types computed from the lief parse, the others only read the raw bytes
+LIEF_BLOCKS = ('general', 'header', 'section', 'imports', 'exports', 'datadirectories')
+
+# Feature types made up (almost) entirely of hashed buckets that are overwhelmingly zero, stored as sparse matrices
+SPARSE_BLOCKS = ('section', 'imports', 'exports')
+
+
+def feature_blocks(feature_version=2):
+    ''' Returns a dict, in feature vector order, of feature type name to its (start, stop) columns. '''
+    types = FEATURE_TYPES + ([DataDirectories] if feature_version == 2 else [])
+    blocks = {}
+    start = 0
+    for fe in types:
+        blocks[fe.name] = (start, start + fe.dim)
+        start += fe.dim
+    return blocks
+
+
+def block_columns(blocks, feature_version=2):
+    ''' Returns the column indices of the named blocks, in feature vector order, see feature_blocks. '''
+    layout = feature_blocks(feature_version)
+    unknown = set(blocks) - set(layout)
+    if unknown:
+        raise ValueError(f"Unknown feature blocks {sorted(unknown)}, expected some of {list(layout)}")
+    return np.concatenate([np.arange(*layout[name]) for name in layout if name in blocks])
+
+
+def sparse_columns(feature_version=2):
+    ''' Returns the (start, stop) columns spanned by SPARSE_BLOCKS, which are adjacent. '''
+    blocks = feature_blocks(feature_version)
+    return blocks[SPARSE_BLOCKS[0]][0], blocks[SPARSE_BLOCKS[-1]][1]
+
+
+def lief_errors():
+    ''' Returns the exception types lief raises on malformed files, lief 0.10 and later no longer have all of them. '''
+    names = ('bad_format', 'bad_file', 'pe_error', 'parser_error', 'read_out_of_bound')
+    return tuple(getattr(lief, name) for name in names if hasattr(lief, name)) + (RuntimeError,)
+
+
 class PEFeatureExtractor(object):
     ''' Extract useful features from a PE file, and return as a vector of fixed size. '''
 
     def __init__(self, feature_version=2, print_feature_warning=True):
-        self.features = [
-            ByteHistogram(),
-            ByteEntropyHistogram(),
-            StringExtractor(),
-            GeneralFileInfo(),
-            HeaderFileInfo(),
-            SectionInfo(),
-            ImportsInfo(),
-            ExportsInfo()
-        ]
+        self.features = [fe() for fe in FEATURE_TYPES]
         if feature_version == 1:
             if not lief.__version__.startswith("0.8.3"):
                 if print_feature_warning:
@@ -516,11 +612,9 @@ class PEFeatureExtractor(object):
         self.dim = sum([fe.dim for fe in self.features])
 
     def raw_features(self, bytez):
-        lief_errors = (lief.bad_format, lief.bad_file, lief.pe_error, lief.parser_error, lief.read_out_of_bound,
-                       RuntimeError)
         try:
             lief_binary = lief.PE.parse(list(bytez))
-        except lief_errors as e:
+        except lief_errors() as e:
             print("lief error: ", str(e))
             lief_binary = None
         except Exception:  # everything else (KeyboardInterrupt, SystemExit, ValueError):
@@ -534,5 +628,11 @@ class PEFeatureExtractor(object):
         feature_vectors = [fe.process_raw_features(raw_obj[fe.name]) for fe in self.features]
         return np.hstack(feature_vectors).astype(np.float32)
 
+    def process_raw_features_sparse(self, raw_obj):
+        ''' Returns the feature vector as a (1, dim) scipy CSR matrix, see SPARSE_BLOCKS. '''
+        from scipy import sparse
+        feature_vectors = [fe.process_raw_features_sparse(raw_obj[fe.name]) for fe in self.features]
+        return sparse.hstack(feature_vectors, format='csr', dtype=np.float32)
+
     def feature_vector(self, bytez):
         return self.process_raw_features(self.raw_features(bytez))
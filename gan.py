@@ -1,15 +1,13 @@
-import keras.models
 import numpy as np
-import matplotlib.pyplot as plt
 import os
+import threading
 import time
-import tensorflow as tf
-from keras import Input
-from keras.models import Sequential
-from keras.layers import BatchNormalization, Concatenate, Dense, Dropout, ELU, Normalization
-from keras.losses import BinaryCrossentropy
-from keras.metrics import BinaryAccuracy, FalseNegatives, FalsePositives, TrueNegatives, TruePositives
-from sklearn.manifold import LocallyLinearEmbedding, SpectralEmbedding
+
+from lazy import lazy_import, lazy_tf_function
+
+# TensorFlow and Keras are only imported on first use, see lazy.py
+tf = lazy_import('tensorflow')
+keras = lazy_import('keras')
 
 # ------------------------------------- MODELS AND DATASET SETUP -------------------------------------
 
@@ -20,96 +18,221 @@ feat_size = 2381  # From EMBER feature digest, DO NOT CHANGE!
 
 g_unbatched_feats = None
 
-def prepare_datasets():
+def to_sparse_tensor(csr):
+    """ Converts a scipy sparse matrix to a tf.sparse.SparseTensor. """
+    coo = csr.tocoo()
+    indices = np.stack([coo.row, coo.col], axis=1).astype(np.int64)
+    return tf.sparse.reorder(tf.sparse.SparseTensor(indices, coo.data.astype(np.float32), coo.shape))
+
+
+def join_sparse_blocks(dense, sparse):
+    """
+    Returns the full feature vectors of a batch of (dense blocks, sparse blocks), as yielded by
+    prepare_datasets(sparse=True).
+
+    :param dense: Tensor of the columns outside features.sparse_columns().
+    :param sparse: tf.sparse.SparseTensor of the columns within.
+    """
+    import features
+
+    start, _ = features.sparse_columns()
+    return tf.concat([dense[:, :start], tf.sparse.to_dense(sparse), dense[:, start:]], axis=1)
+
+
+def prepare_datasets(train_path="dataset/train_set.npz", test_path="dataset/test_set.npz", batch_size=None,
+                     shuffle_buffer_size=None, sparse=False, blocks=None, stratified=False, malware_ratio=None,
+                     seed=0):
+    """
+    Loads the numpy feature sets written by setup.save_npz, or feature stores written by setup.save_feature_store, into
+    batched tf.data datasets.
+
+    :param train_path: Path of the training set.
+    :param test_path: Path of the test set.
+    :param batch_size: Batch size, defaults to BATCH_SIZE.
+    :param shuffle_buffer_size: Shuffle buffer size of the training set, defaults to SHUFFLE_BUFFER_SIZE.
+    :param sparse: Keeps the hashed blocks of the training set as a sparse matrix and yields training features as
+                   (dense blocks, tf.sparse.SparseTensor of the hashed blocks) pairs, for discriminators built with
+                   sparse_input=True (see discriminate). The test set stays dense.
+    :param blocks: Names of the feature blocks to load (see features.feature_blocks), all of them by default. Only
+                   discriminators can be trained on a block subset, the generator edits full feature vectors.
+    :param stratified: Draws training batches with sampling.StratifiedBatchSampler instead of a shuffle buffer, so
+                       every batch holds the same number of malware samples and the generator a constant batch size.
+    :param malware_ratio: Fraction of malware in stratified batches, defaults to the fraction in the training set.
+    :param seed: Seed of stratified sampling.
+
+    Memory-mapped feature sets (see feature_store.write_mmap) are read batch by batch rather than copied into memory,
+    so concurrent processes training on one share it through the page cache. This doesn't apply to stratified or
+    sparse batches.
+    """
+    import feature_store
+    import setup
+
     global g_unbatched_feats
-    with np.load("dataset/train_set.npz") as train_data:
-        train_features = train_data["features"]
+    if sparse and blocks is not None:
+        raise ValueError('Sparse datasets always hold all feature blocks')
+    if sparse and stratified:
+        raise ValueError('Stratified sampling needs dense features')
+    batch_size = batch_size or BATCH_SIZE
+    shuffle_buffer_size = shuffle_buffer_size or SHUFFLE_BUFFER_SIZE
+    if sparse:
+        train_labels, (dense, block) = setup.load_npz(train_path, sparse=True)
+        # The LLE layer of the resistant discriminator is fitted on a dense sample
+        g_unbatched_feats = setup.join_blocks(dense[:2000], block[:2000])
+        train_features = (dense, to_sparse_tensor(block))
+    else:
+        train_labels, train_features = feature_store.load(train_path, blocks)
         g_unbatched_feats = train_features
-        train_labels = train_data["labels"]
+    if stratified:
+        from sampling import StratifiedBatchSampler
+        train_dataset = StratifiedBatchSampler(train_labels, batch_size, malware_ratio, seed).dataset(train_features,
+                                                                                                    train_labels)
+    elif isinstance(train_features, np.memmap):
+        train_dataset = memmap_dataset(train_features, train_labels, batch_size, shuffle_buffer_size)
+    else:
         train_dataset = tf.data.Dataset.from_tensor_slices((train_features, train_labels))
-    train_dataset = train_dataset.shuffle(SHUFFLE_BUFFER_SIZE).batch(BATCH_SIZE)
+        train_dataset = train_dataset.shuffle(shuffle_buffer_size).batch(batch_size)
 
-    with np.load("dataset/test_set.npz") as test_data:
-        test_features = test_data["features"]
-        test_labels = test_data["labels"]
-        test_dataset = tf.data.Dataset.from_tensor_slices((test_features, test_labels))
+    test_labels, test_features = feature_store.load(test_path, blocks)
+    if isinstance(test_features, np.memmap):
+        return train_dataset, memmap_dataset(test_features, test_labels, batch_size)
+    test_dataset = tf.data.Dataset.from_tensor_slices((test_features, test_labels))
 
-    test_dataset = test_dataset.batch(BATCH_SIZE)
+    test_dataset = test_dataset.batch(batch_size)
     return train_dataset, test_dataset
 
 
-def make_generator_model():
-    model = Sequential([
-        Dense(512, activation='linear'),
-        ELU(),
-        Dropout(0.05),
-        Dense(512, activation='sigmoid'),
-        Dropout(0.05),
+def memmap_dataset(features, labels, batch_size, shuffle_buffer_size=None):
+    """
+    Returns a batched tf.data dataset of a memory-mapped feature matrix, which only reads the rows of every batch.
+    Rows are shuffled like Dataset.shuffle would, by shuffling their indices.
+
+    :param features: Memory-mapped feature matrix.
+    :param labels: Array of labels, one per row.
+    :param batch_size: Batch size.
+    :param shuffle_buffer_size: Shuffle buffer size, no shuffling if None.
+    """
+    labels = tf.constant(labels)
+
+    def read(indices):
+        return np.asarray(features[indices], dtype=np.float32)
+
+    def batch(indices):
+        batch_features = tf.numpy_function(read, [indices], tf.float32, stateful=False)
+        batch_features.set_shape([None, features.shape[1]])
+        return batch_features, tf.gather(labels, indices)
+
+    indices = tf.data.Dataset.range(len(features))
+    if shuffle_buffer_size:
+        indices = indices.shuffle(shuffle_buffer_size)
+    return indices.batch(batch_size).map(batch).prefetch(tf.data.AUTOTUNE)
+
+
+def prepare_validation_dataset(path="dataset/validation_set.npz", batch_size=None, blocks=None):
+    """
+    Loads a numpy feature set written by setup.save_npz, or a feature store, into a batched tf.data dataset for
+    validation during training.
+
+    :param path: Path of the validation set.
+    :param batch_size: Batch size, defaults to BATCH_SIZE.
+    :param blocks: Names of the feature blocks to load, all of them by default. See prepare_datasets.
+    """
+    import feature_store
+
+    labels, features = feature_store.load(path, blocks)
+    if isinstance(features, np.memmap):
+        return memmap_dataset(features, labels, batch_size or BATCH_SIZE)
+    return tf.data.Dataset.from_tensor_slices((features, labels)).batch(batch_size or BATCH_SIZE)
+
+
+GENERATOR_WIDTHS = (512, 512)
+DISCRIMINATOR_WIDTHS = (512, 512, 128)
+DROPOUT = 0.05
+
+
+def make_generator_model(widths=GENERATOR_WIDTHS, dropout=DROPOUT):
+    """
+    Builds the generator.
+
+    :param widths: Units of the hidden layers, the first with an ELU activation and the others sigmoid.
+    :param dropout: Dropout rate after every hidden layer.
+    """
+    from keras.layers import Dense, Dropout, ELU
+    from keras.models import Sequential
+
+    hidden_layers = [Dense(widths[0], activation='linear'), ELU(), Dropout(dropout)]
+    for width in widths[1:]:
+        hidden_layers += [Dense(width, activation='sigmoid'), Dropout(dropout)]
+    model = Sequential(hidden_layers + [
         Dense(feat_size, activation='linear')
     ])
     return model
 
 
-def make_simple_discriminator_model():
-    model = Sequential([
-        Dense(512, activation='linear'),
-        Normalization(),
-        ELU(),
-        Dropout(0.05),
-        Dense(512, activation='linear'),
-        Normalization(),
-        ELU(),
-        Dropout(0.05),
-        Dense(128, activation='linear'),
-        Normalization(),
-        ELU(),
-        Dropout(0.05),
-        Dense(1, activation='sigmoid')
-    ])
+def _discriminator_layers(widths, dropout, first_layer=None):
+    # Dense, Normalization, ELU and Dropout per hidden layer, then the sigmoid output
+    from keras.layers import Dense, Dropout, ELU, Normalization
+
+    hidden_layers = []
+    for i, width in enumerate(widths):
+        dense = first_layer if i == 0 and first_layer is not None else Dense(width, activation='linear')
+        hidden_layers += [dense, Normalization(), ELU(), Dropout(dropout)]
+    return hidden_layers + [Dense(1, activation='sigmoid')]
+
+
+def make_simple_discriminator_model(sparse_input=False, widths=DISCRIMINATOR_WIDTHS, dropout=DROPOUT):
+    """
+    Builds the simple discriminator.
+
+    :param sparse_input: Uses a layers.BlockSparseDense first layer, so (dense blocks, sparse blocks) batches (see
+                         prepare_datasets) can be trained on with discriminate. Dense batches still work.
+    :param widths: Units of the hidden layers.
+    :param dropout: Dropout rate after every hidden layer.
+    """
+    from keras.models import Sequential
+
+    if sparse_input:
+        from layers import BlockSparseDense
+        model = Sequential([keras.Input(shape=(feat_size,))] +
+                           _discriminator_layers(widths, dropout, BlockSparseDense(widths[0], activation='linear')))
+    else:
+        model = Sequential(_discriminator_layers(widths, dropout))
     return model
 
 
-class SKLearnLLE(keras.layers.Layer):
-    classifier = None
-
-    def __init__(self, output_dim, **kwargs):
-        self.output_dim = output_dim
-        super().__init__(**kwargs)
-        self.trainable = False
-        self.classifier = LocallyLinearEmbedding(n_neighbors=10, n_components=output_dim)
-        self.classifier.fit(g_unbatched_feats[:2000])
-        print("LLE Trained")
-
-    def build(self, input_shape):
-        self.built = True
-
-    def call(self, x):
-        # Eager execution must be enabled
-        inp = x.numpy()
-        out = self.classifier.fit_transform(inp)
-        return tf.convert_to_tensor(out)
-
-    def compute_output_shape(self, input_shape):
-        return input_shape[0], self.output_dim
-
-
-def make_resistant_discriminator_model():
-    model = Sequential([
-        SKLearnLLE(512),
-        Dense(512, activation='linear'),
-        Normalization(),
-        ELU(),
-        Dropout(0.05),
-        Dense(512, activation='linear'),
-        Normalization(),
-        ELU(),
-        Dropout(0.05),
-        Dense(128, activation='linear'),
-        Normalization(),
-        ELU(),
-        Dropout(0.05),
-        Dense(1, activation='sigmoid')
-    ])
+def discriminate(discriminator, features, training=False):
+    """
+    Returns a discriminator's predictions on a batch of feature vectors, or of (dense blocks, sparse blocks) pairs as
+    yielded by prepare_datasets(sparse=True). Sequential models only take a single input tensor, so pairs are run
+    through the layers one by one, the first being a layers.BlockSparseDense.
+    """
+    if not isinstance(features, tuple):
+        return discriminator(features, training=training)
+    for layer in discriminator.layers:
+        features = layer(features, training=training)
+    return features
+
+
+def make_resistant_discriminator_model(embedding_path=None, widths=DISCRIMINATOR_WIDTHS, dropout=DROPOUT):
+    """
+    Builds the resistant discriminator, which classifies an LLE embedding of the features.
+
+    :param embedding_path: Optional embedding saved by manifold.py, used instead of fitting SKLearnLLE on the first
+                           2000 training samples: either the fitted embedding (.npz) or its distilled Keras model.
+    :param widths: Units of the hidden layers after the embedding.
+    :param dropout: Dropout rate after every hidden layer.
+    """
+    from keras.models import Sequential
+    from layers import SKLearnLLE
+
+    if embedding_path is None:
+        embedding = SKLearnLLE(512, g_unbatched_feats[:2000])
+    elif embedding_path.endswith('.npz'):
+        embedding = SKLearnLLE(512, embedding=embedding_path)
+    else:
+        embedding = keras.models.load_model(embedding_path)
+        embedding.trainable = False
+
+    model = Sequential([embedding] + _discriminator_layers(widths, dropout))
     return model
 
 
@@ -119,9 +242,26 @@ def save_model(model, name):
     model.save(path)
 
 
+def load_model(path):
+    """ Loads a model saved by save_model, including discriminators built with the custom layers of layers.py. """
+    import layers  # noqa: F401, registers the custom layers with Keras
+    return keras.models.load_model(path)
+
+
 # ------------------------------------------ LOSS FUNCTIONS ------------------------------------------
 
-cross_entropy = BinaryCrossentropy(from_logits=False)
+LEARNING_RATE = 1e-4
+
+_cross_entropy = None
+_optimizers = {}
+_learning_rates = {}
+
+
+def get_cross_entropy():
+    global _cross_entropy
+    if _cross_entropy is None:
+        _cross_entropy = tf.keras.losses.BinaryCrossentropy(from_logits=False)
+    return _cross_entropy
 
 
 def discriminator_bb_loss(y_hat, d_theta):
@@ -132,7 +272,7 @@ def discriminator_bb_loss(y_hat, d_theta):
 
 
 def discriminator_loss(y_true, y_pred):
-    loss = cross_entropy(y_true, y_pred)
+    loss = get_cross_entropy()(y_true, y_pred)
     return loss
 
 
@@ -140,11 +280,47 @@ def generator_loss(y_pred):
     # Assumes that all samples generated by the generator are malware, loss is proportional to
     # how many predictions on generated examples were labeled as benign.
     y_true = tf.zeros_like(y_pred)
-    return cross_entropy(y_true, y_pred)
+    return get_cross_entropy()(y_true, y_pred)
 
 
-generator_optimizer = tf.keras.optimizers.Adam(1e-4)
-discriminator_optimizer = tf.keras.optimizers.Adam(1e-4)
+def get_optimizer(name):
+    """
+    Returns the shared Adam optimizer of the generator or discriminator, creating it on first use.
+
+    :param name: Either 'generator' or 'discriminator'.
+    """
+    if name not in _optimizers:
+        _optimizers[name] = tf.keras.optimizers.Adam(_learning_rates.get(name, LEARNING_RATE))
+    return _optimizers[name]
+
+
+def set_learning_rate(name, learning_rate):
+    """
+    Sets the learning rate of the generator or discriminator optimizer. Takes effect when the optimizer is next
+    created, so call it before training (or after reset_optimizers).
+
+    :param name: Either 'generator' or 'discriminator'.
+    :param learning_rate: Learning rate, or a keras LearningRateSchedule, see validation.make_learning_rate.
+    """
+    _learning_rates[name] = learning_rate
+    _optimizers.pop(name, None)
+
+
+def reset_optimizers():
+    """ Discards the shared optimizers and their state, e.g. before training an unrelated model in the same process. """
+    _optimizers.clear()
+
+
+def __getattr__(name):
+    # Keeps the objects that used to be module globals reachable without building them at import time
+    if name == 'cross_entropy':
+        return get_cross_entropy()
+    if name in ('generator_optimizer', 'discriminator_optimizer'):
+        return get_optimizer(name[:-len('_optimizer')])
+    if name == 'SKLearnLLE':
+        from layers import SKLearnLLE
+        return SKLearnLLE
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # --------------------------------------- TRAINING AND TESTING ---------------------------------------
 
@@ -152,18 +328,31 @@ EPOCHS = 30
 noise_dim = 100
 
 
+def generator_noise_dim(generator):
+    """
+    Returns the length of a generator's noise input, which differs from noise_dim for generators trained with
+    another one (see runner.py). A generator that isn't built yet takes noise_dim.
+    """
+    if not generator.built:
+        return noise_dim
+    return generator.input_shape[-1] - feat_size
+
+
 #@tf.function
-def discriminator_train_step(samples, discriminator):
+def discriminator_train_step(samples, discriminator, return_grad_norms=False):
     features = samples[0]
     labels = samples[1]
 
     with tf.GradientTape() as disc_tape:
-        pred = discriminator(features, training=True)
+        pred = discriminate(discriminator, features, training=True)
         disc_loss = discriminator_loss(labels, pred)
 
     gradients_of_discriminator = disc_tape.gradient(disc_loss, discriminator.trainable_variables)
-    discriminator_optimizer.apply_gradients(zip(gradients_of_discriminator, discriminator.trainable_variables))
+    get_optimizer('discriminator').apply_gradients(zip(gradients_of_discriminator,
+                                                       discriminator.trainable_variables))
 
+    if return_grad_norms:
+        return disc_loss, {'discriminator': tf.linalg.global_norm(gradients_of_discriminator)}
     return disc_loss
 
 
@@ -173,19 +362,19 @@ def discriminator_test_step(samples, discriminator):
 
     pred = discriminator(features, training=False)
 
-    ba_m = BinaryAccuracy()
+    ba_m = keras.metrics.BinaryAccuracy()
     ba_m.update_state(labels, pred)
     accuracy = ba_m.result().numpy()
 
-    tp_m = TruePositives()
+    tp_m = keras.metrics.TruePositives()
     tp_m.update_state(labels, pred)
     true_positives = tp_m.result().numpy()
 
-    tn_m = TrueNegatives()
+    tn_m = keras.metrics.TrueNegatives()
     tn_m.update_state(labels, pred)
     true_negatives = tn_m.result().numpy()
 
-    fp_m = FalsePositives()
+    fp_m = keras.metrics.FalsePositives()
     fp_m.update_state(labels, pred)
     false_positives = fp_m.result().numpy()
     if (false_positives + true_negatives) == 0:
@@ -193,7 +382,7 @@ def discriminator_test_step(samples, discriminator):
     else:
         false_positive_r = false_positives / (false_positives + true_negatives)
 
-    fn_m = FalseNegatives()
+    fn_m = keras.metrics.FalseNegatives()
     fn_m.update_state(labels, pred)
     false_negatives = fn_m.result().numpy()
     if (false_negatives + true_positives) == 0:
@@ -213,7 +402,7 @@ def gan_test_step(samples, discriminator, generator):
     benign_i = tf.squeeze(tf.where(labels == 0))
     benign_feats = tf.reshape(tf.cast(tf.gather(features, benign_i), tf.float32), [-1, feat_size])
 
-    noise = tf.random.normal([tf.size(malware_i), noise_dim], dtype=tf.float32)
+    noise = tf.random.normal([tf.size(malware_i), generator_noise_dim(generator)], dtype=tf.float32)
     generator_input = tf.concat([malware_feats, noise], axis=1)
 
     gen_output = generator(generator_input, training=False)
@@ -222,20 +411,20 @@ def gan_test_step(samples, discriminator, generator):
     benign_pred = discriminator(benign_feats, training=False)
     obscured_pred = discriminator(obscured_feats, training=False)
 
-    ba_m = BinaryAccuracy()
+    ba_m = keras.metrics.BinaryAccuracy()
     ba_m.update_state(tf.zeros_like(benign_pred), benign_pred)
     ba_m.update_state(tf.ones_like(obscured_pred), obscured_pred)
     accuracy = ba_m.result().numpy()
 
-    tp_m = TruePositives()
+    tp_m = keras.metrics.TruePositives()
     tp_m.update_state(tf.ones_like(obscured_pred), obscured_pred)
     true_positives = tp_m.result().numpy()
 
-    tn_m = TrueNegatives()
+    tn_m = keras.metrics.TrueNegatives()
     tn_m.update_state(tf.zeros_like(benign_pred), benign_pred)
     true_negatives = tn_m.result().numpy()
 
-    fp_m = FalsePositives()
+    fp_m = keras.metrics.FalsePositives()
     fp_m.update_state(tf.zeros_like(benign_pred), benign_pred)
     false_positives = fp_m.result().numpy()
     if (false_positives + true_negatives) == 0:
@@ -243,7 +432,7 @@ def gan_test_step(samples, discriminator, generator):
     else:
         false_positive_r = false_positives / (false_positives + true_negatives)
 
-    fn_m = FalseNegatives()
+    fn_m = keras.metrics.FalseNegatives()
     fn_m.update_state(tf.ones_like(obscured_pred), obscured_pred)
     false_negatives = fn_m.result().numpy()
     if (false_negatives + true_positives) == 0:
@@ -254,8 +443,8 @@ def gan_test_step(samples, discriminator, generator):
     return accuracy, false_positive_r, false_negative_r
 
 
-@tf.function(experimental_relax_shapes=True)
-def edit_features(features: tf.Tensor, generator_output: tf.Tensor):
+@lazy_tf_function(experimental_relax_shapes=True)
+def edit_features(features: 'tf.Tensor', generator_output: 'tf.Tensor'):
     assert features.get_shape()[1] == feat_size and generator_output.get_shape()[1] == feat_size
     assert features.get_shape()[0] == generator_output.get_shape()[0]
 
@@ -293,13 +482,16 @@ def edit_features(features: tf.Tensor, generator_output: tf.Tensor):
 
 
 # @tf.function
-def gan_train_step(samples, discriminator, generator, black_box=None):
+def gan_train_step(samples, discriminator, generator, black_box=None, return_grad_norms=False):
     features = samples[0]
     labels = samples[1]
+    if isinstance(features, tuple):
+        # The generator edits full feature vectors
+        features = join_sparse_blocks(*features)
 
     malware_i = tf.squeeze(tf.where(labels))
     malware_feats = tf.reshape(tf.cast(tf.gather(features, malware_i), tf.float32), [-1, feat_size])
-    noise = tf.random.normal([tf.size(malware_i), noise_dim], dtype=tf.float32)
+    noise = tf.random.normal([tf.size(malware_i), generator_noise_dim(generator)], dtype=tf.float32)
     generator_input = tf.concat([malware_feats, noise], axis=1)
     with tf.GradientTape() as gen_tape, tf.GradientTape() as disc_tape:
         generator_output = generator(generator_input, training=True)
@@ -313,43 +505,348 @@ def gan_train_step(samples, discriminator, generator, black_box=None):
             obscured_pred = discriminator(obscured_features, training=True)
             disc_loss = discriminator_loss(labels, pred) + \
                         discriminator_loss(tf.ones_like(obscured_pred), obscured_pred)
+            d_theta = obscured_pred
         gen_loss = generator_loss(d_theta)
 
     gradients_of_generator = gen_tape.gradient(gen_loss, generator.trainable_variables)
     gradients_of_discriminator = disc_tape.gradient(disc_loss, discriminator.trainable_variables)
-    generator_optimizer.apply_gradients(zip(gradients_of_generator, generator.trainable_variables))
-    discriminator_optimizer.apply_gradients(zip(gradients_of_discriminator, discriminator.trainable_variables))
+    get_optimizer('generator').apply_gradients(zip(gradients_of_generator, generator.trainable_variables))
+    get_optimizer('discriminator').apply_gradients(zip(gradients_of_discriminator,
+                                                       discriminator.trainable_variables))
+
+    if return_grad_norms:
+        return gen_loss, {'generator': tf.linalg.global_norm(gradients_of_generator),
+                          'discriminator': tf.linalg.global_norm(gradients_of_discriminator)}
+    return gen_loss
+
+
+def generator_train_step(malware_feats, discriminator, generator, return_grad_norms=False):
+    """
+    Trains the generator alone to make the (fixed) discriminator label the malware it obscures benign.
+
+    :param malware_feats: Batch of malware feature vectors.
+    :param discriminator: Discriminator the generator is trained to evade.
+    :param generator: Generator model to train.
+    :param return_grad_norms: Also return the global norm of the gradients.
+    """
+    noise = tf.random.normal([tf.shape(malware_feats)[0], generator_noise_dim(generator)], dtype=tf.float32)
+    with tf.GradientTape() as gen_tape:
+        generator_output = generator(tf.concat([malware_feats, noise], axis=1), training=True)
+        obscured_features = edit_features(malware_feats, generator_output)
+        gen_loss = generator_loss(discriminator(obscured_features, training=False))
+
+    gradients_of_generator = gen_tape.gradient(gen_loss, generator.trainable_variables)
+    get_optimizer('generator').apply_gradients(zip(gradients_of_generator, generator.trainable_variables))
 
+    if return_grad_norms:
+        return gen_loss, {'generator': tf.linalg.global_norm(gradients_of_generator)}
     return gen_loss
 
 
-def train(dataset, epochs, discriminator, generator=None, black_box=None):
-    checkpoint_dir = './training_checkpoints'
-    checkpoint_prefix = os.path.join(checkpoint_dir, "ckpt")
+class ObscuredRingBuffer(object):
+    """ Fixed-size ring buffer of the most recently generated obscured malware feature vectors, thread safe. """
+
+    def __init__(self, capacity, seed=0):
+        """
+        :param capacity: Number of feature vectors kept.
+        :param seed: Seed of sampling.
+        """
+        self.capacity = capacity
+        self._rows = np.zeros((capacity, feat_size), dtype=np.float32)
+        self._size = 0
+        self._next = 0
+        self._rng = np.random.default_rng(seed)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._size
+
+    def add(self, rows):
+        """ Adds feature vectors, replacing the oldest ones once full. """
+        rows = np.asarray(rows, dtype=np.float32)[-self.capacity:]
+        with self._lock:
+            self._rows[(self._next + np.arange(len(rows))) % self.capacity] = rows
+            self._next = (self._next + len(rows)) % self.capacity
+            self._size = min(self.capacity, self._size + len(rows))
+
+    def sample(self, n):
+        """ Returns n feature vectors drawn uniformly with replacement, or None while the buffer is empty. """
+        with self._lock:
+            if not self._size:
+                return None
+            return self._rows[self._rng.integers(0, self._size, n)]
+
+
+class AdversarialTraining(object):
+    """
+    Trains a discriminator on batches mixed with malware obscured by a generator that is trained against it at the
+    same time, see train.
+
+    Every step, the generator is trained on the malware of the batch in a background thread while the discriminator is
+    trained on the batch, so neither update waits for the other; both are done when step returns. The generator is
+    trained against a private copy of the discriminator, never reading weights the discriminator's optimizer is
+    updating. Every refresh_every steps, the copy gets the discriminator's current weights, and the malware seen since
+    the last refresh is obscured by the current generator into a ring buffer, from which adversarial_ratio of every
+    discriminator batch is drawn, labeled malware. The buffer isn't checkpointed, a resumed run refills it at its
+    first refresh.
+    """
+
+    def __init__(self, discriminator, generator, refresh_every=10, adversarial_ratio=0.25, buffer_size=None, seed=0):
+        """
+        :param discriminator: Discriminator model to train.
+        :param generator: Generator model trained alongside it.
+        :param refresh_every: Number of steps between refreshes of the obscured malware and the discriminator copy.
+        :param adversarial_ratio: Fraction of every discriminator batch drawn from the obscured malware, in [0, 1).
+        :param buffer_size: Number of obscured feature vectors kept, defaults to 16 batches of BATCH_SIZE.
+        :param seed: Seed of sampling from the buffer.
+        """
+        if not 0 <= adversarial_ratio < 1:
+            raise ValueError(f'adversarial_ratio must be in [0, 1), not {adversarial_ratio}')
+        self.discriminator = discriminator
+        self.generator = generator
+        self.refresh_every = refresh_every
+        self.adversarial_ratio = adversarial_ratio
+        self.buffer = ObscuredRingBuffer(buffer_size or 16 * BATCH_SIZE, seed)
+        self.steps = 0
+        self._refreshed_at = 0
+        self._discriminator_copy = None  # What the generator is trained against
+        self._pending = []  # Malware seen since the last refresh
+        self._pending_rows = 0
+        self._executor = None
+        # Created here rather than on first use from two threads at once
+        get_optimizer('generator')
+        get_optimizer('discriminator')
+
+    def _copy_discriminator(self):
+        if not self.discriminator.built:
+            self.discriminator.build([None, feat_size])
+        copy = keras.models.clone_model(self.discriminator)
+        copy.build([None, feat_size])
+        copy.set_weights(self.discriminator.get_weights())
+        return copy
+
+    def refresh(self, discriminator_weights=None):
+        """
+        Obscures the malware seen since the last refresh with the current generator, into the buffer, then gives the
+        discriminator copy the given weights.
+
+        :param discriminator_weights: Weights of the discriminator, read while it isn't being updated.
+        """
+        if self._pending:
+            malware_feats = tf.concat(self._pending, axis=0)
+            self._pending, self._pending_rows = [], 0
+            noise_shape = [tf.shape(malware_feats)[0], generator_noise_dim(self.generator)]
+            noise = tf.random.normal(noise_shape, dtype=tf.float32)
+            generator_output = self.generator(tf.concat([malware_feats, noise], axis=1), training=False)
+            self.buffer.add(edit_features(malware_feats, generator_output).numpy())
+        if discriminator_weights is not None:
+            self._discriminator_copy.set_weights(discriminator_weights)
+
+    def _generator_job(self, malware_feats, return_grad_norms):
+        result = generator_train_step(malware_feats, self._discriminator_copy, self.generator, return_grad_norms)
+        if self._pending_rows < self.buffer.capacity:
+            self._pending.append(malware_feats)
+            self._pending_rows += int(malware_feats.shape[0])
+        return result
+
+    def step(self, samples, return_grad_norms=False):
+        """
+        One training step of the discriminator and the generator on a batch, returns the discriminator loss (and the
+        gradient norms of both models if return_grad_norms).
+        """
+        import concurrent.futures
+
+        features = samples[0]
+        labels = samples[1]
+        if isinstance(features, tuple):
+            raise ValueError('Adversarial training needs dense feature batches')
+
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='generator')
+            self._discriminator_copy = self._copy_discriminator()
+        self.steps += 1
+        # Background jobs run in order on one thread, and the previous step's are done, so nothing is updating the
+        # discriminator while its weights are read for the copy
+        futures = []
+        if self.steps - self._refreshed_at >= self.refresh_every:
+            self._refreshed_at = self.steps
+            futures.append(self._executor.submit(self.refresh, self.discriminator.get_weights()))
+        malware_i = tf.squeeze(tf.where(labels))
+        malware_feats = tf.reshape(tf.cast(tf.gather(features, malware_i), tf.float32), [-1, feat_size])
+        generator_future = None
+        if malware_feats.shape[0]:
+            generator_future = self._executor.submit(self._generator_job, malware_feats, return_grad_norms)
+            futures.append(generator_future)
+
+        batch_size = int(labels.shape[0])
+        obscured = self.buffer.sample(int(round(batch_size * self.adversarial_ratio / (1 - self.adversarial_ratio))))
+        if obscured is not None and len(obscured):
+            features = tf.concat([tf.cast(features, tf.float32), obscured], axis=0)
+            labels = tf.concat([labels, tf.ones([len(obscured)], dtype=labels.dtype)], axis=0)
+        result = discriminator_train_step((features, labels), self.discriminator, return_grad_norms)
+
+        for future in futures:
+            future.result()
+        generator_result = generator_future.result() if generator_future is not None else None
+        if return_grad_norms:
+            disc_loss, grad_norms = result
+            if generator_result is not None:
+                grad_norms = dict(grad_norms, **generator_result[1])
+            return disc_loss, grad_norms
+        return result
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+def train(dataset, epochs, discriminator, generator=None, black_box=None, checkpoint_dir='./training_checkpoints',
+          resume=False, on_epoch_end=None, checkpoint_every_steps=None, checkpoint_every_secs=None,
+          max_checkpoints=3, keep_best=0, metric_fn=None, metric_mode='min', telemetry=None, validation=None,
+          validation_metric='fnr_at_fpr', early_stopping_patience=None, lr_plateau_patience=None, adversarial=None):
+    """
+    Trains the discriminator alone, or the generator against a discriminator (and optionally a black-box model), or
+    both adversarially.
+
+    :param dataset: Batched training dataset.
+    :param epochs: Total number of epochs, including those already completed when resuming.
+    :param discriminator: Discriminator model to train.
+    :param generator: Generator model, trains a GAN when given.
+    :param black_box: Black-box discriminator the generator is trained to evade.
+    :param checkpoint_dir: Directory to write checkpoints to.
+    :param resume: Restores the latest checkpoint in checkpoint_dir, including the position within the epoch.
+    :param on_epoch_end: Optional callable receiving the epoch number and a dict of epoch statistics. Returning True
+                         stops training, e.g. to prune a hyperparameter sweep trial.
+    :param checkpoint_every_steps: Also checkpoint every N training steps.
+    :param checkpoint_every_secs: Also checkpoint every T seconds.
+    :param max_checkpoints: Number of most recent checkpoints to retain.
+    :param keep_best: Number of best checkpoints by metric_fn to retain.
+    :param metric_fn: Optional callable evaluated after every epoch returning a validation metric.
+    :param metric_mode: 'min' if lower metric_fn values are better, 'max' otherwise.
+    :param telemetry: Optional telemetry.TrainingTelemetry recording per-step timings and gradient norms.
+    :param validation: Optional validation.Validator run after every epoch. Its metrics are added to the epoch
+                       statistics and, when metric_fn isn't given, ranked for keep_best.
+    :param validation_metric: Validation metric used for keep_best, early stopping and plateau detection, compared
+                              according to metric_mode.
+    :param early_stopping_patience: Stop after this many validations without improvement, None to disable.
+    :param lr_plateau_patience: Halve the learning rates after this many validations without improvement.
+    :param adversarial: Optional AdversarialTraining of the discriminator, whose generator is then checkpointed too.
+    """
+    from checkpoints import CheckpointSaver
+    from validation import EarlyStopping, ReduceLROnPlateau
+
+    if adversarial is not None:
+        generator = adversarial.generator
+    step = tf.Variable(0, dtype=tf.int64, trainable=False)
+    completed_epochs = tf.Variable(0, dtype=tf.int64, trainable=False)
     if generator is None:
-        checkpoint = tf.train.Checkpoint(discriminator_optimizer=discriminator_optimizer,
-                                         discriminator=discriminator)
+        checkpoint = tf.train.Checkpoint(discriminator_optimizer=get_optimizer('discriminator'),
+                                         discriminator=discriminator,
+                                         epoch=completed_epochs,
+                                         step=step)
     else:
-        checkpoint = tf.train.Checkpoint(generator_optimizer=generator_optimizer,
-                                         discriminator_optimizer=discriminator_optimizer,
+        checkpoint = tf.train.Checkpoint(generator_optimizer=get_optimizer('generator'),
+                                         discriminator_optimizer=get_optimizer('discriminator'),
                                          generator=generator,
-                                         discriminator=discriminator)
-
-    for epoch in range(epochs):
+                                         discriminator=discriminator,
+                                         epoch=completed_epochs,
+                                         step=step)
+    # The input pipeline iterator is checkpointed too, so a resumed run continues mid-epoch where it stopped
+    input_checkpoint = tf.train.Checkpoint(iterator=iter(dataset))
+    saver = CheckpointSaver(checkpoint, checkpoint_dir, step, every_n_steps=checkpoint_every_steps,
+                            every_n_secs=checkpoint_every_secs, max_to_keep=max_checkpoints, keep_best=keep_best,
+                            mode=metric_mode, input_checkpoint=input_checkpoint)
+
+    latest = saver.restore_latest() if resume else None
+    if latest is not None:
+        print(f'Resuming from {latest} at epoch #{int(completed_epochs.numpy()) + 1}, step {int(step.numpy())}')
+
+    early_stopping = None
+    lr_on_plateau = None
+    if validation is not None and early_stopping_patience is not None:
+        early_stopping = EarlyStopping(validation_metric, metric_mode, early_stopping_patience)
+    if validation is not None and lr_plateau_patience is not None:
+        optimizers = [get_optimizer('discriminator')] + ([get_optimizer('generator')] if generator is not None else [])
+        lr_on_plateau = ReduceLROnPlateau(optimizers, validation_metric, metric_mode, patience=lr_plateau_patience)
+
+    for epoch in range(int(completed_epochs.numpy()), epochs):
         start = time.time()
         loss = np.inf
-        for batch in dataset:
-            if generator is None:
-                loss = discriminator_train_step(batch, discriminator)
+        examples = 0
+        iterator = input_checkpoint.iterator
+        while True:
+            wait_start = time.perf_counter()
+            batch = next(iterator, None)
+            if batch is None:
+                break
+            step_start = time.perf_counter()
+            if adversarial is not None:
+                result = adversarial.step(batch, return_grad_norms=telemetry is not None)
+            elif generator is None:
+                result = discriminator_train_step(batch, discriminator, return_grad_norms=telemetry is not None)
             else:
-                loss = gan_train_step(batch, discriminator, generator, black_box)
-
-
-        # Save the model every 15 epochs
-        if (epoch + 1) % 15 == 0:
-            checkpoint.save(file_prefix=checkpoint_prefix)
+                result = gan_train_step(batch, discriminator, generator, black_box,
+                                        return_grad_norms=telemetry is not None)
+            batch_size = int(batch[1].shape[0])
+            examples += batch_size
+            step.assign_add(1)
+            if telemetry is not None:
+                loss, grad_norms = result
+                # float() waits for the step to finish, so the timing covers the actual computation
+                loss = float(loss)
+                telemetry.record_step(int(step.numpy()), step_start - wait_start, time.perf_counter() - step_start,
+                                      batch_size, loss, grad_norms)
+            else:
+                loss = result
+            saver.maybe_save()
+
+        completed_epochs.assign(epoch + 1)
+        input_checkpoint.iterator = iter(dataset)
+        # Save the model every 15 epochs, and at the end of training so finished runs can be resumed/cached
+        if (epoch + 1) % 15 == 0 or epoch + 1 == epochs:
+            saver.save()
+        if metric_fn is not None:
+            saver.record_metric(metric_fn())
+
+        stop = False
+        validation_metrics = None
+        if validation is not None:
+            # Validation of this epoch runs in the background while the next one trains, so decisions are based on
+            # the previous epoch's results. Ranking checkpoints needs the metrics of the current state, so it waits,
+            # as does the last epoch, whose metrics would otherwise never be recorded.
+            validation.submit(epoch + 1)
+            validation_metrics = validation.poll(wait=(bool(keep_best) and metric_fn is None) or epoch + 1 == epochs)
+            if validation_metrics is not None:
+                if metric_fn is None and validation_metrics['epoch'] == epoch + 1:
+                    saver.record_metric(validation_metrics[validation_metric])
+                if lr_on_plateau is not None:
+                    lr_on_plateau.update(validation_metrics)
+                if early_stopping is not None and early_stopping.update(validation_metrics):
+                    print(f'Early stopping: {validation_metric} has not improved since epoch '
+                          f'#{early_stopping.best_epoch} ({early_stopping.best})')
+                    stop = True
+
+        elapsed = time.time() - start
+        print(f'Epoch #{epoch + 1} - Time:{elapsed}, Loss: {loss}')
+        stats = {'time': elapsed, 'loss': float(loss), 'examples': examples,
+                 'examples_per_sec': examples / elapsed if elapsed > 0 else 0.0}
+        if telemetry is not None:
+            stats.update(telemetry.end_epoch(epoch + 1))
+        if validation_metrics is not None:
+            stats['validation'] = validation_metrics
+        if on_epoch_end is not None and on_epoch_end(epoch + 1, stats):
+            stop = True
+        if stop:
+            saver.save()
+            break
 
-        print(f'Epoch #{epoch + 1} - Time:{(time.time() - start)}, Loss: {loss}')
+    if validation is not None:
+        validation.close()
+    if adversarial is not None:
+        adversarial.close()
+    # Make sure background writes have finished before returning
+    saver.sync()
 
 
 def test(dataset, discriminator, generator=None):
@@ -375,73 +872,10 @@ def test(dataset, discriminator, generator=None):
     print(f'Accuracy: {(avg_acc * 100)}%, '
           f'False Positive Rate {(avg_fp_r * 100)}%, '
           f'False Negative Rate {(avg_fn_r * 100)}%')
+    return {'accuracy': float(avg_acc), 'fpr': float(avg_fp_r), 'fnr': float(avg_fn_r)}
 
 
 if __name__ == "__main__":
-    train_dataset, test_dataset = prepare_datasets()
-    while True:
-        user_in = input('Select mode:')
-
-        if user_in == "Simple Discriminator":
-
-            if os.path.exists("./models/simple_disc.model"):
-                print("Found model, loading...")
-                disc = keras.models.load_model("./models/simple_disc.model")
-            else:
-                print("Training new model...")
-                disc = make_simple_discriminator_model()
-                train(train_dataset, EPOCHS, disc)
-                save_model(disc, "simple_disc.model")
-            print("Testing...")
-            test(test_dataset, disc)
-            break
-        elif user_in == "Simple GAN":
-            if os.path.exists("./models/simple_disc.model"):
-                print("Found black-box model, loading...")
-                disc_bb = keras.models.load_model("./models/simple_disc.model")
-                if os.path.exists("./models/simple_generator.model"):
-                    print("Found generator model, loading...")
-                    gen = keras.models.load_model("./models/simple_generator.model")
-                else:
-                    print("Training generator...")
-                    disc = make_simple_discriminator_model()
-                    disc.build([None, feat_size])
-                    gen = make_generator_model()
-                    train(train_dataset, EPOCHS, disc, gen, disc_bb)
-                    save_model(gen, "simple_generator.model")
-                print("Testing...")
-                test(test_dataset, disc_bb, gen)
-                break
-            else:
-                print("Please train a black-box model first using \"Simple Discriminator\".")
-        elif user_in == "Resistant Discriminator":
-            if os.path.exists("./models/resistant_disc.model"):
-                print("Found model, CANNOT LOAD B/C OF LLE LAYER!")
-            #     disc = tf.saved_model.load("./models/resistant_disc.model") LOADING MODEL DOESN'T WORK
-            else:
-                print("Training new model...")
-                disc = make_resistant_discriminator_model()
-                train(train_dataset, EPOCHS, disc)
-            #     tf.saved_model.save(disc, "./models/resistant_disc.model") SAVING MODEL DOESN'T WORK
-            print("Testing...")
-            test(test_dataset, disc)
-            break
-        elif user_in == "Resistant GAN":
-            # First train Resistant Discriminator
-            print("Training Resistant Discriminator...")
-            resistant_disc = make_resistant_discriminator_model()
-            train(train_dataset, EPOCHS, resistant_disc)
-            print("Testing Resistant Discriminator...")
-            test(test_dataset, resistant_disc)
-            # Now run adversarial Attack
-            print("Training Generator...")
-            disc = make_simple_discriminator_model()
-            disc.build([None, feat_size])
-            gen = make_generator_model()
-            train(train_dataset, 15, disc, gen, resistant_disc)
-            print("Testing...")
-            test(test_dataset, resistant_disc, gen)
-            break
-        else:
-            print("Valid selections are: \"Simple Discriminator\", \"Simple GAN\", \"Resistant Discriminator\", "
-                  "and \"Resistant GAN\"")
+    # Experiments are run through runner.py, e.g. "python gan.py --mode simple_disc"
+    import runner
+    runner.main()
@@ -0,0 +1,146 @@
+"""
+Custom Keras layers used by the discriminators in gan.py. Kept separate from gan.py because defining them requires
+importing Keras.
+"""
+import keras
+import tensorflow as tf
+
+
+@keras.utils.register_keras_serializable(package='gan')
+class SKLearnLLE(keras.layers.Layer):
+    """
+    Locally linear embedding of the input features. Samples are embedded as the reconstruction-weighted sum of the
+    coordinates of their nearest reference points, computed with TensorFlow ops. The reference points and their
+    coordinates are stored as non-trainable weights, so the layer is saved with the model and loads without refitting.
+    """
+
+    def __init__(self, output_dim, fit_features=None, embedding=None, n_neighbors=10, reg=1e-3, n_reference=None,
+                 input_dim=None, **kwargs):
+        """
+        :param output_dim: Dimension of the embedding.
+        :param fit_features: Samples to fit an exact LLE on, they become the reference points.
+        :param embedding: Fitted manifold.ManifoldEmbedding, or the path of one saved by manifold.py, instead of
+                          fit_features.
+        :param n_neighbors: Number of reference points samples are reconstructed from.
+        :param reg: Regularization of the reconstruction weights.
+        :param n_reference: Number of reference points, only needed when restoring from a config.
+        :param input_dim: Feature dimension, only needed when restoring from a config.
+        """
+        super().__init__(**kwargs)
+        self.output_dim = output_dim
+        self.n_neighbors = n_neighbors
+        self.reg = reg
+        self.trainable = False
+        self._fitted = None
+
+        if fit_features is not None or embedding is not None:
+            import manifold
+            if isinstance(embedding, str):
+                embedding = manifold.ManifoldEmbedding.load(embedding)
+            elif embedding is None:
+                embedding = manifold.ManifoldEmbedding(output_dim, n_neighbors, n_landmarks=None, reg=reg,
+                                                       eigen_solver='dense', projection_dim=None).fit(fit_features)
+                print("LLE Trained")
+            if embedding.n_components != output_dim:
+                raise ValueError(f'Embedding has {embedding.n_components} components, expected {output_dim}')
+            self.n_neighbors = embedding.n_neighbors if embedding.n_landmarks is None else embedding.landmark_neighbors
+            self.reg = embedding.reg
+            self._fitted = (embedding.reference_, embedding.embedding_)
+            n_reference, input_dim = embedding.reference_.shape
+        elif n_reference is None or input_dim is None:
+            raise ValueError('SKLearnLLE needs fit_features, embedding, or n_reference and input_dim')
+        self.n_reference = int(n_reference)
+        self.input_dim = int(input_dim)
+
+    def build(self, input_shape):
+        reference, embedding = self._fitted if self._fitted is not None else (None, None)
+        self.reference = self.add_weight(
+            name='reference', shape=(self.n_reference, self.input_dim), trainable=False,
+            initializer=keras.initializers.Constant(reference) if reference is not None else 'zeros')
+        self.embedding = self.add_weight(
+            name='embedding', shape=(self.n_reference, self.output_dim), trainable=False,
+            initializer=keras.initializers.Constant(embedding) if embedding is not None else 'zeros')
+        self._fitted = None
+        super().build(input_shape)
+
+    def call(self, x):
+        x = tf.cast(x, self.reference.dtype)
+        distances = tf.reduce_sum(tf.square(x), axis=1, keepdims=True) \
+            - 2 * tf.matmul(x, self.reference, transpose_b=True) \
+            + tf.reduce_sum(tf.square(self.reference), axis=1)[tf.newaxis, :]
+        _, neighbors = tf.math.top_k(-distances, k=self.n_neighbors)
+
+        # Weights reconstructing every sample from its neighbors, see manifold.barycenter_weights
+        z = tf.gather(self.reference, neighbors) - x[:, tf.newaxis, :]
+        gram = tf.matmul(z, z, transpose_b=True)
+        trace = tf.linalg.trace(gram)
+        gram += (tf.where(trace > 0, self.reg * trace, self.reg))[:, tf.newaxis, tf.newaxis] * tf.eye(self.n_neighbors)
+        weights = tf.linalg.solve(gram, tf.ones([tf.shape(x)[0], self.n_neighbors, 1]))
+        weights /= tf.reduce_sum(weights, axis=1, keepdims=True)
+        return tf.reduce_sum(weights * tf.gather(self.embedding, neighbors), axis=1)
+
+    def compute_output_shape(self, input_shape):
+        return input_shape[0], self.output_dim
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({'output_dim': self.output_dim, 'n_neighbors': self.n_neighbors, 'reg': self.reg,
+                       'n_reference': self.n_reference, 'input_dim': self.input_dim})
+        return config
+
+
+def _sparse_kernel_matmul(sparse, kernel):
+    # tf.sparse.sparse_dense_matmul whose gradient only flows to the kernel. The op's own gradient also computes one
+    # for the sparse values, by gathering a row of the upstream gradient and of the kernel per nonzero, which takes
+    # longer than the whole dense matmul it replaces.
+    @tf.custom_gradient
+    def matmul(kernel):
+        def grad(upstream):
+            return tf.sparse.sparse_dense_matmul(sparse, upstream, adjoint_a=True)
+        return tf.sparse.sparse_dense_matmul(sparse, kernel), grad
+
+    return matmul(kernel)
+
+
+@keras.utils.register_keras_serializable(package='gan')
+class BlockSparseDense(keras.layers.Dense):
+    """
+    Dense layer that also takes feature batches split into (dense blocks, sparse blocks), as yielded by
+    gan.prepare_datasets(sparse=True): the columns outside the hashed blocks (features.SPARSE_BLOCKS) as a dense tensor
+    and the mostly zero hashed blocks as a tf.sparse.SparseTensor. The dense blocks are multiplied with their kernel rows
+    by a dense matmul and only the hashed blocks by a sparse-dense matmul, so the full feature vectors are never built.
+    Full dense feature vectors are multiplied as in keras.layers.Dense.
+    """
+
+    def __init__(self, units, sparse_columns=None, **kwargs):
+        """
+        :param units: Output dimension.
+        :param sparse_columns: (start, stop) columns of the hashed blocks, defaults to features.sparse_columns().
+        """
+        super().__init__(units, **kwargs)
+        if sparse_columns is None:
+            import features
+            sparse_columns = features.sparse_columns()
+        self.sparse_columns = tuple(int(c) for c in sparse_columns)
+
+    def build(self, input_shape):
+        super().build(input_shape)
+        # Dense's input spec only matches full feature vectors, not (dense blocks, sparse blocks) pairs
+        self.input_spec = None
+
+    def call(self, inputs):
+        if not isinstance(inputs, (tuple, list)):
+            return super().call(inputs)
+        dense, sparse = inputs
+        start, stop = self.sparse_columns
+        # Split rather than gathered or sliced, so the kernel gradient is one concat of the three parts' gradients
+        before, within, after = tf.split(self.kernel, [start, stop - start, self.kernel.shape[0] - stop])
+        outputs = tf.matmul(dense, tf.concat([before, after], axis=0)) + _sparse_kernel_matmul(sparse, within)
+        if self.use_bias:
+            outputs = tf.nn.bias_add(outputs, self.bias)
+        return self.activation(outputs) if self.activation is not None else outputs
+
+    def get_config(self):
+        config = super().get_config()
+        config['sparse_columns'] = list(self.sparse_columns)
+        return config
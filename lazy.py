@@ -0,0 +1,56 @@
+"""
+Helpers for deferring heavy imports (TensorFlow, Keras, sklearn, lief, ...) until they are first used, so that tools
+which only need a small helper from gan.py, setup.py or features.py start quickly.
+"""
+import functools
+import importlib
+import types
+
+
+class LazyModule(types.ModuleType):
+    """ Module placeholder that imports the real module on first attribute access. """
+
+    def __init__(self, name):
+        super(LazyModule, self).__init__(name)
+
+    def _load(self):
+        module = importlib.import_module(self.__name__)
+        # Copy the attributes over so subsequent lookups no longer go through __getattr__
+        self.__dict__.update(module.__dict__)
+        return module
+
+    def __getattr__(self, item):
+        return getattr(self._load(), item)
+
+    def __dir__(self):
+        return dir(self._load())
+
+
+def lazy_import(name):
+    """
+    Returns a placeholder for the named module which is only imported once one of its attributes is accessed.
+
+    :param name: Fully qualified module name, e.g. 'tensorflow'.
+    """
+    return LazyModule(name)
+
+
+def lazy_tf_function(**tf_function_kwargs):
+    """
+    Decorator equivalent to tf.function(**tf_function_kwargs), except the function is only wrapped (and TensorFlow
+    only imported) on its first call.
+    """
+    def decorator(python_function):
+        compiled = []
+
+        @functools.wraps(python_function)
+        def wrapper(*args, **kwargs):
+            if not compiled:
+                import tensorflow as tf
+                compiled.append(tf.function(python_function, **tf_function_kwargs))
+            return compiled[0](*args, **kwargs)
+
+        wrapper.python_function = python_function
+        return wrapper
+
+    return decorator
@@ -0,0 +1,216 @@
+"""
+Writes feature vectors to a features LMDB in the SOREL-20M format read by dataset.LMDBReader: zlib-compressed msgpack
+of [vector], keyed by the ascii sha256, in a single-file (subdir=False) environment.
+
+LMDBWriter takes (sha256, vector) records as extraction produces them. Records are encoded and compressed in a thread
+pool (zlib releases the GIL) while a writer thread commits them in large write transactions, growing the map size
+whenever it fills up. Records can carry a meta.db row, which is upserted by sha256 once the features it points to are
+committed, so meta.db never lists samples without features.
+
+Usage:
+    python lmdb_writer.py raw_features.jsonl dataset/ember_features/data.mdb --meta-db dataset/ember_features/meta.db
+"""
+import argparse
+import concurrent.futures
+import functools
+import json
+import queue
+import sqlite3
+import threading
+import zlib
+
+import numpy as np
+
+_STOP = object()
+
+
+def encode(vector, level=6):
+    """ Returns the LMDB value of a feature vector, as dataset.LMDBReader decodes it. """
+    import msgpack
+    return zlib.compress(msgpack.dumps([np.asarray(vector, dtype=np.float32).tolist()]), level)
+
+
+class LMDBWriter(object):
+    """
+    Asynchronous batched writer of feature vectors to a features LMDB, see the module docstring. Errors in the
+    background are raised by the next call to put, flush or close.
+    """
+
+    def __init__(self, path, meta_db_path=None, workers=4, batch_size=1000, map_size=1 << 30, compression_level=6,
+                 max_pending=None, encoder=None):
+        """
+        :param path: Path of the LMDB file, created if missing.
+        :param meta_db_path: Path of meta.db to upsert the meta rows of records into.
+        :param workers: Number of encoding threads.
+        :param batch_size: Number of records per write transaction.
+        :param map_size: Initial map size in bytes, doubled whenever it fills up.
+        :param compression_level: zlib compression level.
+        :param max_pending: Number of records encoded or waiting to be written before put blocks, 4 batches by default.
+        :param encoder: Function of a vector returning its LMDB value, encode at compression_level by default. See
+                        feature_codec.encode for compact records.
+        """
+        import lmdb
+        self._lmdb = lmdb
+        self.env = lmdb.open(path, map_size=map_size, subdir=False)
+        self.meta_db_path = meta_db_path
+        self.batch_size = batch_size
+        self.compression_level = compression_level
+        self.encoder = encoder or functools.partial(encode, level=compression_level)
+        self.written = 0
+        self._pool = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix='lmdb-encode')
+        self._pending = queue.Queue(max_pending or 4 * batch_size)
+        self._error = None
+        self._writer = threading.Thread(target=self._write_loop, name='lmdb-writer', daemon=True)
+        self._writer.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _check(self):
+        if self._error is not None:
+            raise RuntimeError('LMDB writer failed') from self._error
+
+    def put(self, sha256, vector, meta=None):
+        """
+        Queues a record for writing, replacing any record with the same sha256.
+
+        :param sha256: Hex sha256 of the sample.
+        :param vector: Raw feature vector (before dataset.features_postproc_func).
+        :param meta: Optional dict of meta.db columns to upsert for the sample.
+        """
+        self._check()
+        future = self._pool.submit(self.encoder, vector)
+        self._pending.put((sha256.encode('ascii'), future, meta))
+
+    def write(self, records):
+        """
+        Queues every record of an iterable of (sha256, vector) or (sha256, vector, meta) tuples, see put.
+
+        :param records: The records.
+        """
+        for record in records:
+            self.put(*record)
+
+    def flush(self):
+        """ Blocks until every queued record is committed. """
+        self._check()
+        done = threading.Event()
+        self._pending.put((None, None, done))
+        while not done.wait(0.1):
+            if not self._writer.is_alive():
+                break
+        self._check()
+
+    def close(self):
+        """ Commits the queued records and closes the environment. """
+        if self._writer.is_alive():
+            self._pending.put(_STOP)
+            self._writer.join()
+        self._pool.shutdown()
+        self.env.close()
+        self._check()
+
+    def _write_loop(self):
+        batch = []
+        try:
+            while True:
+                item = self._pending.get()
+                stop = item is _STOP
+                flush = not stop and item[0] is None
+                if not stop and not flush:
+                    batch.append(item)
+                if batch and (stop or flush or len(batch) >= self.batch_size):
+                    self._commit(batch)
+                    batch = []
+                if flush:
+                    item[2].set()
+                if stop:
+                    return
+        except BaseException as e:
+            self._error = e
+            # Unblocks producers waiting on a full queue
+            while True:
+                try:
+                    item = self._pending.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not _STOP and item[0] is None:
+                    item[2].set()
+
+    def _commit(self, batch):
+        records = [(key, future.result()) for key, future, _ in batch]
+        while True:
+            try:
+                with self.env.begin(write=True) as txn:
+                    for key, value in records:
+                        txn.put(key, value)
+                break
+            except self._lmdb.MapFullError:
+                # The transaction was aborted, retry it with a map twice as large
+                self.env.set_mapsize(self.env.info()['map_size'] * 2)
+        metas = [(key.decode('ascii'), meta) for key, _, meta in batch if meta]
+        if metas and self.meta_db_path:
+            upsert_meta(self.meta_db_path, metas)
+        self.written += len(records)
+
+
+def upsert_meta(meta_db_path, rows):
+    """
+    Updates the meta.db rows of the given samples, and inserts those missing, in one transaction.
+
+    :param meta_db_path: Path of meta.db.
+    :param rows: List of (sha256, dict of column to value).
+    """
+    con = sqlite3.connect(meta_db_path)
+    try:
+        with con:
+            # Looking rows up by sha256 scans the whole table without an index
+            indexed = any(con.execute(f'PRAGMA index_info("{index[1]}")').fetchone()[2] == 'sha256'
+                          for index in con.execute('PRAGMA index_list(meta)'))
+            if not indexed:
+                con.execute('CREATE INDEX meta_sha256 ON meta (sha256)')
+            for sha256, meta in rows:
+                meta = {k: v for k, v in meta.items() if k != 'sha256'}
+                columns = list(meta)
+                updated = con.execute(f'UPDATE meta SET {", ".join(f"{c} = ?" for c in columns)} WHERE sha256 = ?',
+                                      [meta[c] for c in columns] + [sha256]).rowcount if columns else 0
+                if not updated:
+                    con.execute(f'INSERT INTO meta (sha256{"".join(", " + c for c in columns)}) '
+                                f'VALUES ({", ".join("?" * (len(columns) + 1))})',
+                                [sha256] + [meta[c] for c in columns])
+    finally:
+        con.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write raw features (from extraction.py) to a features LMDB.")
+    parser.add_argument("raw_features", help="JSON lines file of raw features, as written by extraction.py.")
+    parser.add_argument("lmdb_path", help="LMDB file to write to, created if missing.")
+    parser.add_argument("--meta-db", help="meta.db to upsert rows into, with the --label given to every sample.")
+    parser.add_argument("--label", type=int, choices=(0, 1), help="is_malware of every sample.")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+    if args.meta_db and args.label is None:
+        parser.error('--meta-db requires --label')
+
+    import features
+    extractor = features.PEFeatureExtractor(print_feature_warning=False)
+
+    def records():
+        with open(args.raw_features) as f:
+            for line in f:
+                raw = json.loads(line)
+                meta = {'is_malware': args.label} if args.label is not None else {}
+                yield raw['sha256'], extractor.process_raw_features(raw), meta
+
+    with LMDBWriter(args.lmdb_path, args.meta_db, args.workers, args.batch_size) as writer:
+        writer.write(records())
+    print(f'Wrote {writer.written} records to {args.lmdb_path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,319 @@
+"""
+Scalable locally linear embedding (LLE) for the resistant discriminator.
+
+sklearn's LocallyLinearEmbedding builds an exact kNN graph and, for 512 components, ends up in a dense eigen-solve
+of an n x n matrix, which is why SKLearnLLE is only fitted on 2000 samples. Even sparse eigen-solvers (ARPACK) are
+slow at finding 512 eigenvectors. ManifoldEmbedding fits the embedding on far larger samples:
+
+- the kNN graph is approximate: candidates are found in a random projection of the features and re-ranked by their
+  exact distance, in chunks so memory stays bounded,
+- with Locally Linear Landmarks (Vladymyrov & Carreira-Perpinan, 2013) every sample is expressed as a reconstruction
+  from its nearest landmarks, a random subset of the samples, and the LLE cost over all samples is minimized over the
+  landmark coordinates only. The eigen-problem is then of size n_landmarks x n_landmarks regardless of n,
+- without landmarks, the bottom eigenvectors of the sparse n x n LLE matrix are found with ARPACK in shift-invert
+  mode.
+
+Fitted embeddings (only the reference points and their coordinates) are saved to an npz file. New samples are
+embedded with the out-of-sample LLE mapping, reconstruction weights over their nearest reference points, or with a
+Dense network distilled from it, which is much faster at inference.
+
+Usage:
+    python manifold.py dataset/train_set.npz --samples 20000 --out models/lle_embedding.npz \
+        --distill models/lle_distilled.model
+"""
+import argparse
+import time
+
+import numpy as np
+from scipy import sparse
+
+
+def _squared_distances(a, b, b_sq_norms=None):
+    if b_sq_norms is None:
+        b_sq_norms = np.einsum('ij,ij->i', b, b)
+    d = np.einsum('ij,ij->i', a, a)[:, None] - 2 * a @ b.T + b_sq_norms[None, :]
+    return np.maximum(d, 0, out=d)
+
+
+def nearest_neighbors(queries, reference, k, projection_dim=64, oversample=4, chunk_size=256, seed=0,
+                      exclude_self=False):
+    """
+    Returns the indices, shape (len(queries), k), of the approximate k nearest reference points of every query.
+
+    :param queries: Array of shape (n, d).
+    :param reference: Array of shape (m, d).
+    :param k: Number of neighbors.
+    :param projection_dim: Dimension of the random projection candidates are searched in, None for an exact search.
+    :param oversample: Number of candidates per neighbor re-ranked by their exact distance.
+    :param chunk_size: Number of queries processed at once.
+    :param seed: Seed of the random projection.
+    :param exclude_self: Queries are the reference points themselves and must not be their own neighbor.
+    """
+    k_search = k + 1 if exclude_self else k
+    project = projection_dim is not None and projection_dim < reference.shape[1]
+    if project:
+        rng = np.random.default_rng(seed)
+        projection = rng.standard_normal((reference.shape[1], projection_dim)).astype(np.float32)
+        projection /= np.sqrt(projection_dim)
+        search_reference = reference @ projection
+        n_candidates = min(k_search * oversample, len(reference))
+    else:
+        search_reference = reference
+        n_candidates = k_search
+    search_sq_norms = np.einsum('ij,ij->i', search_reference, search_reference)
+
+    indices = np.empty((len(queries), k), dtype=np.int64)
+    for start in range(0, len(queries), chunk_size):
+        chunk = queries[start:start + chunk_size]
+        search_chunk = chunk @ projection if project else chunk
+        d = _squared_distances(search_chunk, search_reference, search_sq_norms)
+        if exclude_self:
+            d[np.arange(len(chunk)), np.arange(start, start + len(chunk))] = np.inf
+        candidates = np.argpartition(d, n_candidates - 1, axis=1)[:, :n_candidates]
+        if project:
+            # Re-rank the candidates by their distance in the original space
+            diff = reference[candidates] - chunk[:, None, :]
+            d = np.einsum('ijk,ijk->ij', diff, diff)
+        else:
+            d = np.take_along_axis(d, candidates, axis=1)
+        order = np.argsort(d, axis=1)[:, :k]
+        indices[start:start + len(chunk)] = np.take_along_axis(candidates, order, axis=1)
+    return indices
+
+
+def barycenter_weights(queries, reference, neighbors, reg=1e-3, chunk_size=256):
+    """
+    Returns the weights, shape (len(queries), k), that best reconstruct every query from its neighbors.
+
+    :param queries: Array of shape (n, d).
+    :param reference: Array of shape (m, d).
+    :param neighbors: Neighbor indices into reference, shape (n, k).
+    :param reg: Regularization of the local Gram matrices, relative to their trace.
+    :param chunk_size: Number of queries processed at once.
+    """
+    n, k = neighbors.shape
+    weights = np.empty((n, k), dtype=np.float64)
+    ones = np.ones((k, 1))
+    for start in range(0, n, chunk_size):
+        z = reference[neighbors[start:start + chunk_size]] - queries[start:start + chunk_size, None, :]
+        gram = np.matmul(z, z.transpose(0, 2, 1)).astype(np.float64)
+        trace = np.trace(gram, axis1=1, axis2=2)
+        gram += (np.where(trace > 0, reg * trace, reg))[:, None, None] * np.eye(k)
+        w = np.linalg.solve(gram, np.broadcast_to(ones, (len(gram), k, 1)))[:, :, 0]
+        weights[start:start + chunk_size] = w / w.sum(axis=1, keepdims=True)
+    return weights
+
+
+def _bottom_eigenvectors(m, n_vectors, solver, tol, max_iter, seed, b=None):
+    # Smallest eigenpairs of m x = lambda b x (b = identity when None)
+    rng = np.random.default_rng(seed)
+    if solver == 'dense':
+        from scipy.linalg import eigh
+        m = m.toarray() if sparse.issparse(m) else m
+        return eigh(m, b, subset_by_index=[0, n_vectors - 1])
+    if solver != 'arpack':
+        raise ValueError(f'Unknown eigen solver {solver!r}')
+    from scipy.sparse.linalg import eigsh
+    v0 = rng.uniform(-1, 1, m.shape[0])
+    values, vectors = eigsh(m, n_vectors, b, sigma=0.0, tol=tol, maxiter=max_iter, v0=v0)
+    order = np.argsort(values)
+    return values[order], vectors[:, order]
+
+
+class ManifoldEmbedding(object):
+    """ Locally linear embedding fitted with an approximate kNN graph and landmarks or a sparse eigen-solver. """
+
+    def __init__(self, n_components=512, n_neighbors=10, n_landmarks=2000, landmark_neighbors=10, reg=1e-3,
+                 eigen_solver='dense', projection_dim=64, oversample=4, tol=1e-6, max_iter=None, seed=0):
+        """
+        :param n_components: Dimension of the embedding.
+        :param n_neighbors: Number of neighbors each sample is reconstructed from.
+        :param n_landmarks: Number of landmarks, None to solve the full n x n eigen-problem instead.
+        :param landmark_neighbors: Number of landmarks each sample is expressed by.
+        :param reg: Regularization of the reconstruction weights.
+        :param eigen_solver: 'dense' or 'arpack', 'dense' is only practical for the landmark eigen-problem.
+        :param projection_dim: Dimension of the random projection used to find kNN candidates, None for exact kNN.
+        :param oversample: Number of kNN candidates per neighbor re-ranked by their exact distance.
+        :param tol: ARPACK tolerance.
+        :param max_iter: Maximum ARPACK iterations, None for its default.
+        :param seed: Seed of the landmark selection, random projection and ARPACK start vector.
+        """
+        self.n_components = n_components
+        self.n_neighbors = n_neighbors
+        self.n_landmarks = n_landmarks
+        self.landmark_neighbors = landmark_neighbors
+        self.reg = reg
+        self.eigen_solver = eigen_solver
+        self.projection_dim = projection_dim
+        self.oversample = oversample
+        self.tol = tol
+        self.max_iter = max_iter
+        self.seed = seed
+        self.reference_ = None
+        self.embedding_ = None
+
+    def _neighbors(self, queries, reference, k, exclude_self=False):
+        return nearest_neighbors(queries, reference, k, self.projection_dim, self.oversample, seed=self.seed,
+                                 exclude_self=exclude_self)
+
+    def _reconstruction_matrix(self, queries, reference, k, exclude_self=False):
+        # Sparse (len(queries), len(reference)) matrix of the weights reconstructing queries from their neighbors
+        neighbors = self._neighbors(queries, reference, k, exclude_self)
+        weights = barycenter_weights(queries, reference, neighbors, self.reg)
+        rows = np.repeat(np.arange(len(queries)), k)
+        return sparse.csr_matrix((weights.ravel(), (rows, neighbors.ravel())), shape=(len(queries), len(reference)))
+
+    def fit_transform(self, features):
+        """
+        Fits the embedding of features and returns their coordinates. The landmarks (or all samples without
+        landmarks) are kept as reference points for transform.
+
+        :param features: Array of shape (n, d), n must exceed n_components.
+        """
+        features = np.ascontiguousarray(features, dtype=np.float32)
+        n = len(features)
+        n_landmarks = n if self.n_landmarks is None else min(self.n_landmarks, n)
+        if n_landmarks <= self.n_components:
+            raise ValueError(f'Need more than n_components={self.n_components} landmarks/samples to fit, '
+                             f'got {n_landmarks}')
+
+        w = self._reconstruction_matrix(features, features, self.n_neighbors, exclude_self=True)
+        i_minus_w = sparse.identity(n, format='csr') - w
+        m = (i_minus_w.T @ i_minus_w).tocsr()
+
+        # The bottom eigenvector is the constant vector with eigenvalue 0, it is discarded
+        if self.n_landmarks is None:
+            _, vectors = _bottom_eigenvectors(m, self.n_components + 1, self.eigen_solver, self.tol, self.max_iter,
+                                              self.seed)
+            self.reference_ = features
+            self.embedding_ = vectors[:, 1:].astype(np.float32)
+            return self.embedding_
+
+        rng = np.random.default_rng(self.seed)
+        landmarks = np.sort(rng.choice(n, n_landmarks, replace=False))
+        # Samples are expressed as Y = L Y_landmarks, landmarks are their own reconstruction
+        lmk = self._reconstruction_matrix(features, features[landmarks], self.landmark_neighbors).tolil()
+        lmk[landmarks] = sparse.identity(n_landmarks, format='lil')
+        lmk = lmk.tocsr()
+        # min tr(Y^T M Y) s.t. Y^T Y = I becomes a generalized eigen-problem in the landmark coordinates
+        a = (lmk.T @ (m @ lmk)).toarray()
+        b = (lmk.T @ lmk).toarray()
+        b += 1e-10 * np.trace(b) / n_landmarks * np.eye(n_landmarks)
+        _, vectors = _bottom_eigenvectors(a, self.n_components + 1, self.eigen_solver, self.tol, self.max_iter,
+                                          self.seed, b)
+        self.reference_ = features[landmarks]
+        self.embedding_ = vectors[:, 1:].astype(np.float32)
+        return (lmk @ self.embedding_).astype(np.float32)
+
+    def fit(self, features):
+        """ Fits the embedding of features, see fit_transform. """
+        self.fit_transform(features)
+        return self
+
+    def transform(self, features):
+        """
+        Embeds new samples as the reconstruction-weighted sum of the embeddings of their nearest reference points.
+
+        :param features: Array of shape (n, d).
+        """
+        if self.embedding_ is None:
+            raise RuntimeError('ManifoldEmbedding must be fitted or loaded before transform')
+        features = np.ascontiguousarray(features, dtype=np.float32)
+        k = self.n_neighbors if self.n_landmarks is None else self.landmark_neighbors
+        return (self._reconstruction_matrix(features, self.reference_, k) @ self.embedding_).astype(np.float32)
+
+    def save(self, path):
+        """ Saves the fitted embedding and its settings to an npz file. """
+        np.savez(path, reference=self.reference_, embedding=self.embedding_, n_neighbors=self.n_neighbors,
+                 n_landmarks=-1 if self.n_landmarks is None else self.n_landmarks,
+                 landmark_neighbors=self.landmark_neighbors, reg=self.reg,
+                 projection_dim=-1 if self.projection_dim is None else self.projection_dim,
+                 oversample=self.oversample, seed=self.seed)
+
+    @classmethod
+    def load(cls, path):
+        """ Loads an embedding saved by save. """
+        with np.load(path) as data:
+            projection_dim = int(data['projection_dim'])
+            n_landmarks = int(data['n_landmarks'])
+            embedding = cls(n_components=data['embedding'].shape[1], n_neighbors=int(data['n_neighbors']),
+                            n_landmarks=None if n_landmarks < 0 else n_landmarks,
+                            landmark_neighbors=int(data['landmark_neighbors']), reg=float(data['reg']),
+                            projection_dim=None if projection_dim < 0 else projection_dim,
+                            oversample=int(data['oversample']), seed=int(data['seed']))
+            embedding.reference_ = data['reference']
+            embedding.embedding_ = data['embedding']
+        return embedding
+
+
+def distill(embedding, features=None, hidden_units=1024, epochs=30, batch_size=256):
+    """
+    Trains a Dense network approximating embedding.transform, for fast inference. Returns the Keras model.
+
+    :param embedding: Fitted ManifoldEmbedding.
+    :param features: Samples to distill on besides the reference points, embedded with transform.
+    :param hidden_units: Width of the hidden layers.
+    :param epochs: Number of training epochs.
+    :param batch_size: Training batch size.
+    """
+    import tensorflow as tf
+    from keras.layers import Dense, ELU, Normalization, Rescaling
+    from keras.models import Sequential
+
+    x = embedding.reference_
+    y = embedding.embedding_
+    if features is not None:
+        x = np.concatenate([x, np.asarray(features, dtype=np.float32)])
+        y = np.concatenate([y, embedding.transform(features)])
+
+    # EMBER features span many orders of magnitude, standardize them before the Dense layers
+    normalization = Normalization()
+    normalization.adapt(x)
+    # LLE coordinates are orthonormal columns, so tiny, the last layer predicts them standardized instead
+    model = Sequential([
+        normalization,
+        Dense(hidden_units), ELU(),
+        Dense(hidden_units), ELU(),
+        Dense(embedding.n_components, activation='linear'),
+        Rescaling(float(y.std())),
+    ])
+    model.compile(optimizer=tf.keras.optimizers.Adam(1e-3), loss='mse')
+    model.fit(x, y, epochs=epochs, batch_size=batch_size, shuffle=True, verbose=2)
+    return model
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit the LLE embedding of the resistant discriminator.")
+    parser.add_argument("features", help="Numpy feature set written by setup.save_npz.")
+    parser.add_argument("--samples", type=int, default=20000, help="Number of samples to fit on.")
+    parser.add_argument("--components", type=int, default=512)
+    parser.add_argument("--neighbors", type=int, default=10)
+    parser.add_argument("--landmarks", type=int, default=2000, help="0 to solve the full eigen-problem with ARPACK.")
+    parser.add_argument("--solver", default="dense", choices=("arpack", "dense"))
+    parser.add_argument("--projection-dim", type=int, default=64, help="0 for an exact kNN graph.")
+    parser.add_argument("--out", required=True, help="Path of the npz file to save the embedding to.")
+    parser.add_argument("--distill", help="Also save a distilled Keras model of the embedding to this path.")
+    parser.add_argument("--distill-samples", type=int, default=0,
+                        help="Samples to distill on in addition to those fitted on.")
+    parser.add_argument("--distill-epochs", type=int, default=30)
+    args = parser.parse_args()
+
+    import setup
+    _, features = setup.load_npz(args.features)
+    fit_features = features[:args.samples]
+
+    start = time.time()
+    embedding = ManifoldEmbedding(args.components, args.neighbors, n_landmarks=args.landmarks or None,
+                                  eigen_solver='arpack' if not args.landmarks else args.solver,
+                                  projection_dim=args.projection_dim or None).fit(fit_features)
+    print(f'Fitted {args.components}-dimensional embedding of {len(fit_features)} samples in '
+          f'{time.time() - start:.1f}s')
+    embedding.save(args.out)
+
+    if args.distill:
+        model = distill(embedding, features[:args.samples + args.distill_samples], epochs=args.distill_epochs)
+        model.save(args.distill)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,397 @@
+"""
+Header-only extraction of the lief based EMBER feature types (features.LIEF_BLOCKS) without lief.
+
+The general, header, section, imports, exports and datadirectories blocks only depend on the PE headers, the section
+table and the import/export tables, so they are computed by seeking to those structures in a file handle and reading
+them with struct, instead of reading the whole file and parsing everything with lief. Only section contents are read,
+for the section entropy, and that can be skipped too. The raw features have the same layout as the lief based
+feature types return, so they are vectorized by the same process_raw_features and mixed freely with features.py.
+
+Some values follow what lief 0.9 (the version EMBER feature version 2 was computed with) reports rather than the PE
+specification, e.g. the entry section is looked up by treating the entry point address as a file offset.
+
+Usage:
+    python pe_headers.py sample.exe
+"""
+import argparse
+import json
+import os
+import struct
+
+import numpy as np
+
+# Enumeration names as lief 0.9 prints them, by value
+MACHINE_TYPES = {
+    0x0: 'UNKNOWN', 0x14c: 'I386', 0x166: 'R4000', 0x169: 'WCEMIPSV2', 0x184: 'ALPHA', 0x1a2: 'SH3', 0x1a3: 'SH3DSP',
+    0x1a6: 'SH4', 0x1a8: 'SH5', 0x1c0: 'ARM', 0x1c2: 'THUMB', 0x1c4: 'ARMNT', 0x1d3: 'AM33', 0x1f0: 'POWERPC',
+    0x1f1: 'POWERPCFP', 0x200: 'IA64', 0x266: 'MIPS16', 0x284: 'ALPHA64', 0x366: 'MIPSFPU', 0x466: 'MIPSFPU16',
+    0xebc: 'EBC', 0x8664: 'AMD64', 0x9041: 'M32R', 0xaa64: 'ARM64'
+}
+HEADER_CHARACTERISTICS = [
+    (0x1, 'RELOCS_STRIPPED'), (0x2, 'EXECUTABLE_IMAGE'), (0x4, 'LINE_NUMS_STRIPPED'), (0x8, 'LOCAL_SYMS_STRIPPED'),
+    (0x10, 'AGGRESSIVE_WS_TRIM'), (0x20, 'LARGE_ADDRESS_AWARE'), (0x80, 'BYTES_REVERSED_LO'),
+    (0x100, 'CHARA_32BIT_MACHINE'), (0x200, 'DEBUG_STRIPPED'), (0x400, 'REMOVABLE_RUN_FROM_SWAP'),
+    (0x800, 'NET_RUN_FROM_SWAP'), (0x1000, 'SYSTEM'), (0x2000, 'DLL'), (0x4000, 'UP_SYSTEM_ONLY'),
+    (0x8000, 'BYTES_REVERSED_HI')
+]
+SUBSYSTEMS = {
+    0: 'UNKNOWN', 1: 'NATIVE', 2: 'WINDOWS_GUI', 3: 'WINDOWS_CUI', 5: 'OS2_CUI', 7: 'POSIX_CUI', 8: 'NATIVE_WINDOWS',
+    9: 'WINDOWS_CE_GUI', 10: 'EFI_APPLICATION', 11: 'EFI_BOOT_SERVICE_DRIVER', 12: 'EFI_RUNTIME_DRIVER', 13: 'EFI_ROM',
+    14: 'XBOX', 16: 'WINDOWS_BOOT_APPLICATION'
+}
+DLL_CHARACTERISTICS = [
+    (0x20, 'HIGH_ENTROPY_VA'), (0x40, 'DYNAMIC_BASE'), (0x80, 'FORCE_INTEGRITY'), (0x100, 'NX_COMPAT'),
+    (0x200, 'NO_ISOLATION'), (0x400, 'NO_SEH'), (0x800, 'NO_BIND'), (0x1000, 'APPCONTAINER'), (0x2000, 'WDM_DRIVER'),
+    (0x4000, 'GUARD_CF'), (0x8000, 'TERMINAL_SERVER_AWARE')
+]
+# lief 0.9 tests every value with a bitwise and, so the multi-bit ALIGN_ values match more than the actual alignment
+SECTION_CHARACTERISTICS = [
+    (0x8, 'TYPE_NO_PAD'), (0x20, 'CNT_CODE'), (0x40, 'CNT_INITIALIZED_DATA'), (0x80, 'CNT_UNINITIALIZED_DATA'),
+    (0x100, 'LNK_OTHER'), (0x200, 'LNK_INFO'), (0x800, 'LNK_REMOVE'), (0x1000, 'LNK_COMDAT'), (0x8000, 'GPREL'),
+    (0x10000, 'MEM_PURGEABLE'), (0x20000, 'MEM_16BIT'), (0x40000, 'MEM_LOCKED'), (0x80000, 'MEM_PRELOAD'),
+    (0x100000, 'ALIGN_1BYTES'), (0x200000, 'ALIGN_2BYTES'), (0x300000, 'ALIGN_4BYTES'), (0x400000, 'ALIGN_8BYTES'),
+    (0x500000, 'ALIGN_16BYTES'), (0x600000, 'ALIGN_32BYTES'), (0x700000, 'ALIGN_64BYTES'),
+    (0x800000, 'ALIGN_128BYTES'), (0x900000, 'ALIGN_256BYTES'), (0xA00000, 'ALIGN_512BYTES'),
+    (0xB00000, 'ALIGN_1024BYTES'), (0xC00000, 'ALIGN_2048BYTES'), (0xD00000, 'ALIGN_4096BYTES'),
+    (0xE00000, 'ALIGN_8192BYTES'), (0x1000000, 'LNK_NRELOC_OVFL'), (0x2000000, 'MEM_DISCARDABLE'),
+    (0x4000000, 'MEM_NOT_CACHED'), (0x8000000, 'MEM_NOT_PAGED'), (0x10000000, 'MEM_SHARED'),
+    (0x20000000, 'MEM_EXECUTE'), (0x40000000, 'MEM_READ'), (0x80000000, 'MEM_WRITE')
+]
+DATA_DIRECTORIES = [
+    'EXPORT_TABLE', 'IMPORT_TABLE', 'RESOURCE_TABLE', 'EXCEPTION_TABLE', 'CERTIFICATE_TABLE', 'BASE_RELOCATION_TABLE',
+    'DEBUG', 'ARCHITECTURE', 'GLOBAL_PTR', 'TLS_TABLE', 'LOAD_CONFIG_TABLE', 'BOUND_IMPORT', 'IAT',
+    'DELAY_IMPORT_DESCRIPTOR', 'CLR_RUNTIME_HEADER', 'RESERVED'
+]
+PE32, PE32_PLUS = 0x10b, 0x20b
+
+# Bounds on the tables read from untrusted files
+MAX_SECTIONS = 1024
+MAX_IMPORT_LIBRARIES = 4096
+MAX_IMPORTS_PER_LIBRARY = 1 << 16
+MAX_EXPORTS = 1 << 16
+MAX_NAME_LENGTH = 10000  # Same clipping as ImportsInfo and ExportsInfo
+ENTROPY_CHUNK_SIZE = 1 << 20
+
+
+class PEFormatError(ValueError):
+    """ Raised when a file isn't a PE file, or its headers are truncated. """
+
+
+def _flags(value, names):
+    return [name for flag, name in names if value & flag]
+
+
+def _align(value, alignment):
+    return (value + alignment - 1) // alignment * alignment if alignment else value
+
+
+class PEHeaders(object):
+    """ The headers, section table and data directories of a PE file, read from a seekable binary file handle. """
+
+    def __init__(self, f, file_size=None):
+        """
+        :param f: Binary file handle, only read with seeks to the needed structures.
+        :param file_size: Size of the file in bytes, determined by seeking to the end when omitted.
+        """
+        self.f = f
+        if file_size is None:
+            file_size = f.seek(0, os.SEEK_END)
+        self.file_size = file_size
+
+        if self._read(0, 2) != b'MZ':
+            raise PEFormatError('No MZ header')
+        (pe_offset,) = struct.unpack('<I', self._read(0x3c, 4))
+        if self._read(pe_offset, 4) != b'PE\0\0':
+            raise PEFormatError('No PE signature')
+        (self.machine, num_sections, self.timestamp, self.symbol_table, self.num_symbols, optional_size,
+         self.characteristics) = struct.unpack('<HHIIIHH', self._read(pe_offset + 4, 20))
+
+        optional_offset = pe_offset + 24
+        (self.magic,) = struct.unpack('<H', self._read(optional_offset, 2))
+        if self.magic == PE32:
+            fields = struct.unpack('<HBBIIIIIIIIIHHHHHHIIIIHHIIIIII', self._read(optional_offset, 96))
+            directories_offset = optional_offset + 96
+        elif self.magic == PE32_PLUS:
+            fields = struct.unpack('<HBBIIIIIQIIHHHHHHIIIIHHQQQQII', self._read(optional_offset, 112))
+            fields = fields[:8] + (None,) + fields[8:]  # No BaseOfData
+            directories_offset = optional_offset + 112
+        else:
+            raise PEFormatError(f'Unknown optional header magic {self.magic:#x}')
+        (_, self.major_linker_version, self.minor_linker_version, self.sizeof_code, _, _, self.entry_point, _, _,
+         self.image_base, self.section_alignment, _, self.major_operating_system_version,
+         self.minor_operating_system_version, self.major_image_version, self.minor_image_version,
+         self.major_subsystem_version, self.minor_subsystem_version, _, self.sizeof_image, self.sizeof_headers, _,
+         self.subsystem, self.dll_characteristics, _, _, _, self.sizeof_heap_commit, _, num_directories) = fields
+
+        num_directories = min(num_directories, len(DATA_DIRECTORIES))
+        directories = self._read(directories_offset, 8 * num_directories, strict=False)
+        num_directories = len(directories) // 8
+        self.data_directories = [struct.unpack_from('<II', directories, 8 * i) for i in range(num_directories)]
+
+        sections_offset = optional_offset + optional_size
+        table = self._read(sections_offset, 40 * min(num_sections, MAX_SECTIONS), strict=False)
+        self.sections = []
+        for i in range(len(table) // 40):
+            (name, virtual_size, virtual_address, sizeof_raw_data, pointerto_raw_data, _, _, _, _,
+             characteristics) = struct.unpack_from('<8sIIIIIIHHI', table, 40 * i)
+            self.sections.append({
+                'name': name.split(b'\0', 1)[0].decode('utf-8', 'replace'),
+                'virtual_size': virtual_size,
+                'virtual_address': virtual_address,
+                'size': sizeof_raw_data,
+                'offset': pointerto_raw_data,
+                'characteristics': characteristics
+            })
+        self.headers_end = sections_offset + 40 * len(self.sections)
+
+    def _read(self, offset, size, strict=True):
+        if offset < 0 or offset >= self.file_size:
+            if strict:
+                raise PEFormatError(f'Offset {offset:#x} is outside the file')
+            return b''
+        self.f.seek(offset)
+        data = self.f.read(size)
+        if strict and len(data) < size:
+            raise PEFormatError(f'Truncated structure at {offset:#x}')
+        return data
+
+    def _rva_to_offset(self, rva):
+        for s in self.sections:
+            if s['virtual_address'] <= rva < s['virtual_address'] + max(s['virtual_size'], s['size']):
+                return rva - s['virtual_address'] + s['offset']
+        if rva < self.sizeof_headers:
+            return rva
+        return None
+
+    def _read_rva(self, rva, size):
+        offset = self._rva_to_offset(rva)
+        return b'' if offset is None else self._read(offset, size, strict=False)
+
+    def _read_string(self, rva, limit=MAX_NAME_LENGTH):
+        offset = self._rva_to_offset(rva)
+        if offset is None:
+            return ''
+        data = b''
+        while len(data) < limit:
+            chunk = self._read(offset + len(data), 256, strict=False)
+            if not chunk:
+                break
+            data += chunk
+            if b'\0' in chunk:
+                break
+        return data.split(b'\0', 1)[0][:limit].decode('utf-8', 'replace')
+
+    def _directory(self, index):
+        return self.data_directories[index] if index < len(self.data_directories) else (0, 0)
+
+    def virtual_size(self):
+        """ Size of the image in memory, computed from the section table like lief does. """
+        size = self.headers_end
+        for s in self.sections:
+            size = max(size, s['virtual_address'] + s['virtual_size'])
+        return _align(size, self.section_alignment)
+
+    def entry_section(self):
+        """ Name of the entry section, the section lief 0.9 finds for the entry point, see the module docstring. """
+        entry = self.image_base + self.entry_point
+        for s in self.sections:
+            if s['offset'] <= entry < s['offset'] + s['size']:
+                return s['name']
+        # Like lief.not_found: the first executable section
+        for s in self.sections:
+            if s['characteristics'] & 0x20000000:
+                return s['name']
+        return ''
+
+    def section_entropy(self, section):
+        """ Shannon entropy in bits of the contents of a section, read in chunks. """
+        counts = np.zeros(256, dtype=np.int64)
+        # Like lief, the padding past the virtual size isn't part of the contents
+        size = min(section['size'], section['virtual_size']) if section['virtual_size'] else section['size']
+        offset, remaining = section['offset'], min(size, max(0, self.file_size - section['offset']))
+        while remaining > 0:
+            chunk = self._read(offset, min(remaining, ENTROPY_CHUNK_SIZE), strict=False)
+            if not chunk:
+                break
+            counts += np.bincount(np.frombuffer(chunk, dtype=np.uint8), minlength=256)
+            offset += len(chunk)
+            remaining -= len(chunk)
+        total = counts.sum()
+        if not total:
+            return 0.0
+        p = counts[counts > 0] / total
+        return float(-np.sum(p * np.log2(p)))
+
+    def imports(self):
+        """ Dict of library name to imported function names, or 'ordinal<n>' for imports by ordinal. """
+        imports = {}
+        rva, size = self._directory(1)
+        if not rva:
+            return imports
+        thunk_size, ordinal_flag, thunk_format = (8, 1 << 63, '<Q') if self.magic == PE32_PLUS else (4, 1 << 31, '<I')
+        for i in range(MAX_IMPORT_LIBRARIES):
+            descriptor = self._read_rva(rva + 20 * i, 20)
+            if len(descriptor) < 20:
+                break
+            lookup_rva, _, _, name_rva, iat_rva = struct.unpack('<5I', descriptor)
+            if not any((lookup_rva, name_rva, iat_rva)):
+                break
+            name = self._read_string(name_rva)
+            functions = imports.setdefault(name, [])  # Libraries can be listed more than once
+            thunks_rva = lookup_rva or iat_rva
+            for j in range(MAX_IMPORTS_PER_LIBRARY):
+                thunk = self._read_rva(thunks_rva + thunk_size * j, thunk_size)
+                if len(thunk) < thunk_size:
+                    break
+                (value,) = struct.unpack(thunk_format, thunk)
+                if not value:
+                    break
+                if value & ordinal_flag:
+                    functions.append('ordinal' + str(value & 0xffff))
+                else:
+                    functions.append(self._read_string((value & 0x7fffffff) + 2))
+        return imports
+
+    def exports(self):
+        """ Names of the exported functions, empty for exports by ordinal only. """
+        rva, size = self._directory(0)
+        directory = self._read_rva(rva, 40) if rva else b''
+        if len(directory) < 40:
+            return []
+        (_, _, _, _, _, _, num_functions, num_names, functions_rva, names_rva,
+         ordinals_rva) = struct.unpack('<IIHHIIIIIII', directory)
+        num_functions, num_names = min(num_functions, MAX_EXPORTS), min(num_names, MAX_EXPORTS)
+        names_table = self._read_rva(names_rva, 4 * num_names)
+        ordinals_table = self._read_rva(ordinals_rva, 2 * num_names)
+        names = {}
+        for i in range(min(len(names_table) // 4, len(ordinals_table) // 2)):
+            (name_rva,) = struct.unpack_from('<I', names_table, 4 * i)
+            (ordinal,) = struct.unpack_from('<H', ordinals_table, 2 * i)
+            names[ordinal] = self._read_string(name_rva)
+        addresses = self._read_rva(functions_rva, 4 * num_functions)
+        exports = []
+        for i in range(len(addresses) // 4):
+            (address,) = struct.unpack_from('<I', addresses, 4 * i)
+            if address:
+                exports.append(names.get(i, ''))
+        return exports
+
+
+def raw_features(f, file_size=None, section_entropy=True):
+    """
+    Returns the raw features of features.LIEF_BLOCKS for a PE file, as the lief based feature types compute them. Files
+    that aren't PE files, or whose headers are truncated, get the features those compute without a lief parse.
+
+    :param f: Seekable binary file handle.
+    :param file_size: Size of the file in bytes, determined by seeking to the end when omitted.
+    :param section_entropy: Reads the section contents for their entropy, which is left 0 otherwise.
+    """
+    import features
+    try:
+        pe = PEHeaders(f, file_size)
+    except PEFormatError:
+        size = f.seek(0, os.SEEK_END) if file_size is None else file_size
+        raw = {fe.name: fe().raw_features(b'', None) for fe in features.FEATURE_TYPES + [features.DataDirectories]
+               if fe.name in features.LIEF_BLOCKS}
+        raw['general']['size'] = size
+        return raw
+
+    imports = pe.imports()
+    exports = pe.exports()
+    directories = [pe._directory(i) for i in range(len(DATA_DIRECTORIES))]
+    has = lambda name: int(directories[DATA_DIRECTORIES.index(name)][0] != 0)  # noqa: E731
+    raw = {}
+    raw['general'] = {
+        'size': pe.file_size,
+        'vsize': pe.virtual_size(),
+        'has_debug': has('DEBUG'),
+        'exports': len(exports),
+        'imports': sum(len(functions) for functions in imports.values()),
+        'has_relocations': has('BASE_RELOCATION_TABLE'),
+        'has_resources': has('RESOURCE_TABLE'),
+        'has_signature': has('CERTIFICATE_TABLE'),
+        'has_tls': has('TLS_TABLE'),
+        'symbols': pe.num_symbols if pe.symbol_table else 0,
+    }
+    raw['header'] = {
+        'coff': {
+            'timestamp': pe.timestamp,
+            'machine': MACHINE_TYPES.get(pe.machine, 'UNKNOWN'),
+            'characteristics': _flags(pe.characteristics, HEADER_CHARACTERISTICS)
+        },
+        'optional': {
+            'subsystem': SUBSYSTEMS.get(pe.subsystem, 'UNKNOWN'),
+            'dll_characteristics': _flags(pe.dll_characteristics, DLL_CHARACTERISTICS),
+            'magic': 'PE32_PLUS' if pe.magic == PE32_PLUS else 'PE32',
+            'major_image_version': pe.major_image_version,
+            'minor_image_version': pe.minor_image_version,
+            'major_linker_version': pe.major_linker_version,
+            'minor_linker_version': pe.minor_linker_version,
+            'major_operating_system_version': pe.major_operating_system_version,
+            'minor_operating_system_version': pe.minor_operating_system_version,
+            'major_subsystem_version': pe.major_subsystem_version,
+            'minor_subsystem_version': pe.minor_subsystem_version,
+            'sizeof_code': pe.sizeof_code,
+            'sizeof_headers': pe.sizeof_headers,
+            'sizeof_heap_commit': pe.sizeof_heap_commit
+        }
+    }
+    raw['section'] = {
+        'entry': pe.entry_section(),
+        'sections': [{
+            'name': s['name'],
+            'size': s['size'],
+            'entropy': pe.section_entropy(s) if section_entropy else 0.0,
+            'vsize': s['virtual_size'],
+            'props': _flags(s['characteristics'], SECTION_CHARACTERISTICS)
+        } for s in pe.sections]
+    }
+    raw['imports'] = {name: [function[:MAX_NAME_LENGTH] for function in functions]
+                      for name, functions in imports.items()}
+    raw['exports'] = [name[:MAX_NAME_LENGTH] for name in exports]
+    raw['datadirectories'] = [{'name': name, 'size': size, 'virtual_address': rva}
+                              for name, (rva, size) in zip(DATA_DIRECTORIES, pe.data_directories)]
+    return raw
+
+
+class HeaderFeatureExtractor(object):
+    """
+    Computes the feature vector columns of features.LIEF_BLOCKS from a file path, reading only the headers, tables and
+    (optionally) the section contents. The columns are in feature vector order, so the vector is the input of a model
+    trained on those blocks only (runner.py --blocks).
+    """
+
+    def __init__(self, feature_version=2, section_entropy=True):
+        """
+        :param feature_version: EMBER feature version, 1 or 2.
+        :param section_entropy: Reads the section contents for their entropy, see raw_features.
+        """
+        import features
+        types = features.FEATURE_TYPES + ([features.DataDirectories] if feature_version == 2 else [])
+        self.features = [fe() for fe in types if fe.name in features.LIEF_BLOCKS]
+        self.blocks = [fe.name for fe in self.features]
+        self.dim = sum(fe.dim for fe in self.features)
+        self.section_entropy = section_entropy
+
+    def raw_features(self, path):
+        with open(path, 'rb') as f:
+            return raw_features(f, section_entropy=self.section_entropy)
+
+    def process_raw_features(self, raw_obj):
+        return np.hstack([fe.process_raw_features(raw_obj[fe.name]) for fe in self.features]).astype(np.float32)
+
+    def feature_vector(self, path):
+        return self.process_raw_features(self.raw_features(path))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print the header-only raw features of a PE file.")
+    parser.add_argument("path")
+    parser.add_argument("--no-entropy", action="store_true", help="Don't read the section contents.")
+    args = parser.parse_args()
+    with open(args.path, 'rb') as f:
+        print(json.dumps(raw_features(f, section_entropy=not args.no_entropy), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,459 @@
+"""
+Scriptable, resumable runner for the experiments in gan.py.
+
+Each experiment is a config dict (mode, epochs, batch size, data paths, ...). Its artifacts are cached under
+``<runs_dir>/<mode>-<config hash>/``: training checkpoints (resumed from automatically), the trained model, and a
+metrics.json log with per-epoch loss/throughput and final test metrics. Re-running a finished config is a no-op.
+
+Usage:
+    python runner.py --mode simple_disc simple_gan --epochs 30 --workers 2
+    python runner.py --config experiments.json --workers 4 --threads-per-worker 8
+"""
+import argparse
+import functools
+import hashlib
+import json
+import multiprocessing
+import os
+
+import gan
+
+MODES = {
+    'simple_disc': 'Simple Discriminator',
+    'simple_gan': 'Simple GAN',
+    'resistant_disc': 'Resistant Discriminator',
+    'resistant_gan': 'Resistant GAN',
+    'adversarial_disc': 'Adversarial Discriminator',
+}
+
+DEFAULT_CONFIG = {
+    'mode': 'simple_disc',
+    'epochs': gan.EPOCHS,
+    'gan_epochs': 15,  # Generator epochs of "Resistant GAN"
+    'batch_size': gan.BATCH_SIZE,
+    'shuffle_buffer_size': gan.SHUFFLE_BUFFER_SIZE,
+    'train_set': 'dataset/train_set.npz',
+    'test_set': 'dataset/test_set.npz',
+    'seed': None,
+    'checkpoint_every_steps': None,
+    'checkpoint_every_secs': 600,
+    'telemetry': False,  # Per-step timing/gradient logs in telemetry-<stage>.jsonl and tensorboard/
+    'profile_steps': None,  # [start, stop] global steps to capture a tf.profiler trace for
+    'validation_set': None,  # npz file validated against after every epoch, enables the settings below
+    'target_fpr': 1e-3,  # Validation reports the FNR at this FPR ('fnr_at_fpr')
+    'early_stopping_patience': None,
+    'lr_plateau_patience': None,
+    'learning_rate': gan.LEARNING_RATE,
+    'generator_learning_rate': None,  # Learning rate of the generator, learning_rate by default
+    'lr_schedule': 'constant',  # constant, exponential or cosine, see validation.make_learning_rate
+    'lr_decay_steps': 10000,
+    'embedding_path': None,  # Distilled LLE model from manifold.py for the resistant discriminator
+    'sparse': False,  # Train simple_disc on sparse hashed feature blocks, see gan.prepare_datasets
+    'blocks': None,  # Feature blocks discriminators are trained on (see features.feature_blocks), all by default
+    'stratified': False,  # Fixed-size batches with a fixed malware count, see sampling.StratifiedBatchSampler
+    'malware_ratio': None,  # Malware fraction of stratified batches, that of the training set by default
+    'adapt_normalization': False,  # Adapt the discriminator's Normalization layers to the training set first
+    'adversarial_ratio': 0.25,  # Fraction of obscured malware in "Adversarial Discriminator" batches
+    'adversarial_refresh_every': 10,  # Steps between refreshes of the obscured malware, see gan.AdversarialTraining
+    'adversarial_buffer_size': None,  # Obscured feature vectors kept, see gan.AdversarialTraining
+    'noise_dim': gan.noise_dim,  # Length of the generator's noise input
+    'generator_widths': list(gan.GENERATOR_WIDTHS),  # Hidden layer units of the generator
+    'discriminator_widths': list(gan.DISCRIMINATOR_WIDTHS),  # Hidden layer units of the discriminators
+    'dropout': gan.DROPOUT,  # Dropout rate of every model
+}
+
+# Settings that don't change an experiment's results, and are therefore left out of its config hash
+NON_RESULT_KEYS = ('name', 'checkpoint_every_steps', 'checkpoint_every_secs', 'telemetry', 'profile_steps')
+
+# Settings every config hash covers. Any other setting is only hashed when it differs from its default, so adding a
+# setting to DEFAULT_CONFIG doesn't change the hashes, and orphan the run directories, of existing experiments.
+HASHED_KEYS = ('mode', 'epochs', 'gan_epochs', 'batch_size', 'shuffle_buffer_size', 'train_set', 'test_set', 'seed')
+
+# Experiments whose trained discriminator is reused as the black box of another
+DEPENDENCIES = {'simple_gan': 'simple_disc', 'resistant_gan': 'resistant_disc'}
+
+# Settings only generators are trained with, left out of the config of the black box an experiment depends on so
+# experiments differing only in these share it
+GENERATOR_KEYS = ('gan_epochs', 'noise_dim', 'generator_widths', 'generator_learning_rate', 'adversarial_ratio',
+                  'adversarial_refresh_every', 'adversarial_buffer_size')
+
+# Experiments training a generator, which edits full feature vectors
+GENERATOR_MODES = ('simple_gan', 'resistant_gan', 'adversarial_disc')
+
+
+def normalize_mode(mode):
+    # Accept the names of the old interactive menu as well, e.g. "Simple Discriminator"
+    for key, name in MODES.items():
+        if mode in (key, name):
+            return key
+    raise ValueError(f'Unknown mode {mode!r}, valid modes are: {", ".join(MODES)}')
+
+
+def make_config(**overrides):
+    config = dict(DEFAULT_CONFIG)
+    config.update({k: v for k, v in overrides.items() if v is not None})
+    config['mode'] = normalize_mode(config['mode'])
+    if config['blocks'] is not None and config['mode'] in GENERATOR_MODES:
+        raise ValueError(f'{config["mode"]} trains a generator, which needs all feature blocks')
+    if config['sparse'] and os.path.isdir(config['train_set']):
+        raise ValueError('Sparse training loads its training set from a numpy file written by setup.save_npz, '
+                         f'{config["train_set"]} is a directory')
+    return config
+
+
+def config_hash(config):
+    """ Returns a short stable hash of the settings that affect an experiment's results. """
+    settings = {k: v for k, v in config.items() if k not in NON_RESULT_KEYS and
+                (k in HASHED_KEYS or k not in DEFAULT_CONFIG or v != DEFAULT_CONFIG[k])}
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+
+def run_dir_for(config, runs_dir):
+    return os.path.join(runs_dir, f'{config["mode"]}-{config_hash(config)}')
+
+
+def dependency_of(config):
+    mode = DEPENDENCIES.get(config['mode'])
+    if mode is None:
+        return None
+    return make_config(**dict({k: v for k, v in config.items() if k not in GENERATOR_KEYS}, mode=mode))
+
+
+def _write_json(path, obj):
+    # Write to a temporary file first so a killed process never leaves a truncated log behind
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+class MetricsLog(object):
+    """
+    Per-epoch metrics of one experiment, rewritten to metrics.json after every epoch. A pruner, if given, is called
+    with (path, stage, epoch, stats) after every epoch, and stops training the stage when it returns True.
+    """
+
+    def __init__(self, path, config, pruner=None):
+        self.path = path
+        self.pruner = pruner
+        self.log = {'config': config, 'epochs': [], 'test': {}}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.log = json.load(f)
+
+    def epoch_callback(self, stage):
+        def on_epoch_end(epoch, stats):
+            # Drop entries of epochs that are being redone after resuming from an earlier checkpoint
+            self.log['epochs'] = [e for e in self.log['epochs'] if not (e['stage'] == stage and e['epoch'] >= epoch)]
+            self.log['epochs'].append(dict(stats, stage=stage, epoch=epoch))
+            _write_json(self.path, self.log)
+            if self.pruner is not None and self.pruner(self.path, stage, epoch, stats):
+                print(f'Pruned {stage} at epoch #{epoch}')
+                self.log['pruned'] = {'stage': stage, 'epoch': epoch}
+                _write_json(self.path, self.log)
+                return True
+            return False
+        return on_epoch_end
+
+    def set_test(self, name, metrics):
+        self.log['test'][name] = metrics
+        _write_json(self.path, self.log)
+
+
+def _roc_summary(dataset, discriminator):
+    import evaluate
+    import numpy as np
+
+    batches = ((f.numpy(), l.numpy(), None) for f, l in dataset)
+    report = evaluate.evaluate(lambda x: discriminator(x.astype(np.float32), training=False).numpy(), batches)
+    return {'auc': report['auc'], 'operating_points': report['operating_points']}
+
+
+def _make_telemetry(config, run_dir, stage):
+    if not config['telemetry']:
+        return None
+    from telemetry import TrainingTelemetry
+    return TrainingTelemetry(log_path=os.path.join(run_dir, f'telemetry-{stage}.jsonl'),
+                             tensorboard_dir=os.path.join(run_dir, 'tensorboard', stage),
+                             profile_steps=config['profile_steps'])
+
+
+def _set_learning_rates(config):
+    from validation import make_learning_rate
+
+    learning_rates = {'generator': config['generator_learning_rate'] or config['learning_rate'],
+                      'discriminator': config['learning_rate']}
+    for name, learning_rate in learning_rates.items():
+        gan.set_learning_rate(name, make_learning_rate(config['lr_schedule'], learning_rate, config['lr_decay_steps']))
+
+
+def _validation_kwargs(config, model, input_dim, score_fn=None):
+    # Keyword arguments of gan.train enabling validation, or none when the config has no validation set
+    if not config['validation_set']:
+        return {}
+    import validation
+
+    dataset = gan.prepare_validation_dataset(config['validation_set'], config['batch_size'], config['blocks'])
+    validator = validation.Validator(dataset, model, input_dim, score_fn or validation.discriminator_scores,
+                                     target_fpr=config['target_fpr'])
+    return {'validation': validator, 'early_stopping_patience': config['early_stopping_patience'],
+            'lr_plateau_patience': config['lr_plateau_patience']}
+
+
+def _input_dim(config):
+    if config['blocks'] is None:
+        return gan.feat_size
+    import features
+    return len(features.block_columns(config['blocks']))
+
+
+def _train_discriminator(make_model, config, run_dir, train_dataset, metrics, stage='discriminator', generator=None):
+    disc = make_model()
+    if config['adapt_normalization']:
+        import feature_stats
+        if not disc.built:
+            disc.build([None, _input_dim(config)])
+        feature_stats.adapt_normalization(disc, train_dataset)
+    adversarial = None
+    if generator is not None:
+        adversarial = gan.AdversarialTraining(disc, generator, config['adversarial_refresh_every'],
+                                              config['adversarial_ratio'], config['adversarial_buffer_size'],
+                                              config['seed'] or 0)
+    telemetry = _make_telemetry(config, run_dir, stage)
+    gan.train(train_dataset, config['epochs'], disc, checkpoint_dir=os.path.join(run_dir, f'{stage}_checkpoints'),
+              resume=True, on_epoch_end=metrics.epoch_callback(stage),
+              checkpoint_every_steps=config['checkpoint_every_steps'],
+              checkpoint_every_secs=config['checkpoint_every_secs'], telemetry=telemetry, adversarial=adversarial,
+              **_validation_kwargs(config, disc, _input_dim(config)))
+    if telemetry is not None:
+        telemetry.close()
+    return disc
+
+
+def _make_generator(config):
+    gen = gan.make_generator_model(config['generator_widths'], config['dropout'])
+    gen.build([None, gan.feat_size + config['noise_dim']])
+    return gen
+
+
+def _train_generator(epochs, black_box, config, run_dir, train_dataset, metrics):
+    disc = gan.make_simple_discriminator_model(widths=config['discriminator_widths'], dropout=config['dropout'])
+    disc.build([None, gan.feat_size])
+    gen = _make_generator(config)
+    telemetry = _make_telemetry(config, run_dir, 'generator')
+    # The generator is validated by how often the black box misses the malware it obscures, higher is better
+    from validation import make_generator_scores
+    gan.train(train_dataset, epochs, disc, gen, black_box,
+              checkpoint_dir=os.path.join(run_dir, 'generator_checkpoints'), resume=True,
+              on_epoch_end=metrics.epoch_callback('generator'),
+              checkpoint_every_steps=config['checkpoint_every_steps'],
+              checkpoint_every_secs=config['checkpoint_every_secs'], telemetry=telemetry, metric_mode='max',
+              **_validation_kwargs(config, gen, gen.input_shape[-1], make_generator_scores(black_box)))
+    if telemetry is not None:
+        telemetry.close()
+    return gen
+
+
+def _load_black_box(config, runs_dir):
+    # Trains the discriminator the experiment depends on, unless it already finished, and loads it
+    dependency = dependency_of(config)
+    run_experiment(dependency, runs_dir)
+    # That experiment set gan.py's module-level state from its own config, set this experiment's back
+    gan.reset_optimizers()
+    gan.noise_dim = config['noise_dim']
+    _set_learning_rates(config)
+    return gan.load_model(os.path.join(run_dir_for(dependency, runs_dir), 'model'))
+
+
+def run_experiment(config, runs_dir='./runs', pruner=None):
+    """
+    Runs one experiment, or returns its cached metrics if it already finished. Returns the metrics log.
+
+    :param config: Experiment config, see DEFAULT_CONFIG.
+    :param runs_dir: Directory holding the artifacts of all experiments.
+    :param pruner: Optional callable stopping training early, see MetricsLog. A pruned experiment is still tested,
+                   and cached like a finished one. Experiments it depends on aren't pruned.
+    """
+    config = make_config(**config)
+    run_dir = run_dir_for(config, runs_dir)
+    done_path = os.path.join(run_dir, 'done.json')
+    if os.path.exists(done_path):
+        print(f'{config["mode"]}: found finished run in {run_dir}, skipping')
+        with open(done_path) as f:
+            return json.load(f)
+
+    os.makedirs(run_dir, exist_ok=True)
+    _write_json(os.path.join(run_dir, 'config.json'), config)
+    metrics = MetricsLog(os.path.join(run_dir, 'metrics.json'), config, pruner)
+
+    # Optimizers and the noise length are module-level state in gan.py, start every experiment from fresh ones
+    gan.reset_optimizers()
+    gan.noise_dim = config['noise_dim']
+    _set_learning_rates(config)
+    if config['seed'] is not None:
+        gan.tf.keras.utils.set_random_seed(config['seed'])
+    mode = config['mode']
+    # Only the simple discriminator has a sparse input layer
+    sparse = config['sparse'] and mode == 'simple_disc'
+    train_dataset, test_dataset = gan.prepare_datasets(config['train_set'], config['test_set'],
+                                                       config['batch_size'], config['shuffle_buffer_size'], sparse,
+                                                       config['blocks'], config['stratified'], config['malware_ratio'],
+                                                       config['seed'] or 0)
+    model_path = os.path.join(run_dir, 'model')
+    model_kwargs = {'widths': config['discriminator_widths'], 'dropout': config['dropout']}
+    make_resistant = functools.partial(gan.make_resistant_discriminator_model, config['embedding_path'], **model_kwargs)
+    make_simple = functools.partial(gan.make_simple_discriminator_model, sparse, **model_kwargs)
+
+    if mode == 'simple_disc':
+        disc = _train_discriminator(make_simple, config, run_dir, train_dataset, metrics)
+        disc.save(model_path)
+        metrics.set_test('discriminator', dict(gan.test(test_dataset, disc), roc=_roc_summary(test_dataset, disc)))
+    elif mode == 'simple_gan':
+        disc_bb = _load_black_box(config, runs_dir)
+        gen = _train_generator(config['epochs'], disc_bb, config, run_dir, train_dataset, metrics)
+        gen.save(model_path)
+        metrics.set_test('generator', gan.test(test_dataset, disc_bb, gen))
+    elif mode == 'resistant_disc':
+        disc = _train_discriminator(make_resistant, config, run_dir, train_dataset, metrics)
+        disc.save(model_path)
+        metrics.set_test('discriminator', dict(gan.test(test_dataset, disc), roc=_roc_summary(test_dataset, disc)))
+    elif mode == 'resistant_gan':
+        # The resistant discriminator, LLE fit included, is trained once by its own experiment and loaded here
+        resistant_disc = _load_black_box(config, runs_dir)
+        metrics.set_test('resistant_discriminator', gan.test(test_dataset, resistant_disc))
+        gen = _train_generator(config['gan_epochs'], resistant_disc, config, run_dir, train_dataset, metrics)
+        gen.save(model_path)
+        metrics.set_test('generator', gan.test(test_dataset, resistant_disc, gen))
+    elif mode == 'adversarial_disc':
+        # The discriminator is trained with a generator of its own, whose obscured malware it is then tested on too
+        gen = _make_generator(config)
+        disc = _train_discriminator(make_simple, config, run_dir, train_dataset, metrics, generator=gen)
+        disc.save(model_path)
+        gen.save(os.path.join(run_dir, 'generator_model'))
+        metrics.set_test('discriminator', dict(gan.test(test_dataset, disc), roc=_roc_summary(test_dataset, disc)))
+        metrics.set_test('generator', gan.test(test_dataset, disc, gen))
+
+    _write_json(done_path, metrics.log)
+    return metrics.log
+
+
+def _init_worker(threads, core_sets=None):
+    if core_sets is not None:
+        # Every worker takes its own set of cores, before TensorFlow starts its thread pools
+        cores = core_sets.get()
+        os.sched_setaffinity(0, cores)
+        threads = threads or len(cores)
+    if threads:
+        gan.tf.config.threading.set_intra_op_parallelism_threads(threads)
+        gan.tf.config.threading.set_inter_op_parallelism_threads(2)
+
+
+def _run_worker(args):
+    config, runs_dir, pruner = args
+    return run_experiment(config, runs_dir, pruner)
+
+
+def core_sets(workers, cores_per_worker):
+    """ Splits the cores this process may run on into one set of cores_per_worker per worker, wrapping around. """
+    cores = sorted(os.sched_getaffinity(0))
+    return [[cores[(i * cores_per_worker + j) % len(cores)] for j in range(cores_per_worker)] for i in range(workers)]
+
+
+def run_all(configs, runs_dir='./runs', workers=1, threads_per_worker=None, cores_per_worker=None, pruner=None):
+    """
+    Runs a list of experiments, in parallel processes when workers > 1. Experiments other experiments depend on
+    (e.g. the black box of "simple_gan") are run first so they're only trained once.
+
+    :param configs: List of experiment configs.
+    :param runs_dir: Directory holding the artifacts of all experiments.
+    :param workers: Number of experiments run concurrently.
+    :param threads_per_worker: TensorFlow intra-op threads per worker process, cores_per_worker by default.
+    :param cores_per_worker: Pins every worker process to its own set of this many cores, see core_sets.
+    :param pruner: Optional pruner of the experiments (not of those they depend on), see run_experiment.
+    """
+    configs = [make_config(**c) for c in configs]
+    dependencies = {}
+    for config in configs:
+        dependency = dependency_of(config)
+        if dependency is not None:
+            dependencies[config_hash(dependency)] = dependency
+    stages = [list(dependencies.values()),
+              [c for c in configs if config_hash(c) not in dependencies]]
+
+    results = []
+    if workers <= 1:
+        _init_worker(threads_per_worker)
+        for stage, stage_pruner in zip(stages, (None, pruner)):
+            results.extend(run_experiment(c, runs_dir, stage_pruner) for c in stage)
+        return results
+
+    # Spawn (rather than fork) so each worker initializes its own TensorFlow runtime
+    context = multiprocessing.get_context('spawn')
+    cores = None
+    if cores_per_worker:
+        cores = context.Queue()
+        for core_set in core_sets(workers, cores_per_worker):
+            cores.put(core_set)
+    with context.Pool(workers, initializer=_init_worker, initargs=(threads_per_worker, cores)) as pool:
+        for stage, stage_pruner in zip(stages, (None, pruner)):
+            results.extend(pool.map(_run_worker, [(c, runs_dir, stage_pruner) for c in stage], chunksize=1))
+    return results
+
+
+def load_configs(path):
+    with open(path) as f:
+        configs = json.load(f)
+    if isinstance(configs, dict):
+        configs = configs.get('experiments', [configs])
+    return configs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run gan.py experiments.")
+    parser.add_argument("--mode", nargs="+", help=f"Experiment modes: {', '.join(MODES)}.")
+    parser.add_argument("--config", help="JSON file with an experiment config or a list of them.")
+    parser.add_argument("--epochs", type=int)
+    parser.add_argument("--gan-epochs", type=int)
+    parser.add_argument("--batch-size", type=int)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--train-set")
+    parser.add_argument("--test-set")
+    parser.add_argument("--validation-set", help="Numpy validation set, enables per-epoch validation.")
+    parser.add_argument("--early-stopping-patience", type=int)
+    parser.add_argument("--lr-schedule", choices=("constant", "exponential", "cosine"))
+    parser.add_argument("--sparse", action="store_true", default=None, help="Train on sparse hashed feature blocks.")
+    parser.add_argument("--blocks", nargs="+", help="Feature blocks to train discriminators on, all by default.")
+    parser.add_argument("--stratified", action="store_true", default=None,
+                        help="Draw batches with a fixed malware count.")
+    parser.add_argument("--malware-ratio", type=float, help="Malware fraction of stratified batches.")
+    parser.add_argument("--adapt-normalization", action="store_true", default=None,
+                        help="Adapt the discriminator's Normalization layers to the training set before training.")
+    parser.add_argument("--adversarial-ratio", type=float,
+                        help="Fraction of obscured malware in Adversarial Discriminator batches.")
+    parser.add_argument("--adversarial-refresh-every", type=int,
+                        help="Steps between refreshes of the obscured malware of Adversarial Discriminator.")
+    parser.add_argument("--runs-dir", default="./runs")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--threads-per-worker", type=int, default=None)
+    parser.add_argument("--telemetry", action="store_true", default=None, help="Record per-step training telemetry.")
+    args = parser.parse_args()
+
+    overrides = {'epochs': args.epochs, 'gan_epochs': args.gan_epochs, 'batch_size': args.batch_size,
+                 'telemetry': args.telemetry, 'seed': args.seed, 'train_set': args.train_set, 'test_set': args.test_set,
+                 'validation_set': args.validation_set, 'early_stopping_patience': args.early_stopping_patience,
+                 'lr_schedule': args.lr_schedule, 'sparse': args.sparse, 'blocks': args.blocks,
+                 'stratified': args.stratified, 'malware_ratio': args.malware_ratio,
+                 'adapt_normalization': args.adapt_normalization, 'adversarial_ratio': args.adversarial_ratio,
+                 'adversarial_refresh_every': args.adversarial_refresh_every}
+    configs = load_configs(args.config) if args.config else []
+    configs = [dict(c, **{k: v for k, v in overrides.items() if v is not None}) for c in configs]
+    configs += [dict(overrides, mode=mode) for mode in (args.mode or [])]
+    if not configs:
+        parser.error("at least one of --mode or --config is required")
+
+    for result in run_all(configs, args.runs_dir, args.workers, args.threads_per_worker):
+        print(f'{result["config"]["mode"]}: {json.dumps(result["test"])}')
+
+
+if __name__ == '__main__':
+    main()
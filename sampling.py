@@ -0,0 +1,73 @@
+"""
+Stratified batch sampling for the training sets loaded by gan.prepare_datasets.
+
+Shuffling a training set written in meta.db order through a small shuffle buffer gives batches whose malware count
+varies wildly, so the malware subset gan.gan_train_step feeds to the generator changes shape from batch to batch.
+StratifiedBatchSampler instead draws every batch from per-class index arrays: each batch has the same size and the same
+number of malware samples, and the sequence of batches only depends on the seed.
+"""
+import numpy as np
+
+from lazy import lazy_import
+
+tf = lazy_import('tensorflow')
+
+
+class StratifiedBatchSampler(object):
+    """
+    Yields fixed-size batches with a fixed number of malware and benign samples. Each class is drawn without
+    replacement from a seeded permutation of its indices, reshuffled whenever it is exhausted, so the minority class
+    is oversampled rather than the majority class truncated.
+    """
+
+    def __init__(self, labels, batch_size, malware_ratio=None, seed=0, batches_per_epoch=None):
+        """
+        :param labels: Array of 0/1 labels of the training set.
+        :param batch_size: Number of samples per batch.
+        :param malware_ratio: Fraction of malware in every batch, defaults to the fraction in labels.
+        :param seed: Seed of the per-class permutations.
+        :param batches_per_epoch: Number of batches per epoch (dataset iteration), defaults to len(labels) // batch_size.
+        """
+        labels = np.asarray(labels).reshape(-1)
+        self.malware_indices = np.flatnonzero(labels == 1)
+        self.benign_indices = np.flatnonzero(labels != 1)
+        if malware_ratio is None:
+            malware_ratio = len(self.malware_indices) / len(labels)
+        self.batch_size = batch_size
+        self.malware_per_batch = int(round(batch_size * malware_ratio))
+        self.benign_per_batch = batch_size - self.malware_per_batch
+        if (self.malware_per_batch and not len(self.malware_indices)) or \
+                (self.benign_per_batch and not len(self.benign_indices)):
+            raise ValueError(f'Cannot draw {self.malware_per_batch} malware and {self.benign_per_batch} benign samples '
+                             f'per batch from {len(self.malware_indices)} malware and {len(self.benign_indices)} benign')
+        self.seed = seed
+        self.batches_per_epoch = batches_per_epoch or max(1, len(labels) // batch_size)
+
+    def _class_indices(self, indices, per_batch, seed):
+        # Reshuffled on every repetition, i.e. whenever the class is exhausted, and restarted with every epoch
+        return tf.data.Dataset.from_tensor_slices(indices).shuffle(len(indices), seed=seed,
+                                                                   reshuffle_each_iteration=True) \
+            .repeat().batch(per_batch, drop_remainder=True)
+
+    def index_dataset(self):
+        """ Returns a tf.data dataset of index batches of shape [batch_size], malware first, for one epoch. """
+        parts = []
+        if self.malware_per_batch:
+            parts.append(self._class_indices(self.malware_indices, self.malware_per_batch, self.seed))
+        if self.benign_per_batch:
+            parts.append(self._class_indices(self.benign_indices, self.benign_per_batch, self.seed + 1))
+        batches = tf.data.Dataset.zip(tuple(parts)).map(lambda *p: tf.concat(p, axis=0))
+        return batches.take(self.batches_per_epoch)
+
+    def dataset(self, features, labels):
+        """
+        Returns a tf.data dataset of (features, labels) batches with static shapes, for one epoch per iteration.
+
+        :param features: Feature matrix of the samples labels were given for.
+        :param labels: The labels.
+        """
+        features = tf.constant(features)
+        labels = tf.constant(labels)
+        return self.index_dataset().map(lambda indices: (tf.gather(features, indices), tf.gather(labels, indices)),
+                                        num_parallel_calls=tf.data.AUTOTUNE, deterministic=True) \
+            .prefetch(tf.data.AUTOTUNE)
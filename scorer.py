@@ -0,0 +1,62 @@
+"""
+Lightweight scoring runtime for discriminators exported with export.py.
+
+Only NumPy and a TFLite interpreter are imported, so short-lived scanning processes do not pay for loading
+TensorFlow/Keras. The standalone ``tflite_runtime`` package is preferred; the interpreter bundled with full
+TensorFlow is only used as a fallback when it is not installed.
+"""
+import numpy as np
+
+feat_size = 2381  # From EMBER feature digest, DO NOT CHANGE!
+
+
+def _load_interpreter_class():
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        # Fall back to the (much heavier) interpreter shipped with TensorFlow
+        import tensorflow as tf
+        Interpreter = tf.lite.Interpreter
+    return Interpreter
+
+
+class Scorer(object):
+    """ Scores preprocessed EMBER feature vectors with an exported TFLite discriminator. """
+
+    def __init__(self, model_path, num_threads=1):
+        """
+        :param model_path: Path to a .tflite file written by export.export_tflite.
+        :param num_threads: Number of CPU threads the interpreter may use.
+        """
+        interpreter_class = _load_interpreter_class()
+        self.interpreter = interpreter_class(model_path=model_path, num_threads=num_threads)
+        self._input_index = self.interpreter.get_input_details()[0]['index']
+        self._output_index = self.interpreter.get_output_details()[0]['index']
+        self._batch_size = None
+
+    def _resize(self, batch_size):
+        # Reallocating tensors is comparatively expensive, only do it when the batch size changes
+        if batch_size != self._batch_size:
+            self.interpreter.resize_tensor_input(self._input_index, [batch_size, feat_size])
+            self.interpreter.allocate_tensors()
+            self._batch_size = batch_size
+
+    def score(self, features):
+        """
+        Returns the probability of each sample being malware.
+
+        :param features: Array of shape (n, 2381) or (2381,) holding features from dataset.features_postproc_func.
+        """
+        features = np.asarray(features, dtype=np.float32)
+        if features.ndim == 1:
+            features = features.reshape(1, feat_size)
+        if features.ndim != 2 or features.shape[1] != feat_size:
+            raise ValueError(f'Expected features of shape (n, {feat_size}) or ({feat_size},), not {features.shape}')
+
+        self._resize(features.shape[0])
+        self.interpreter.set_tensor(self._input_index, features)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self._output_index).reshape(-1).copy()
+
+    def __call__(self, features):
+        return self.score(features)
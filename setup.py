@@ -1,22 +1,52 @@
 import sys
 
-import features
-import dataset
+import functools
 import os
 import numpy as np
-import boto3
 import sqlite3
-from enum import Enum
 
-extractor = features.PEFeatureExtractor(print_feature_warning=False)
-reader = dataset.LMDBReader(path="./dataset/ember_features/data.mdb", postproc_func=dataset.features_postproc_func)
-s3 = boto3.client('s3')
+features_lmdb_path = "./dataset/ember_features/data.mdb"
+meta_db_path = "./dataset/ember_features/meta.db"
 
 train_amount = 50000
 test_amount = 25000
+validation_amount = 10000
 
 feat_size = 2381  # From EMBER feature digest, DO NOT CHANGE!
-label_size = 15
+
+# Columns of the SOREL-20M meta table, in order, the tags being those of dataset.Dataset
+META_COLUMNS = ['sha256', 'is_malware', 'rl_fs_t', 'rl_ls_const_positives', 'adware', 'flooder', 'ransomware',
+                'dropper', 'spyware', 'packed', 'crypto_miner', 'file_infector', 'installer', 'worm', 'downloader']
+label_size = len(META_COLUMNS)
+
+
+# The extractor, LMDB reader and S3 client are only created on first use, so importing this module neither pulls in
+# lief/torch/boto3 nor requires the dataset to be present.
+@functools.lru_cache(maxsize=None)
+def get_extractor():
+    import features
+    return features.PEFeatureExtractor(print_feature_warning=False)
+
+
+@functools.lru_cache(maxsize=None)
+def get_reader(path=None):
+    # Returns the vectors dataset.LMDBReader does with features_postproc_func, without dataset.py's torch and config
+    import lmdb
+    from feature_stats import decode
+
+    env = lmdb.open(path or features_lmdb_path, readonly=True, map_size=int(1e13), max_readers=1024, subdir=False)
+
+    def read(key):
+        with env.begin() as txn:
+            value = txn.get(key.encode('ascii'))
+        return None if value is None else decode(value)
+    return read
+
+
+@functools.lru_cache(maxsize=None)
+def get_s3_client():
+    import boto3
+    return boto3.client('s3')
 
 
 def main():
@@ -25,16 +55,20 @@ def main():
     print(feats[0][626])
     # save_npz("dataset/train_set.npz", train_amount, 0)
     # save_npz("dataset/test_set.npz", test_amount, train_amount)
+    # save_npz("dataset/validation_set.npz", validation_amount, train_amount + test_amount)
+    # save_feature_store("dataset/train_store", train_amount, 0)
+    # ingest("dataset/train_store")  # Appends samples added to the databases since the last call
 
 
 # Saves a numpy file of
-def save_npz(path, batch_amount, offset):
+def save_npz(path, batch_amount, offset, sparse=False):
     """
     Creates and saves a numpy file with a labeled feature set from data within meta.db and data.mdb.
 
     :param path: File path to save the numpy file to.
     :param batch_amount: How many entries to pull from databases and save.
     :param offset: Offset within databases to start pulling entries from.
+    :param sparse: Stores the mostly-zero hashed blocks (features.SPARSE_BLOCKS) as a CSR matrix, see load_npz.
     """
     print(f'Extracting labels for {path}...')
     labels, feats = get_labels_and_features(batch_amount, offset, only_malware=False)
@@ -44,7 +78,162 @@ def save_npz(path, batch_amount, offset):
 
     labels = labels.astype(float)
 
-    np.savez(path, labels=labels, features=feats)
+    if sparse:
+        np.savez(path, labels=labels, **sparse_npz_arrays(feats))
+    else:
+        np.savez(path, labels=labels, features=feats)
+
+
+def save_feature_store(path, batch_amount, offset, blocks=None):
+    """
+    Creates a block-grouped feature store (see feature_store.py) from data within meta.db and data.mdb. Only the
+    requested blocks are kept in memory and written. Being offset based, the store has no high-water mark, use ingest
+    to build stores that are updated incrementally.
+
+    :param path: Directory to write the store to.
+    :param batch_amount: How many entries to pull from databases and save.
+    :param offset: Offset within databases to start pulling entries from.
+    :param blocks: Names of the feature blocks to store, all of them by default.
+    """
+    import feature_store
+
+    print(f'Extracting labels for {path}...')
+    labels, feats = get_labels_and_features(batch_amount, offset, only_malware=False, blocks=blocks)
+    feature_store.write_store(path, labels[:, 1].astype(float), feats, blocks)
+
+
+# Sort key of the rl_fs_t high-water mark. Rows without a first-seen time sort as 0 rather than NULL, which can't be
+# compared with a mark.
+FIRST_SEEN = 'COALESCE(rl_fs_t, 0)'
+
+
+def ingest(path, mark_column='rowid', blocks=None, chunk_size=50000, limit=None):
+    """
+    Appends the samples added to meta.db since the last ingest to a feature store (see feature_store.py), creating it
+    if needed. Rows are scanned in order of the high-water mark column, every chunk is appended as a new shard together
+    with the mark of its last row, so the cost is proportional to the new rows and an interrupted ingest resumes where
+    it stopped. Rows without features in data.mdb when they are scanned are skipped for good.
+
+    Returns the number of samples appended.
+
+    :param path: Directory of the store.
+    :param mark_column: meta.db column ordering new rows, 'rowid' or 'rl_fs_t' (first-seen time, ties are broken by
+                        rowid, and rows without one sort as 0). Only used when creating the store, afterwards the
+                        store's mark is used.
+    :param blocks: Names of the feature blocks to store, all of them by default. Only used when creating the store.
+    :param chunk_size: Number of meta.db rows per shard.
+    :param limit: Optional maximum number of meta.db rows to scan.
+    """
+    import feature_store
+
+    if os.path.exists(os.path.join(path, feature_store.MANIFEST)):
+        store = feature_store.FeatureStore(path)
+    else:
+        store = feature_store.create_store(path, blocks)
+    if store.high_water_mark is None and len(store):
+        raise ValueError(f'{path} has samples but no high-water mark, it was not built by ingest')
+    mark = store.high_water_mark or {'column': mark_column, 'value': None, 'rowid': 0}
+    if mark['column'] not in ('rowid', 'rl_fs_t'):
+        raise ValueError(f"Unknown high-water mark column {mark['column']}")
+    columns = store.columns()
+
+    con = sqlite3.connect(meta_db_path)
+    cur = con.cursor()
+    added = scanned = 0
+    while limit is None or scanned < limit:
+        size = chunk_size if limit is None else min(chunk_size, limit - scanned)
+        if mark['column'] == 'rowid':
+            cur.execute('SELECT rowid, * FROM meta WHERE rowid > ? ORDER BY rowid LIMIT ?', (mark['rowid'], size))
+        elif mark['value'] is None and not mark['rowid']:
+            cur.execute(f'SELECT rowid, * FROM meta ORDER BY {FIRST_SEEN}, rowid LIMIT ?', (size,))
+        else:
+            # Marks of stores ingested before NULL first-seen times sorted as 0 can be None
+            value = mark['value'] or 0
+            cur.execute(f'SELECT rowid, * FROM meta WHERE {FIRST_SEEN} > ? OR ({FIRST_SEEN} = ? AND rowid > ?) '
+                        f'ORDER BY {FIRST_SEEN}, rowid LIMIT ?', (value, value, mark['rowid'], size))
+        rows = cur.fetchall()
+        if not rows:
+            break
+        names = [d[0] for d in cur.description]
+        sha_i, malware_i, time_i = names.index('sha256'), names.index('is_malware'), names.index('rl_fs_t')
+
+        labels, feats = [], []
+        for row in rows:
+            new_features = extract_preprocessed_features(row[sha_i])
+            if new_features is not None and not np.isnan(new_features).any():
+                labels.append(float(row[malware_i]))
+                feats.append(new_features.reshape(feat_size)[columns])
+        last = rows[-1]
+        mark = {'column': mark['column'], 'value': last[0] if mark['column'] == 'rowid' else last[time_i] or 0,
+                'rowid': last[0]}
+        store.append_shard(np.array(labels), np.array(feats, dtype=np.float32).reshape(len(labels), len(columns)),
+                           mark)
+        scanned += len(rows)
+        added += len(labels)
+        print(f'{path}: scanned {scanned} new rows, appended {added}')
+    con.close()
+    return added
+
+
+def sparse_npz_arrays(feats):
+    """
+    Splits a dense feature matrix into the arrays of a sparse numpy file: the dense blocks as one float32 matrix,
+    and the columns of features.SPARSE_BLOCKS as the data/indices/indptr of a CSR matrix.
+
+    :param feats: Feature matrix of shape (n, 2381).
+    """
+    from scipy import sparse
+    import features
+
+    start, stop = features.sparse_columns()
+    block = sparse.csr_matrix(np.asarray(feats[:, start:stop], dtype=np.float32))
+    return {'dense_features': np.hstack([feats[:, :start], feats[:, stop:]]).astype(np.float32),
+            'sparse_data': block.data, 'sparse_indices': block.indices, 'sparse_indptr': block.indptr,
+            'sparse_columns': np.array([start, stop])}
+
+
+def load_npz(path, sparse=False):
+    """
+    Loads a numpy file written by save_npz, dense or sparse. Returns the labels and the float32 features, either as
+    one array or, if sparse, as a (dense blocks, sparse blocks) pair: an array of all columns outside
+    features.sparse_columns() and a scipy CSR matrix of the columns within, see join_blocks.
+
+    :param path: Path of the numpy file.
+    :param sparse: Return the features as a (dense blocks, sparse blocks) pair.
+    """
+    from scipy import sparse as sp
+    import features
+
+    with np.load(path) as data:
+        labels = data["labels"]
+        if "features" in data:
+            feats = data["features"].astype(np.float32, copy=False)
+            if not sparse:
+                return labels, feats
+            start, stop = features.sparse_columns()
+            return labels, (np.hstack([feats[:, :start], feats[:, stop:]]), sp.csr_matrix(feats[:, start:stop]))
+
+        start, stop = data["sparse_columns"]
+        dense = data["dense_features"]
+        block = sp.csr_matrix((data["sparse_data"], data["sparse_indices"], data["sparse_indptr"]),
+                              shape=(len(dense), stop - start))
+    if sparse:
+        return labels, (dense, block)
+    return labels, join_blocks(dense, block, start)
+
+
+def join_blocks(dense, block, start=None):
+    """
+    Reassembles full feature vectors from the (dense blocks, sparse blocks) pair returned by load_npz.
+
+    :param dense: Array of the columns outside the sparse blocks.
+    :param block: Scipy sparse matrix of the sparse block columns.
+    :param start: First column of the sparse blocks, defaults to features.sparse_columns().
+    """
+    import features
+
+    start = features.sparse_columns()[0] if start is None else start
+    return np.hstack([dense[:, :start], block.toarray(), dense[:, start:]])
 
 
 def extract_preprocessed_features(file_id):
@@ -54,14 +243,14 @@ def extract_preprocessed_features(file_id):
 
     :param file_id: Hash of the file to get features of.
     """
-    val = reader(file_id)
+    val = get_reader()(file_id)
     if val is None:
         return None
     else:
         return val
 
 
-def get_labels_and_features(amount, offset, only_malware=False, only_goodware=False):
+def get_labels_and_features(amount, offset, only_malware=False, only_goodware=False, blocks=None):
     """
     Returns a set of labels from meta.db and a set of corresponding features from data.mdb.
 
@@ -69,11 +258,16 @@ def get_labels_and_features(amount, offset, only_malware=False, only_goodware=Fa
     :param offset: Offset within meta.db to start pulling from.
     :param only_malware: Determines whether all labels are of malware instances. Takes precidence over only_goodware.
     :param only_goodware: Determines whether all labels are of benign file instances.
+    :param blocks: Names of the feature blocks to keep (see features.feature_blocks), all 2381 columns by default.
     """
-    con = sqlite3.connect('./dataset/ember_features/meta.db')
+    import features
+
+    columns = features.block_columns(blocks) if blocks is not None else slice(None)
+    width = feat_size if blocks is None else len(columns)
+    con = sqlite3.connect(meta_db_path)
     cur = con.cursor()
     labels = np.empty((amount, label_size), dtype=str)
-    feats = np.empty((amount, feat_size))
+    feats = np.empty((amount, width), dtype=np.float32)
     count = 0
     # Iteration necessary because not all entries have features
     while count < amount:
@@ -94,7 +288,7 @@ def get_labels_and_features(amount, offset, only_malware=False, only_goodware=Fa
             new_features = extract_preprocessed_features(m_hash)
             if new_features is not None and not np.isnan(new_features.any()):
                 labels[count] = np.array(entry).reshape(1, label_size)
-                feats[count] = new_features.reshape((1, feat_size))
+                feats[count] = new_features.reshape(feat_size)[columns]
                 count += 1
                 if count % 20 == 0:
                     printProgressBar(count, amount, printEnd='')
@@ -102,7 +296,7 @@ def get_labels_and_features(amount, offset, only_malware=False, only_goodware=Fa
     printProgressBar(amount, amount, printEnd='\r\n')
 
     assert labels.shape == (amount, label_size)
-    assert feats.shape == (amount, feat_size)
+    assert feats.shape == (amount, width)
 
     return labels, feats
 
@@ -118,7 +312,7 @@ def s3_download_PE(file_id):
 
     print(f'Downloading: {s3_file} to {local_file}')
 
-    s3.download_file(bucket, s3_file, local_file)
+    get_s3_client().download_file(bucket, s3_file, local_file)
 
 
 # Print iterations progress from https://stackoverflow.com/questions/3173320/text-progress-bar-in-terminal-with-block-characters
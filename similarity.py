@@ -0,0 +1,401 @@
+"""
+Approximate nearest neighbor search over feature vectors, to find the known samples closest to a new binary.
+
+IVFPQIndex is an inverted file index with product quantization, in NumPy: vectors are assigned to the nearest of
+nlist coarse k-means centroids, and the residual to that centroid is compressed to m one-byte codes, one per
+subvector, so 2381 float32 features take 64 bytes. A query scans only the nprobe lists nearest to it, with distances
+from per-list lookup tables, and optionally re-ranks the best candidates with their exact vectors from the LMDB.
+Vectors are the features as the models see them (after dataset.features_postproc_func), compared by L2 distance.
+
+The index is built from the features LMDB for the samples of meta.db, and records the highest meta.db rowid it
+holds, so adding to it later only indexes the rows added since.
+
+Usage:
+    python similarity.py build index.npz dataset/ember_features/data.mdb dataset/ember_features/meta.db
+    python similarity.py add index.npz dataset/ember_features/data.mdb dataset/ember_features/meta.db
+    python similarity.py query index.npz dataset/ember_features/meta.db --file sample.exe -k 10 \
+        --lmdb dataset/ember_features/data.mdb
+"""
+import argparse
+import itertools
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+from feature_stats import decode, signed_log1p
+from setup import META_COLUMNS
+
+feat_size = 2381  # From EMBER feature digest, DO NOT CHANGE!
+
+
+def _squared_distances(x, centroids, centroid_norms=None):
+    if centroid_norms is None:
+        centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+    return np.einsum('ij,ij->i', x, x)[:, None] - 2 * x @ centroids.T + centroid_norms[None, :]
+
+
+def _assign(x, centroids, batch_size=4096):
+    norms = np.einsum('ij,ij->i', centroids, centroids)
+    return np.concatenate([np.argmin(_squared_distances(x[i:i + batch_size], centroids, norms), axis=1)
+                           for i in range(0, len(x), batch_size)]) if len(x) else np.zeros(0, dtype=np.int64)
+
+
+def kmeans(x, k, iterations=20, seed=0):
+    """
+    Returns k centroids of x fitted with Lloyd's algorithm, starting from k random samples. Emptied clusters are
+    restarted from random samples.
+
+    :param x: Array of shape [samples, dim], with at least k samples.
+    :param k: Number of centroids.
+    :param iterations: Number of iterations.
+    :param seed: Random seed.
+    """
+    rng = np.random.default_rng(seed)
+    if len(x) < k:
+        raise ValueError(f'Need at least {k} samples to fit {k} centroids, got {len(x)}')
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(iterations):
+        labels = _assign(x, centroids)
+        counts = np.bincount(labels, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, x)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        centroids[empty] = x[rng.choice(len(x), int(empty.sum()), replace=False)]
+    return centroids
+
+
+class IVFPQIndex(object):
+    """ Inverted file index with product quantized residuals, see the module docstring. """
+
+    def __init__(self, dim=feat_size, nlist=1024, m=64, nbits=8, seed=0):
+        """
+        :param dim: Vector dimension.
+        :param nlist: Number of inverted lists (coarse centroids).
+        :param m: Number of subvectors, each encoded in one byte. Vectors are zero-padded to a multiple of m.
+        :param nbits: Bits per subvector code, at most 8.
+        :param seed: Random seed of training.
+        """
+        if not 1 <= nbits <= 8:
+            raise ValueError(f'nbits must be between 1 and 8, not {nbits}')
+        self.dim = dim
+        self.nlist = nlist
+        self.m = m
+        self.ksub = 1 << nbits
+        self.dsub = -(-dim // m)
+        self.seed = seed
+        self.centroids = None  # [nlist, dim]
+        self.codebooks = None  # [m, ksub, dsub]
+        self.high_water_mark = 0  # Highest meta.db rowid indexed
+        self._codes = [[] for _ in range(nlist)]  # Per list, chunks of [n, m] uint8 codes
+        self._ids = [[] for _ in range(nlist)]  # Per list, chunks of sha256 ids
+        self._list_tables = None
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    def __len__(self):
+        return sum(len(chunk) for chunks in self._ids for chunk in chunks)
+
+    def _pad(self, x):
+        return np.pad(x, ((0, 0), (0, self.m * self.dsub - self.dim))).reshape(len(x), self.m, self.dsub)
+
+    def train(self, sample, iterations=20, codebook_sample_size=None):
+        """
+        Fits the coarse centroids and the subvector codebooks.
+
+        :param sample: Array of shape [samples, dim] representative of the indexed vectors, with at least
+                       max(nlist, 2 ** nbits) samples.
+        :param iterations: k-means iterations.
+        :param codebook_sample_size: Number of samples the codebooks are fitted on, 40 per codebook entry by default.
+        """
+        sample = np.asarray(sample, dtype=np.float32)
+        self.centroids = kmeans(sample, self.nlist, iterations, self.seed)
+        size = min(len(sample), codebook_sample_size or 40 * self.ksub)
+        sample = sample[np.random.default_rng(self.seed).choice(len(sample), size, replace=False)]
+        residuals = self._pad(sample - self.centroids[_assign(sample, self.centroids)])
+        self.codebooks = np.stack([kmeans(residuals[:, j], self.ksub, iterations, self.seed + 1 + j)
+                                   for j in range(self.m)])
+        self._list_tables = None
+
+    def list_tables(self):
+        """
+        Returns the query independent part of the distance lookup tables, of shape [nlist, m * ksub]. The squared
+        distance of a query x to the vector encoded as centroid c and codebook entries y is
+            |x - c|^2 + (2 c.y + |y|^2) - 2 x.y
+        per subvector, the middle term being the list table.
+        """
+        if self._list_tables is None:
+            centroids = self._pad(self.centroids).transpose(1, 0, 2)  # [m, nlist, dsub]
+            tables = 2 * np.matmul(centroids, self.codebooks.transpose(0, 2, 1))  # [m, nlist, ksub]
+            tables += np.einsum('mkd,mkd->mk', self.codebooks, self.codebooks)[:, None, :]
+            self._list_tables = np.ascontiguousarray(tables.transpose(1, 0, 2).reshape(self.nlist, -1))
+        return self._list_tables
+
+    def _encode(self, x, lists):
+        residuals = self._pad(x - self.centroids[lists])
+        codes = np.empty((len(x), self.m), dtype=np.uint8)
+        for j in range(self.m):
+            codes[:, j] = _assign(residuals[:, j], self.codebooks[j])
+        return codes
+
+    def add(self, vectors, ids):
+        """
+        Adds vectors to the index. Ids already in the index aren't checked for, adding one again indexes it twice.
+
+        :param vectors: Array of shape [n, dim].
+        :param ids: The sha256 of every vector.
+        """
+        if not self.is_trained:
+            raise ValueError('The index must be trained before vectors are added')
+        vectors = np.asarray(vectors, dtype=np.float32)
+        ids = np.asarray(ids, dtype='S64')
+        lists = _assign(vectors, self.centroids)
+        codes = self._encode(vectors, lists)
+        order = np.argsort(lists, kind='stable')
+        bounds = np.searchsorted(lists[order], np.arange(self.nlist + 1))
+        for l in np.flatnonzero(np.diff(bounds)):
+            rows = order[bounds[l]:bounds[l + 1]]
+            self._codes[l].append(codes[rows])
+            self._ids[l].append(ids[rows])
+
+    def _list(self, l):
+        # Merges the chunks added to a list since it was last read
+        if len(self._codes[l]) != 1:
+            codes = np.concatenate(self._codes[l]) if self._codes[l] else np.zeros((0, self.m), dtype=np.uint8)
+            ids = np.concatenate(self._ids[l]) if self._ids[l] else np.zeros(0, dtype='S64')
+            self._codes[l], self._ids[l] = [codes], [ids]
+        return self._codes[l][0], self._ids[l][0]
+
+    def search(self, query, k=10, nprobe=16, rerank=None, rerank_factor=4):
+        """
+        Returns the ids (sha256 strings) and squared L2 distances of the approximate k nearest neighbors of a vector,
+        nearest first.
+
+        :param query: Vector of shape [dim].
+        :param k: Number of neighbors.
+        :param nprobe: Number of inverted lists scanned, more is slower and more accurate.
+        :param rerank: Optional function returning the exact vectors ([n, dim]) of a list of ids, used to re-rank the
+                       rerank_factor * k best candidates by their exact distance.
+        :param rerank_factor: See rerank.
+        """
+        query = np.asarray(query, dtype=np.float32).reshape(1, self.dim)
+        coarse = _squared_distances(query, self.centroids)[0]
+        probes = np.argsort(coarse)[:nprobe]
+        offsets = np.arange(self.m) * self.ksub
+        list_tables = self.list_tables()
+        query_table = -2 * np.einsum('md,mkd->mk', self._pad(query)[0], self.codebooks).ravel()
+        all_ids, all_distances = [], []
+        for l in probes:
+            codes, ids = self._list(l)
+            if not len(ids):
+                continue
+            table = list_tables[l] + query_table
+            all_distances.append(coarse[l] + table[codes.astype(np.int64) + offsets].sum(axis=1))
+            all_ids.append(ids)
+        if not all_ids:
+            return [], np.zeros(0)
+        distances = np.concatenate(all_distances)
+        ids = np.concatenate(all_ids)
+        candidates = k * rerank_factor if rerank is not None else k
+        best = np.argsort(distances)[:candidates] if len(distances) > candidates else np.argsort(distances)
+        ids, distances = ids[best], distances[best]
+        if rerank is not None:
+            ids = [i.decode('ascii') for i in ids]
+            exact = np.asarray(rerank(ids), dtype=np.float32)
+            distances = ((exact - query) ** 2).sum(axis=1)
+            order = np.argsort(distances)[:k]
+            return [ids[i] for i in order], distances[order]
+        return [i.decode('ascii') for i in ids[:k]], distances[:k]
+
+    def save(self, path):
+        """ Saves the index to an npz file, replacing it atomically. """
+        lists = [self._list(l) for l in range(self.nlist)]
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, dim=self.dim, nlist=self.nlist, m=self.m, ksub=self.ksub, seed=self.seed,
+                 high_water_mark=self.high_water_mark, centroids=self.centroids, codebooks=self.codebooks,
+                 list_sizes=np.asarray([len(ids) for _, ids in lists]),
+                 codes=np.concatenate([codes for codes, _ in lists]), ids=np.concatenate([ids for _, ids in lists]))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            index = cls(int(f['dim']), int(f['nlist']), int(f['m']), int(f['ksub']).bit_length() - 1, int(f['seed']))
+            index.high_water_mark = int(f['high_water_mark'])
+            index.centroids, index.codebooks = f['centroids'], f['codebooks']
+            bounds = np.concatenate([[0], np.cumsum(f['list_sizes'])])
+            codes, ids = f['codes'], f['ids']
+            for l in range(index.nlist):
+                index._codes[l] = [codes[bounds[l]:bounds[l + 1]]]
+                index._ids[l] = [ids[bounds[l]:bounds[l + 1]]]
+        return index
+
+
+class LMDBVectors(object):
+    """ Postprocessed feature vectors of a features LMDB by sha256. """
+
+    def __init__(self, lmdb_path):
+        import lmdb
+        self.env = lmdb.open(lmdb_path, readonly=True, lock=False, map_size=int(1e13), subdir=False)
+
+    def fetch(self, keys):
+        """ Returns (the keys present in the LMDB, their vectors as an array of shape [n, feat_size]). """
+        present, vectors = [], []
+        with self.env.begin() as txn:
+            for key in keys:
+                value = txn.get(key.encode('ascii'))
+                if value is not None:
+                    present.append(key)
+                    vectors.append(decode(value))
+        return present, np.stack(vectors) if vectors else np.zeros((0, feat_size), dtype=np.float32)
+
+    def __call__(self, keys):
+        present, vectors = self.fetch(keys)
+        if len(present) != len(keys):
+            raise KeyError(f'{len(keys) - len(present)} of the keys are missing from the LMDB')
+        return vectors
+
+
+def _meta_rows(meta_db_path, after_rowid, limit=None):
+    """ Yields the (rowid, sha256) of the meta.db rows after after_rowid, in rowid order, from a cursor. """
+    con = sqlite3.connect(meta_db_path)
+    try:
+        query = 'SELECT rowid, sha256 FROM meta WHERE rowid > ? ORDER BY rowid'
+        yield from con.execute(query + (f' LIMIT {int(limit)}' if limit else ''), (after_rowid,))
+    finally:
+        con.close()
+
+
+def _count_meta_rows(meta_db_path, limit=None):
+    con = sqlite3.connect(meta_db_path)
+    try:
+        count = con.execute('SELECT COUNT(*) FROM meta').fetchone()[0]
+    finally:
+        con.close()
+    return min(count, int(limit)) if limit else count
+
+
+def add_from_lmdb(index, lmdb_path, meta_db_path, batch_size=10000, limit=None):
+    """
+    Adds the samples of meta.db after the index's high-water mark whose features are in the LMDB, and advances the
+    mark. Returns the number of vectors added.
+
+    :param index: A trained IVFPQIndex.
+    :param lmdb_path: Path of the features LMDB.
+    :param meta_db_path: Path of meta.db.
+    :param batch_size: Number of samples encoded at once.
+    :param limit: Optional maximum number of meta.db rows to scan.
+    """
+    vectors = LMDBVectors(lmdb_path)
+    rows = _meta_rows(meta_db_path, index.high_water_mark, limit)
+    added = 0
+    while True:
+        chunk = list(itertools.islice(rows, batch_size))
+        if not chunk:
+            return added
+        keys, batch = vectors.fetch([sha256 for _, sha256 in chunk])
+        if keys:
+            index.add(batch, keys)
+            added += len(keys)
+        index.high_water_mark = chunk[-1][0]
+
+
+def build_from_lmdb(lmdb_path, meta_db_path, train_size=100000, seed=0, limit=None, **index_kwargs):
+    """
+    Returns an IVFPQIndex trained on a random sample of the samples of meta.db and holding all of them.
+
+    :param lmdb_path: Path of the features LMDB.
+    :param meta_db_path: Path of meta.db.
+    :param train_size: Number of samples to train the centroids and codebooks on.
+    :param seed: Random seed.
+    :param limit: Optional maximum number of meta.db rows to index.
+    :param index_kwargs: Arguments of IVFPQIndex.
+    """
+    index = IVFPQIndex(seed=seed, **index_kwargs)
+    count = _count_meta_rows(meta_db_path, limit)
+    rng = np.random.default_rng(seed)
+    positions = set(rng.choice(count, min(train_size, count), replace=False).tolist())
+    sample = [sha256 for i, (_, sha256) in enumerate(_meta_rows(meta_db_path, 0, limit)) if i in positions]
+    index.train(LMDBVectors(lmdb_path).fetch(sample)[1])
+    add_from_lmdb(index, lmdb_path, meta_db_path, limit=limit)
+    return index
+
+
+def lookup_meta(meta_db_path, keys):
+    """ Returns a dict of sha256 to its meta.db row (a dict of META_COLUMNS) for the given keys. """
+    con = sqlite3.connect(meta_db_path)
+    try:
+        rows = con.execute(f'SELECT {", ".join(META_COLUMNS)} FROM meta WHERE sha256 IN ({", ".join("?" * len(keys))})',
+                           list(keys)).fetchall()
+    finally:
+        con.close()
+    return {row[0]: dict(zip(META_COLUMNS, row)) for row in rows}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Nearest neighbor index over the features LMDB.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help="Train an index and add every sample of meta.db to it.")
+    add_parser = subparsers.add_parser('add', help="Add the samples added to meta.db since the index was saved.")
+    for p in (build_parser, add_parser):
+        p.add_argument("index_path")
+        p.add_argument("lmdb_path")
+        p.add_argument("meta_db_path")
+        p.add_argument("--limit", type=int, help="Maximum number of meta.db rows to scan.")
+    build_parser.add_argument("--nlist", type=int, default=1024)
+    build_parser.add_argument("--m", type=int, default=64)
+    build_parser.add_argument("--train-size", type=int, default=100000)
+    build_parser.add_argument("--seed", type=int, default=0)
+
+    query_parser = subparsers.add_parser('query', help="Find the samples nearest to a PE file or an indexed sample.")
+    query_parser.add_argument("index_path")
+    query_parser.add_argument("meta_db_path")
+    source = query_parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--file", help="PE file to extract the features of.")
+    source.add_argument("--sha256", help="Sample whose features are in the LMDB.")
+    query_parser.add_argument("--lmdb", help="Features LMDB, to re-rank by exact distance (and for --sha256).")
+    query_parser.add_argument("-k", type=int, default=10)
+    query_parser.add_argument("--nprobe", type=int, default=16)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        start = time.perf_counter()
+        index = build_from_lmdb(args.lmdb_path, args.meta_db_path, args.train_size, args.seed, args.limit,
+                                nlist=args.nlist, m=args.m)
+        index.save(args.index_path)
+        print(f'Indexed {len(index)} samples in {time.perf_counter() - start:.1f}s')
+    elif args.command == 'add':
+        index = IVFPQIndex.load(args.index_path)
+        added = add_from_lmdb(index, args.lmdb_path, args.meta_db_path, limit=args.limit)
+        index.save(args.index_path)
+        print(f'Added {added} samples, {len(index)} in total')
+    else:
+        index = IVFPQIndex.load(args.index_path)
+        vectors = LMDBVectors(args.lmdb) if args.lmdb else None
+        if args.file:
+            import extraction
+            with open(args.file, 'rb') as f, extraction.GuardedExtractor() as extractor:
+                query = signed_log1p(np.asarray(extractor.feature_vector(f.read()), dtype=np.float32))
+        else:
+            if vectors is None:
+                query_parser.error('--sha256 requires --lmdb')
+            query = vectors([args.sha256])[0]
+        start = time.perf_counter()
+        ids, distances = index.search(query, args.k, args.nprobe, rerank=vectors)
+        elapsed = time.perf_counter() - start
+        meta = lookup_meta(args.meta_db_path, ids)
+        for sha256, distance in zip(ids, distances):
+            row = meta.get(sha256, {})
+            tags = [t for t in META_COLUMNS[4:] if row.get(t)]
+            print(f'{sha256}  distance {np.sqrt(distance):8.3f}  malware {row.get("is_malware")}  '
+                  f'detections {row.get("rl_ls_const_positives")}  tags {",".join(tags) or "-"}')
+        print(f'{elapsed * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
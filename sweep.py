@@ -0,0 +1,209 @@
+"""
+Hyperparameter sweeps over the experiments of runner.py.
+
+A sweep file gives a base experiment config, a search space over config keys, and how trials are ranked and pruned:
+
+    {
+        "base": {"mode": "simple_disc", "epochs": 30, "validation_set": "dataset/validation_set.npz"},
+        "space": {
+            "learning_rate": {"loguniform": [1e-5, 1e-3]},
+            "dropout": {"uniform": [0.0, 0.3]},
+            "batch_size": [64, 128, 256],
+            "discriminator_widths": [[512, 512, 128], [1024, 256]]
+        },
+        "trials": 20,
+        "objective": "discriminator.roc.auc", "objective_mode": "max",
+        "prune_metric": "validation.fnr_at_fpr", "prune_mode": "min", "prune_warmup": 3
+    }
+
+A list is a choice and {"uniform"|"loguniform"|"int": [low, high]} a distribution. With "trials", that many random
+trials are drawn (the first n trials of a seed don't change with "trials"), without it the grid of the lists is run.
+
+Trials run concurrently in runner.run_all worker processes, each pinned to its own cores. The data sets of the trials
+are converted once into memory-mapped copies (see feature_store.write_mmap) in the sweep directory, which all trials
+read through the shared page cache, except the training set of sparse trials, which is loaded from its numpy file. After prune_warmup epochs, a trial is pruned when its prune_metric is worse
+than the median of the other trials at the same epoch (median stopping), read from their metrics.json. Trials are
+cached by config like any runner experiment, so running a sweep again only runs the trials that haven't finished
+(resuming them from their checkpoints). Objective and prune metrics are dotted paths into the test metrics and the
+per-epoch statistics of runner.MetricsLog.
+
+Usage:
+    python sweep.py sweep.json --out sweeps/lr --workers 4 --cores-per-trial 2
+"""
+import argparse
+import glob
+import hashlib
+import itertools
+import json
+import math
+import os
+
+import numpy as np
+
+import runner
+
+
+def _sample(spec, rng):
+    if isinstance(spec, list):
+        return spec[rng.integers(len(spec))]
+    (kind, (low, high)), = spec.items()
+    if kind == 'uniform':
+        return float(rng.uniform(low, high))
+    if kind == 'loguniform':
+        return float(math.exp(rng.uniform(math.log(low), math.log(high))))
+    if kind == 'int':
+        return int(rng.integers(low, high + 1))
+    raise ValueError(f'Unknown distribution {kind!r}, expected a list, uniform, loguniform or int')
+
+
+def sample_space(space, trials=None, seed=0):
+    """
+    Returns the config overrides of every trial of a search space, see the module docstring.
+
+    :param space: Dict of config key to a list of values or a distribution.
+    :param trials: Number of random trials, or None for the grid of the lists (no distributions allowed).
+    :param seed: Random seed.
+    """
+    if trials is None:
+        keys = list(space)
+        if not all(isinstance(space[key], list) for key in keys):
+            raise ValueError('Distributions need a number of trials, a grid only takes lists of values')
+        return [dict(zip(keys, values)) for values in itertools.product(*(space[key] for key in keys))]
+    rng = np.random.default_rng(seed)
+    return [{key: _sample(spec, rng) for key, spec in space.items()} for _ in range(trials)]
+
+
+def lookup(obj, path):
+    """ Returns the value at a dotted path of nested dicts, or None if it's missing. """
+    for key in path.split('.'):
+        if not isinstance(obj, dict) or key not in obj:
+            return None
+        obj = obj[key]
+    return obj
+
+
+def share_dataset(path, data_dir):
+    """
+    Returns the path of a memory-mapped copy of a feature set in data_dir, written on first use. Copies are named
+    after the source path, size and modification time, so a changed source gets a new copy.
+
+    :param path: Numpy file or feature store directory.
+    :param data_dir: Directory of the copies.
+    """
+    import feature_store
+
+    if os.path.isfile(os.path.join(path, feature_store.MMAP_FEATURES)):
+        return path
+    stat = os.stat(path)
+    key = hashlib.sha1(f'{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime}'.encode('utf-8')).hexdigest()[:12]
+    name = os.path.splitext(os.path.basename(os.path.normpath(path)))[0]
+    mmap_path = os.path.join(data_dir, f'{name}-{key}')
+    if not os.path.isfile(os.path.join(mmap_path, feature_store.MMAP_FEATURES)):
+        labels, feats = feature_store.load(path)
+        feature_store.write_mmap(mmap_path, labels, feats)
+    return mmap_path
+
+
+class MedianPruner(object):
+    """
+    Prunes a trial when its metric is worse than the median of the other trials at the same stage and epoch, see
+    runner.MetricsLog. Picklable, so it can be passed to worker processes.
+    """
+
+    def __init__(self, runs_dir, metric='loss', mode='min', warmup=3, min_trials=3):
+        """
+        :param runs_dir: Directory of the trials' runs.
+        :param metric: Dotted path of the metric in the epoch statistics.
+        :param mode: 'min' if lower values are better, 'max' otherwise.
+        :param warmup: Number of epochs before a trial can be pruned.
+        :param min_trials: Number of other trials that must have reached the epoch.
+        """
+        self.runs_dir = runs_dir
+        self.metric = metric
+        self.mode = mode
+        self.warmup = warmup
+        self.min_trials = min_trials
+
+    def __call__(self, path, stage, epoch, stats):
+        value = lookup(stats, self.metric)
+        if epoch <= self.warmup or value is None:
+            return False
+        others = []
+        for other_path in glob.glob(os.path.join(self.runs_dir, '*', 'metrics.json')):
+            if os.path.samefile(other_path, path):
+                continue
+            try:
+                with open(other_path) as f:
+                    epochs = json.load(f)['epochs']
+            except (OSError, ValueError):  # Replaced while being read
+                continue
+            others += [lookup(e, self.metric) for e in epochs if e['stage'] == stage and e['epoch'] == epoch]
+        others = [v for v in others if v is not None]
+        if len(others) < self.min_trials:
+            return False
+        median = float(np.median(others))
+        return value > median if self.mode == 'min' else value < median
+
+
+def run_sweep(sweep, out_dir, workers=1, cores_per_trial=None):
+    """
+    Runs the trials of a sweep, or returns the cached results of those that finished. Returns a list of trial
+    summaries, best first, which is also written to summary.json in out_dir.
+
+    :param sweep: Sweep dict, see the module docstring.
+    :param out_dir: Directory of the sweep's shared data, runs and summary.
+    :param workers: Number of trials run concurrently.
+    :param cores_per_trial: Number of cores every trial is pinned to.
+    """
+    base = dict(sweep.get('base', {}))
+    overrides = sample_space(sweep['space'], sweep.get('trials'), sweep.get('seed', 0))
+    configs = [runner.make_config(**dict(base, **trial)) for trial in overrides]
+    data_dir = os.path.join(out_dir, 'data')
+    os.makedirs(data_dir, exist_ok=True)
+    shared = {}
+    for config in configs:
+        for key in ('train_set', 'test_set', 'validation_set'):
+            # Sparse training sets are split into blocks from the numpy file, see gan.prepare_datasets
+            if config[key] and not (key == 'train_set' and config['sparse']):
+                if config[key] not in shared:
+                    shared[config[key]] = share_dataset(config[key], data_dir)
+                config[key] = shared[config[key]]
+    runs_dir = os.path.join(out_dir, 'runs')
+    pruner = MedianPruner(runs_dir, sweep.get('prune_metric', 'loss'), sweep.get('prune_mode', 'min'),
+                          sweep.get('prune_warmup', 3), sweep.get('prune_min_trials', 3))
+    # Identical trials (e.g. repeated random choices) are run once
+    unique = list({runner.config_hash(config): config for config in configs}.values())
+    results = runner.run_all(unique, runs_dir, workers, cores_per_worker=cores_per_trial, pruner=pruner)
+    by_hash = {runner.config_hash(result['config']): result for result in results}
+
+    objective = sweep.get('objective', 'discriminator.roc.auc')
+    summary = []
+    for trial, config in zip(overrides, configs):
+        result = by_hash[runner.config_hash(config)]
+        summary.append({'params': trial, 'objective': lookup(result['test'], objective),
+                        'pruned': result.get('pruned'), 'run_dir': runner.run_dir_for(config, runs_dir)})
+    sign = -1 if sweep.get('objective_mode', 'max') == 'max' else 1
+    summary.sort(key=lambda s: (s['objective'] is None, sign * (s['objective'] or 0)))
+    with open(os.path.join(out_dir, 'summary.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a hyperparameter sweep over runner.py experiments.")
+    parser.add_argument("sweep", help="JSON sweep file, see the module docstring.")
+    parser.add_argument("--out", required=True, help="Directory of the sweep's data, runs and summary.json.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of trials run concurrently.")
+    parser.add_argument("--cores-per-trial", type=int, help="Pin every trial to its own set of this many cores.")
+    args = parser.parse_args()
+
+    with open(args.sweep) as f:
+        sweep = json.load(f)
+    summary = run_sweep(sweep, args.out, args.workers, args.cores_per_trial)
+    for rank, trial in enumerate(summary, 1):
+        pruned = f' (pruned at epoch {trial["pruned"]["epoch"]})' if trial['pruned'] else ''
+        print(f'#{rank} {trial["objective"]}{pruned}: {json.dumps(trial["params"])}')
+
+
+if __name__ == '__main__':
+    main()
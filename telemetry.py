@@ -0,0 +1,124 @@
+"""
+Per-step training telemetry for gan.train: step time, time blocked waiting for the next batch, examples/sec, loss and
+gradient norms, written to a JSON Lines log and/or TensorBoard, plus optional tf.profiler trace windows.
+
+Telemetry is opt-in, gan.train does no extra timing or synchronization when none is passed.
+"""
+import json
+import time
+
+import numpy as np
+
+from lazy import lazy_import
+
+tf = lazy_import('tensorflow')
+
+
+class TrainingTelemetry(object):
+    """ Collects per-step training statistics. """
+
+    def __init__(self, log_path=None, tensorboard_dir=None, profile_steps=None, profile_dir=None, log_every=1,
+                 stall_warning=0.2):
+        """
+        :param log_path: Path of a JSON Lines file receiving one record per logged step and one per epoch.
+        :param tensorboard_dir: Directory to write TensorBoard summaries to.
+        :param profile_steps: Optional (start, stop) global steps between which a tf.profiler trace is captured.
+        :param profile_dir: Directory for profiler traces, defaults to tensorboard_dir.
+        :param log_every: Only write every Nth step to the log/TensorBoard, epoch summaries cover all steps.
+        :param stall_warning: Warn when more than this fraction of an epoch was spent waiting for input.
+        """
+        self.log_every = log_every
+        self.stall_warning = stall_warning
+        self.profile_steps = profile_steps
+        self.profile_dir = profile_dir or tensorboard_dir
+        self._log = open(log_path, 'a') if log_path else None
+        self._writer = tf.summary.create_file_writer(tensorboard_dir) if tensorboard_dir else None
+        self._profiling = False
+        self._reset_epoch()
+
+    def _reset_epoch(self):
+        self._step_times = []
+        self._wait_times = []
+        self._examples = 0
+
+    def _maybe_profile(self, step):
+        if self.profile_steps is None:
+            return
+        start, stop = self.profile_steps
+        if step == start and not self._profiling:
+            tf.profiler.experimental.start(self.profile_dir)
+            self._profiling = True
+        elif step >= stop and self._profiling:
+            tf.profiler.experimental.stop()
+            self._profiling = False
+
+    def record_step(self, step, wait_time, step_time, examples, loss, grad_norms=None):
+        """
+        Records one training step.
+
+        :param step: Global step number.
+        :param wait_time: Seconds spent blocked waiting for the batch.
+        :param step_time: Seconds spent in the forward/backward pass and optimizer update.
+        :param examples: Number of examples in the batch.
+        :param loss: Loss of the step.
+        :param grad_norms: Optional dict of name to global gradient norm.
+        """
+        self._maybe_profile(step)
+        self._step_times.append(step_time)
+        self._wait_times.append(wait_time)
+        self._examples += examples
+        if step % self.log_every:
+            return
+
+        record = {'step': step, 'wait_time': wait_time, 'step_time': step_time,
+                  'examples_per_sec': examples / (wait_time + step_time) if wait_time + step_time > 0 else 0.0,
+                  'loss': float(loss)}
+        for name, norm in (grad_norms or {}).items():
+            record[f'grad_norm/{name}'] = float(norm)
+
+        if self._log is not None:
+            self._log.write(json.dumps(record) + '\n')
+        if self._writer is not None:
+            with self._writer.as_default():
+                for key, value in record.items():
+                    if key != 'step':
+                        tf.summary.scalar(key, value, step=step)
+
+    def end_epoch(self, epoch):
+        """ Writes and returns a summary of the epoch's steps. """
+        step_times = np.asarray(self._step_times)
+        wait_times = np.asarray(self._wait_times)
+        total = float(step_times.sum() + wait_times.sum())
+        summary = {
+            'epoch': epoch,
+            'steps': len(step_times),
+            'examples_per_sec': self._examples / total if total > 0 else 0.0,
+            'step_time_p50': float(np.percentile(step_times, 50)) if len(step_times) else 0.0,
+            'step_time_p95': float(np.percentile(step_times, 95)) if len(step_times) else 0.0,
+            'input_wait_total': float(wait_times.sum()),
+            'input_stall_fraction': float(wait_times.sum()) / total if total > 0 else 0.0,
+        }
+        if summary['input_stall_fraction'] > self.stall_warning:
+            print(f'WARNING: {summary["input_stall_fraction"] * 100:.1f}% of epoch #{epoch} was spent waiting for '
+                  f'input, the input pipeline is the bottleneck')
+
+        if self._log is not None:
+            self._log.write(json.dumps(summary) + '\n')
+            self._log.flush()
+        if self._writer is not None:
+            with self._writer.as_default():
+                for key in ('examples_per_sec', 'input_stall_fraction', 'step_time_p50', 'step_time_p95'):
+                    tf.summary.scalar(f'epoch/{key}', summary[key], step=epoch)
+            self._writer.flush()
+        self._reset_epoch()
+        return summary
+
+    def close(self):
+        if self._profiling:
+            tf.profiler.experimental.stop()
+            self._profiling = False
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+        if self._writer is not None:
+            self._writer.close()
@@ -0,0 +1,224 @@
+"""
+Periodic validation, early stopping and plateau-based learning rate reduction for gan.train.
+
+Validation runs on a background thread against a snapshot of the model's weights, so training continues while the
+validation split is being scored. The metrics of an epoch are therefore usually acted upon one epoch later.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from lazy import lazy_import
+
+tf = lazy_import('tensorflow')
+
+
+def discriminator_scores(discriminator, features, labels):
+    """ Scores a validation batch with a discriminator. Returns (scores, labels). """
+    return discriminator(features, training=False).numpy().reshape(-1), labels.numpy().reshape(-1)
+
+
+def make_generator_scores(black_box):
+    """
+    Returns a scoring function for validating a generator: malware in the batch is obscured by the generator and,
+    together with the benign samples, scored by the black box. A good generator raises the black box's FNR.
+
+    :param black_box: Discriminator the generator is trained to evade.
+    """
+    import gan
+
+    def generator_scores(generator, features, labels):
+        labels = tf.reshape(labels, [-1])
+        features = tf.cast(features, tf.float32)
+        malware_feats = tf.boolean_mask(features, labels == 1)
+        benign_feats = tf.boolean_mask(features, labels == 0)
+        noise = tf.random.normal([tf.shape(malware_feats)[0], gan.generator_noise_dim(generator)], dtype=tf.float32)
+        gen_output = generator(tf.concat([malware_feats, noise], axis=1), training=False)
+        obscured = gan.edit_features(malware_feats, gen_output)
+        scores = np.concatenate([black_box(benign_feats, training=False).numpy().reshape(-1),
+                                 black_box(obscured, training=False).numpy().reshape(-1)])
+        return scores, np.concatenate([np.zeros(len(benign_feats)), np.ones(len(obscured))])
+
+    return generator_scores
+
+
+def sorel_validation_dataset(metadb_path, lmdb_path, batch_size=1024, n_samples=None):
+    """
+    Returns the 'validation' split of SOREL as a batched tf.data dataset of (features, labels).
+
+    :param metadb_path: Path of meta.db.
+    :param lmdb_path: Path of the features LMDB.
+    :param batch_size: Number of samples per batch.
+    :param n_samples: Optional limit on the number of samples queried from meta.db.
+    """
+    import dataset
+    import evaluate
+    import gan
+
+    ds = dataset.Dataset(metadb_path, lmdb_path, return_malicious=True, return_counts=False, return_tags=True,
+                         mode='validation', n_samples=n_samples)
+
+    def batches():
+        for features, labels, _ in evaluate.sorel_batches(ds, batch_size):
+            yield features.astype(np.float32), labels.reshape(-1, 1).astype(np.float32)
+
+    return tf.data.Dataset.from_generator(batches, output_signature=(
+        tf.TensorSpec([None, gan.feat_size], tf.float32),
+        tf.TensorSpec([None, 1], tf.float32)))
+
+
+class Validator(object):
+    """ Scores a validation dataset with a snapshot of a model, on a background thread. """
+
+    def __init__(self, dataset, model, input_dim, score_fn=discriminator_scores, target_fpr=1e-3, bins=10000,
+                 background=True):
+        """
+        :param dataset: Batched validation dataset of (features, labels).
+        :param model: Model being trained, its weights are copied into a snapshot before every validation run.
+        :param input_dim: Input dimension of the model, used to build the snapshot.
+        :param score_fn: Callable (model, features, labels) -> (scores, labels).
+        :param target_fpr: False positive rate at which 'fnr_at_fpr' is reported.
+        :param bins: Histogram bins of the ROC accumulator.
+        :param background: Validate on a background thread instead of blocking training.
+        """
+        self.dataset = dataset
+        self.model = model
+        self.input_dim = input_dim
+        self.score_fn = score_fn
+        self.target_fpr = target_fpr
+        self.bins = bins
+        self._snapshot = None
+        self._pool = ThreadPoolExecutor(max_workers=1) if background else None
+        self._pending = None
+        self.latest = None
+
+    def _make_snapshot(self):
+        try:
+            snapshot = tf.keras.models.clone_model(self.model)
+            snapshot.build([None, self.input_dim])
+            return snapshot
+        except (TypeError, ValueError, NotImplementedError):
+            # Models with layers that can't be cloned are validated in place instead
+            return self.model
+
+    def _run(self, epoch, model):
+        import evaluate
+
+        roc = evaluate.StreamingROC(bins=self.bins)
+        for features, labels in self.dataset:
+            scores, labels = self.score_fn(model, features, labels)
+            roc.update(scores, labels)
+        threshold, fpr, tpr = roc.threshold_at_fpr(self.target_fpr)
+        return {'epoch': epoch, 'auc': roc.auc(), 'fnr_at_fpr': 1.0 - tpr, 'fpr': fpr, 'threshold': threshold,
+                'target_fpr': self.target_fpr}
+
+    def submit(self, epoch):
+        """ Starts validating the current weights of the model. Returns the latest finished metrics, if any. """
+        if self._snapshot is None:
+            self._snapshot = self._make_snapshot()
+        # Don't overwrite the snapshot while the previous run is still using it
+        self.poll(wait=True)
+        if self._snapshot is not self.model:
+            self._snapshot.set_weights(self.model.get_weights())
+
+        if self._pool is None or self._snapshot is self.model:
+            self.latest = self._run(epoch, self._snapshot)
+        else:
+            self._pending = self._pool.submit(self._run, epoch, self._snapshot)
+        return self.latest
+
+    def poll(self, wait=False):
+        """ Returns the latest finished metrics, optionally waiting for the running validation. """
+        if self._pending is not None and (wait or self._pending.done()):
+            self.latest = self._pending.result()
+            self._pending = None
+        return self.latest
+
+    def close(self):
+        result = self.poll(wait=True)
+        if self._pool is not None:
+            self._pool.shutdown()
+        return result
+
+
+class EarlyStopping(object):
+    """ Signals to stop training once a validation metric hasn't improved for a number of validations. """
+
+    def __init__(self, metric='fnr_at_fpr', mode='min', patience=3, min_delta=0.0):
+        """
+        :param metric: Key of the validation metrics to monitor.
+        :param mode: 'min' if lower values are better, 'max' otherwise.
+        :param patience: Number of validations without improvement to tolerate.
+        :param min_delta: Minimum change counted as an improvement.
+        """
+        self.metric = metric
+        self.mode = mode
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best = None
+        self.best_epoch = None
+        self.wait = 0
+        self._seen_epochs = set()
+
+    def _improved(self, value):
+        if self.best is None:
+            return True
+        if self.mode == 'min':
+            return value < self.best - self.min_delta
+        return value > self.best + self.min_delta
+
+    def update(self, metrics):
+        """ Takes the metrics of a validation run and returns True if training should stop. """
+        if metrics is None or metrics['epoch'] in self._seen_epochs:
+            return False
+        self._seen_epochs.add(metrics['epoch'])
+        value = metrics[self.metric]
+        if self._improved(value):
+            self.best, self.best_epoch, self.wait = value, metrics['epoch'], 0
+            return False
+        self.wait += 1
+        return self.wait >= self.patience
+
+
+class ReduceLROnPlateau(object):
+    """ Multiplies optimizer learning rates by a factor when a validation metric stops improving. """
+
+    def __init__(self, optimizers, metric='fnr_at_fpr', mode='min', factor=0.5, patience=2, min_lr=1e-6):
+        """
+        :param optimizers: Optimizers whose learning rates are reduced. Optimizers driven by a schedule are skipped.
+        :param metric: Key of the validation metrics to monitor.
+        :param mode: 'min' if lower values are better, 'max' otherwise.
+        :param factor: Factor applied to the learning rate.
+        :param patience: Number of validations without improvement before reducing.
+        :param min_lr: Lower bound of the learning rate.
+        """
+        self.optimizers = [o for o in optimizers if isinstance(o.learning_rate, tf.Variable)]
+        self.factor = factor
+        self.min_lr = min_lr
+        self._plateau = EarlyStopping(metric, mode, patience)
+
+    def update(self, metrics):
+        if self._plateau.update(metrics):
+            for optimizer in self.optimizers:
+                new_lr = max(float(optimizer.learning_rate.numpy()) * self.factor, self.min_lr)
+                optimizer.learning_rate.assign(new_lr)
+                print(f'Reducing learning rate to {new_lr}')
+            self._plateau.wait = 0
+
+
+def make_learning_rate(schedule, initial_rate, decay_steps=10000, decay_rate=0.5):
+    """
+    Returns a learning rate, or schedule, for gan.set_learning_rates.
+
+    :param schedule: 'constant', 'exponential' or 'cosine'.
+    :param initial_rate: Initial learning rate.
+    :param decay_steps: Steps over which the rate decays by decay_rate (exponential) or to 0 (cosine).
+    :param decay_rate: Decay factor of the exponential schedule.
+    """
+    if schedule == 'constant':
+        return initial_rate
+    if schedule == 'exponential':
+        return tf.keras.optimizers.schedules.ExponentialDecay(initial_rate, decay_steps, decay_rate)
+    if schedule == 'cosine':
+        return tf.keras.optimizers.schedules.CosineDecay(initial_rate, decay_steps)
+    raise ValueError(f'Unknown learning rate schedule {schedule!r}')